@@ -2,12 +2,12 @@
 import json
 import os
 import base64
-from typing import Dict, Any
+from typing import Dict, Any, List
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import jwt
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from pydantic import BaseModel, Field
 
 # Environment
@@ -79,6 +79,31 @@ class ApprovalActionRequest(BaseModel):
     action: str = Field(..., pattern='^(approve|reject|submit|revoke)$')
     comment: str = Field(default='')
 
+class BulkApprovalRequest(BaseModel):
+    """Модель запроса на массовое утверждение/отклонение"""
+    payment_ids: List[int] = Field(..., min_length=1, max_length=500)
+    action: str = Field(..., pattern='^(approve|reject)$')
+    comment: str = Field(default='')
+
+def parse_body(event: Dict[str, Any]) -> dict:
+    """Разбирает тело запроса с учётом base64"""
+    body_str = event.get('body', '{}')
+    if event.get('isBase64Encoded', False):
+        body_str = base64.b64decode(body_str).decode('utf-8')
+    return json.loads(body_str or '{}')
+
+def get_user_role_flags(cur, user_id: int) -> tuple:
+    """Возвращает (is_admin, is_ceo) для пользователя"""
+    cur.execute(f"""
+        SELECT r.name FROM {SCHEMA}.user_roles ur
+        JOIN {SCHEMA}.roles r ON ur.role_id = r.id
+        WHERE ur.user_id = %s
+    """, (user_id,))
+    user_roles = [row['name'] for row in cur.fetchall()]
+    is_admin = 'Администратор' in user_roles or 'Admin' in user_roles
+    is_ceo = 'CEO' in user_roles or 'Генеральный директор' in user_roles
+    return is_admin, is_ceo
+
 def handle_payment_history(event: Dict[str, Any], conn, payment_id: int) -> Dict[str, Any]:
     """Получение истории согласования платежа"""
     cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -105,13 +130,14 @@ def handle_payment_history(event: Dict[str, Any], conn, payment_id: int) -> Dict
     
     return response(200, {'history': history})
 
-def handle_approvals_list(event: Dict[str, Any], conn, user_id: int) -> Dict[str, Any]:
-    """Получение списка платежей на утверждение"""
+def handle_approvals_list(event: Dict[str, Any], conn, user_id: int, mine: bool = False) -> Dict[str, Any]:
+    """Получение списка платежей на утверждение.
+
+    При mine=True платежи берутся из очереди approval_queue по индексу approver_id.
+    """
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
-    # Получаем платежи, где текущий пользователь - промежуточный или финальный утверждающий
-    cur.execute(f"""
-        SELECT DISTINCT
+    select_fields = """
             p.id, p.category_id, p.amount, p.description, p.payment_date,
             p.status, p.created_at, p.created_by,
             p.legal_entity_id, p.contractor_id, p.department_id, p.service_id,
@@ -121,68 +147,77 @@ def handle_approvals_list(event: Dict[str, Any], conn, user_id: int) -> Dict[str
             cont.name as contractor_name,
             dep.name as department_name,
             s.name as service_name,
+            s.intermediate_approver_id,
+            s.final_approver_id,
             u.username as created_by_username,
-            u.full_name as created_by_full_name
-        FROM {SCHEMA}.payments p
+            u.full_name as created_by_full_name"""
+    joins = f"""
         LEFT JOIN {SCHEMA}.categories c ON p.category_id = c.id
         LEFT JOIN {SCHEMA}.legal_entities le ON p.legal_entity_id = le.id
         LEFT JOIN {SCHEMA}.contractors cont ON p.contractor_id = cont.id
         LEFT JOIN {SCHEMA}.customer_departments dep ON p.department_id = dep.id
         LEFT JOIN {SCHEMA}.services s ON p.service_id = s.id
-        LEFT JOIN {SCHEMA}.users u ON p.created_by = u.id
-        WHERE p.status IN ('pending_ceo', 'pending_tech_director', 'pending_ib', 'pending_cfo')
-        ORDER BY p.created_at DESC
-    """)
+        LEFT JOIN {SCHEMA}.users u ON p.created_by = u.id"""
     
-    payments_data = cur.fetchall()
-    payments = []
-    
-    for payment in payments_data:
-        payment_dict = dict(payment)
-        
-        # Получаем историю утверждений
+    if mine:
+        # Платежи, где текущий пользователь - промежуточный или финальный утверждающий
+        cur.execute(f"""
+            SELECT {select_fields}, q.stage as approval_stage
+            FROM {SCHEMA}.approval_queue q
+            JOIN {SCHEMA}.payments p ON p.id = q.payment_id
+            {joins}
+            WHERE q.approver_id = %s
+            ORDER BY p.created_at DESC
+        """, (user_id,))
+    else:
+        cur.execute(f"""
+            SELECT {select_fields}
+            FROM {SCHEMA}.payments p
+            {joins}
+            WHERE p.status IN ('pending_ceo', 'pending_tech_director', 'pending_ib', 'pending_cfo')
+            ORDER BY p.created_at DESC
+        """)
+    
+    payments = [dict(row) for row in cur.fetchall()]
+    payment_ids = [p['id'] for p in payments]
+    
+    # История утверждений и утверждающие загружаются одним запросом на весь список
+    history_by_payment: Dict[int, list] = {pid: [] for pid in payment_ids}
+    if payment_ids:
         cur.execute(f"""
             SELECT a.id, a.payment_id, a.approver_id, a.action, a.comment, a.created_at,
                    u.username as approver_username,
                    u.full_name as approver_full_name
             FROM {SCHEMA}.approvals a
             LEFT JOIN {SCHEMA}.users u ON a.approver_id = u.id
-            WHERE a.payment_id = %s
+            WHERE a.payment_id = ANY(%s)
             ORDER BY a.created_at DESC
-        """, (payment['id'],))
-        
-        approval_history = [dict(row) for row in cur.fetchall()]
-        payment_dict['approval_history'] = approval_history
-        
-        # Получаем информацию об утверждающих через сервис
-        if payment['service_id']:
-            cur.execute(f"""
-                SELECT intermediate_approver_id, final_approver_id
-                FROM {SCHEMA}.services
-                WHERE id = %s
-            """, (payment['service_id'],))
-            service_info = cur.fetchone()
-            
-            if service_info:
-                # Получаем информацию о промежуточном утверждающем
-                cur.execute(f"""
-                    SELECT id, username, full_name
-                    FROM {SCHEMA}.users
-                    WHERE id = %s
-                """, (service_info['intermediate_approver_id'],))
-                intermediate_approver = cur.fetchone()
-                payment_dict['intermediate_approver'] = dict(intermediate_approver) if intermediate_approver else None
-                
-                # Получаем информацию о финальном утверждающем
-                cur.execute(f"""
-                    SELECT id, username, full_name
-                    FROM {SCHEMA}.users
-                    WHERE id = %s
-                """, (service_info['final_approver_id'],))
-                final_approver = cur.fetchone()
-                payment_dict['final_approver'] = dict(final_approver) if final_approver else None
-        
-        payments.append(payment_dict)
+        """, (payment_ids,))
+        for row in cur.fetchall():
+            history_by_payment[row['payment_id']].append(dict(row))
+    
+    approver_ids = {
+        approver_id
+        for p in payments
+        for approver_id in (p['intermediate_approver_id'], p['final_approver_id'])
+        if approver_id
+    }
+    approvers: Dict[int, dict] = {}
+    if approver_ids:
+        cur.execute(f"""
+            SELECT id, username, full_name
+            FROM {SCHEMA}.users
+            WHERE id = ANY(%s)
+        """, (list(approver_ids),))
+        approvers = {row['id']: dict(row) for row in cur.fetchall()}
+    
+    for payment_dict in payments:
+        payment_dict['approval_history'] = history_by_payment[payment_dict['id']]
+        intermediate_approver_id = payment_dict.pop('intermediate_approver_id')
+        final_approver_id = payment_dict.pop('final_approver_id')
+        if payment_dict['service_id']:
+            payment_dict['intermediate_approver'] = approvers.get(intermediate_approver_id)
+            payment_dict['final_approver'] = approvers.get(final_approver_id)
     
     cur.close()
     return response(200, {'payments': payments})
@@ -190,13 +225,7 @@ def handle_approvals_list(event: Dict[str, Any], conn, user_id: int) -> Dict[str
 def handle_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[str, Any]:
     """Утверждение или отклонение платежа"""
     try:
-        body_str = event.get('body', '{}')
-        
-        # Проверяем, закодировано ли body в base64
-        if event.get('isBase64Encoded', False):
-            body_str = base64.b64decode(body_str).decode('utf-8')
-        
-        body = json.loads(body_str)
+        body = parse_body(event)
         print(f"[DEBUG] Received body: {body}")
         approval_action = ApprovalActionRequest(**body)
     except Exception as e:
@@ -211,11 +240,13 @@ def handle_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[st
         FROM {SCHEMA}.payments p
         LEFT JOIN {SCHEMA}.services s ON p.service_id = s.id
         WHERE p.id = %s
+        FOR UPDATE OF p
     """, (approval_action.payment_id,))
     
     payment = cur.fetchone()
     
     if not payment:
+        conn.rollback()
         cur.close()
         return response(404, {'error': 'Платеж не найден'})
     
@@ -223,33 +254,30 @@ def handle_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[st
     is_final_approver = payment['final_approver_id'] == user_id
     
     # Проверяем, является ли пользователь администратором или CEO
-    cur.execute(f"""
-        SELECT r.name FROM {SCHEMA}.user_roles ur
-        JOIN {SCHEMA}.roles r ON ur.role_id = r.id
-        WHERE ur.user_id = %s
-    """, (user_id,))
-    user_roles = [row['name'] for row in cur.fetchall()]
-    is_admin = 'Администратор' in user_roles or 'Admin' in user_roles
-    is_ceo = 'CEO' in user_roles or 'Генеральный директор' in user_roles
+    is_admin, is_ceo = get_user_role_flags(cur, user_id)
     
     # Определяем новый статус
     if approval_action.action == 'submit':
         if payment['status'] not in ('draft', 'rejected', None):
+            conn.rollback()
             cur.close()
             return response(400, {'error': 'Только черновики и отклонённые платежи можно отправить на согласование'})
         new_status = 'pending_ceo'
     elif approval_action.action == 'approve':
         # Администратор и CEO могут согласовывать любые платежи
         if not is_admin and not is_ceo and not is_intermediate_approver and not is_final_approver:
+            conn.rollback()
             cur.close()
             return response(403, {'error': 'Вы не являетесь утверждающим для этого платежа'})
         if not str(payment['status']).startswith('pending_'):
+            conn.rollback()
             cur.close()
             return response(400, {'error': 'Неверный статус платежа для утверждения'})
         new_status = 'approved'
     elif approval_action.action == 'revoke':
         # Проверяем, что платёж можно отозвать (на согласовании или одобрен)
         if payment['status'] not in ('pending_ceo', 'pending_tech_director', 'approved'):
+            conn.rollback()
             cur.close()
             return response(400, {'error': 'Можно отозвать только платежи на согласовании или одобренные'})
         
@@ -257,11 +285,13 @@ def handle_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[st
         is_creator = payment.get('created_by') == user_id
         
         if not is_creator and not is_admin and not is_ceo:
+            conn.rollback()
             cur.close()
             return response(403, {'error': 'Только создатель платежа, администратор или CEO может его отозвать'})
         
         # Проверяем наличие причины отзыва
         if not approval_action.comment or not approval_action.comment.strip():
+            conn.rollback()
             cur.close()
             return response(400, {'error': 'Причина отзыва обязательна'})
         
@@ -269,6 +299,7 @@ def handle_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[st
     elif approval_action.action == 'reject':
         # Администратор и CEO могут отклонять любые платежи
         if not is_admin and not is_ceo and not is_intermediate_approver and not is_final_approver:
+            conn.rollback()
             cur.close()
             return response(403, {'error': 'Вы не являетесь утверждающим для этого платежа'})
         new_status = 'rejected'
@@ -309,11 +340,86 @@ def handle_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[st
         VALUES (%s, %s, %s, %s, %s, %s)
     """, (approval_action.payment_id, user_id, 'submitter', approval_action.action, approval_action.comment, now_moscow))
     
+    # Очередь approval_queue обновляется триггером на смену статуса платежа
     conn.commit()
     cur.close()
     
     return response(200, {'message': 'Действие выполнено успешно', 'new_status': new_status})
 
+def handle_bulk_approval_action(event: Dict[str, Any], conn, user_id: int) -> Dict[str, Any]:
+    """Массовое утверждение или отклонение платежей одним набором запросов"""
+    try:
+        bulk_action = BulkApprovalRequest(**parse_body(event))
+    except Exception as e:
+        print(f"[ERROR] Validation failed: {str(e)}, body: {event.get('body', '{}')}")
+        return response(400, {'error': f'Ошибка валидации: {str(e)}'})
+    
+    payment_ids = list(dict.fromkeys(bulk_action.payment_ids))
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    is_admin, is_ceo = get_user_role_flags(cur, user_id)
+    
+    cur.execute(f"""
+        SELECT p.id, p.status, s.intermediate_approver_id, s.final_approver_id
+        FROM {SCHEMA}.payments p
+        LEFT JOIN {SCHEMA}.services s ON p.service_id = s.id
+        WHERE p.id = ANY(%s)
+        FOR UPDATE OF p
+    """, (payment_ids,))
+    payments = {row['id']: row for row in cur.fetchall()}
+    
+    processed = []
+    skipped = []
+    for payment_id in payment_ids:
+        payment = payments.get(payment_id)
+        if not payment:
+            skipped.append({'payment_id': payment_id, 'error': 'Платеж не найден'})
+        elif not (is_admin or is_ceo or user_id in (payment['intermediate_approver_id'], payment['final_approver_id'])):
+            skipped.append({'payment_id': payment_id, 'error': 'Вы не являетесь утверждающим для этого платежа'})
+        elif not str(payment['status']).startswith('pending_'):
+            skipped.append({'payment_id': payment_id, 'error': 'Платеж не находится на согласовании'})
+        else:
+            processed.append(payment_id)
+    
+    new_status = 'approved' if bulk_action.action == 'approve' else 'rejected'
+    
+    if processed:
+        moscow_tz = ZoneInfo('Europe/Moscow')
+        now_moscow = datetime.now(moscow_tz).replace(tzinfo=None)
+        
+        if new_status == 'approved':
+            cur.execute(f"""
+                UPDATE {SCHEMA}.payments
+                SET status = %s,
+                    ceo_approved_at = %s,
+                    ceo_approved_by = %s,
+                    submitted_at = COALESCE(submitted_at, %s)
+                WHERE id = ANY(%s)
+            """, (new_status, now_moscow, user_id, now_moscow, processed))
+        else:
+            cur.execute(f"""
+                UPDATE {SCHEMA}.payments
+                SET status = %s
+                WHERE id = ANY(%s)
+            """, (new_status, processed))
+        
+        execute_values(cur, f"""
+            INSERT INTO {SCHEMA}.approvals (payment_id, approver_id, approver_role, action, comment, created_at)
+            VALUES %s
+        """, [
+            (payment_id, user_id, 'submitter', bulk_action.action, bulk_action.comment, now_moscow)
+            for payment_id in processed
+        ])
+    
+    conn.commit()
+    cur.close()
+    
+    return response(200, {
+        'message': 'Действие выполнено успешно',
+        'new_status': new_status,
+        'processed': processed,
+        'skipped': skipped
+    })
+
 def handle_approvers_list(event: Dict[str, Any], conn) -> Dict[str, Any]:
     """Получение списка утверждающих"""
     cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -337,7 +443,9 @@ def handler(event: dict, context) -> dict:
     
     Endpoints:
     - GET /approvals - список платежей на утверждение
+    - GET /approvals?mine=true - платежи из очереди текущего утверждающего
     - POST /approvals - утвердить/отклонить платеж
+    - POST /approvals?endpoint=bulk - массово утвердить/отклонить платежи
     - GET /approvers - список всех утверждающих
     """
     method = event.get('httpMethod', 'GET')
@@ -367,6 +475,14 @@ def handler(event: dict, context) -> dict:
                 return handle_approvers_list(event, conn)
             return response(405, {'error': 'Method not allowed'})
         
+        elif endpoint == 'bulk':
+            if method == 'POST':
+                payload, error = verify_token_and_permission(event, conn, 'payments.update')
+                if error:
+                    return error
+                return handle_bulk_approval_action(event, conn, payload['user_id'])
+            return response(405, {'error': 'Method not allowed'})
+        
         else:
             payload, error = verify_token_and_permission(event, conn, 'approvals.read' if method == 'GET' else 'payments.update')
             if error:
@@ -380,7 +496,8 @@ def handler(event: dict, context) -> dict:
                 if query_params.get('history') == 'true' and query_params.get('payment_id'):
                     payment_id = int(query_params.get('payment_id'))
                     return handle_payment_history(event, conn, payment_id)
-                return handle_approvals_list(event, conn, user_id)
+                mine = query_params.get('mine') == 'true'
+                return handle_approvals_list(event, conn, user_id, mine)
             elif method == 'POST' or method == 'PUT':
                 return handle_approval_action(event, conn, user_id)
             
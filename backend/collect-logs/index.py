@@ -5,6 +5,7 @@ from typing import Dict, Any, List
 from datetime import datetime
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from log_parser import LogParser
 
 TELEMETRY_API = "https://telemetry.poehali.dev"
 
@@ -111,12 +112,13 @@ def save_logs_to_db(conn, source: str, logs: List[str]) -> int:
     """
     filename = f"{source.replace('/', '-')}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.log"
     log_content = '\n'.join(logs)
+    parser = LogParser.for_lines(logs)
     
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         # Создаём файл
         cur.execute(
-            "INSERT INTO log_files (filename, file_size, total_lines, status) VALUES (%s, %s, %s, %s) RETURNING id",
-            (filename, len(log_content), len(logs), 'completed')
+            "INSERT INTO log_files (filename, file_size, total_lines, status, log_format) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+            (filename, len(log_content), len(logs), 'completed', parser.format_name)
         )
         file_id = cur.fetchone()['id']
         conn.commit()
@@ -129,7 +131,7 @@ def save_logs_to_db(conn, source: str, logs: List[str]) -> int:
         if not line.strip():
             continue
         
-        entry = parse_log_line(line, idx)
+        entry = parser.parse_line(line, idx)
         parsed_entries.append((
             file_id,
             entry['line_number'],
@@ -157,49 +159,3 @@ def save_logs_to_db(conn, source: str, logs: List[str]) -> int:
         conn.commit()
     
     return file_id
-
-
-def parse_log_line(line: str, line_number: int) -> Dict[str, Any]:
-    """
-    Парсит строку лога и извлекает timestamp, level, message.
-    """
-    import re
-    from datetime import datetime
-    
-    patterns = [
-        r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z?)\s*\[(\w+)\]\s*(.+)$',
-        r'^(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})\s+(\w+)\s+(.+)$',
-        r'^(\w+\s+\d+\s+\d{2}:\d{2}:\d{2})\s+\S+\s+(\w+):\s*(.+)$',
-    ]
-    
-    timestamp = None
-    level = None
-    message = line
-    
-    for pattern in patterns:
-        match = re.match(pattern, line)
-        if match:
-            groups = match.groups()
-            if len(groups) == 3:
-                try:
-                    ts_str = groups[0]
-                    for fmt in ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S']:
-                        try:
-                            timestamp = datetime.strptime(ts_str, fmt)
-                            break
-                        except:
-                            continue
-                    
-                    level = groups[1].upper()
-                    message = groups[2]
-                    break
-                except:
-                    pass
-    
-    return {
-        'line_number': line_number,
-        'timestamp': timestamp,
-        'level': level,
-        'message': message.strip(),
-        'raw_line': line
-    }
\ No newline at end of file
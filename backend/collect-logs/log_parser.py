@@ -0,0 +1,312 @@
+"""
+Однопроходный парсер строк логов с автоопределением формата.
+
+Формат определяется один раз по первым строкам файла, дальше каждая строка
+проверяется одним заранее скомпилированным шаблоном; остальные шаблоны
+используются только для строк, которые в него не попали.
+
+Одинаковая копия модуля лежит в backend/log-analyzer и backend/collect-logs
+(функции деплоятся отдельно) - изменения нужно вносить в оба файла.
+
+Замер скорости: python log_parser.py [--workers N] [путь_к_логу]
+"""
+import re
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Any, Callable, Iterable, List, NamedTuple, Optional, Tuple
+
+KNOWN_LEVELS = frozenset(('ERROR', 'WARN', 'INFO', 'DEBUG', 'TRACE', 'FATAL'))
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+DETECT_SAMPLE_LINES = 50
+
+Fields = Tuple[Optional[datetime], Optional[str], str]
+
+
+def parse_iso_timestamp(ts: str) -> Optional[datetime]:
+    """
+    Быстрый разбор 'YYYY-MM-DD[T ]HH:MM:SS[.ffffff][Z]' и 'YYYY-MM-DD' срезами строки,
+    без перебора форматов strptime.
+    """
+    try:
+        year, month, day = int(ts[0:4]), int(ts[5:7]), int(ts[8:10])
+        if len(ts) == 10:
+            return datetime(year, month, day)
+        if ts[13:14] != ':' or ts[16:17] != ':':
+            # Несколько пробелов между датой и временем
+            normalized = ' '.join(ts.split())
+            return parse_iso_timestamp(normalized) if normalized != ts else None
+        hour, minute, second = int(ts[11:13]), int(ts[14:16]), int(ts[17:19])
+        microsecond = 0
+        fraction = ts[20:].rstrip('Z') if len(ts) > 19 and ts[19] == '.' else ''
+        if fraction:
+            microsecond = int(fraction[:6].ljust(6, '0'))
+        return datetime(year, month, day, hour, minute, second, microsecond)
+    except ValueError:
+        return None
+
+
+def parse_syslog_timestamp(ts: str) -> Optional[datetime]:
+    """Разбор 'Jan 15 10:30:45' (год 1900, как у strptime с '%b %d %H:%M:%S')"""
+    parts = ts.split()
+    if len(parts) != 3 or parts[0] not in MONTHS:
+        return None
+    try:
+        hour, minute, second = (int(p) for p in parts[2].split(':'))
+        return datetime(1900, MONTHS[parts[0]], int(parts[1]), hour, minute, second)
+    except ValueError:
+        return None
+
+
+class LogFormat(NamedTuple):
+    """Формат строки лога: имя, скомпилированный шаблон и извлечение полей из совпадения"""
+    name: str
+    pattern: 're.Pattern'
+    extract: Callable[['re.Match'], Fields]
+
+
+def _extract_timestamp_first(parse_ts: Callable[[str], Optional[datetime]]) -> Callable[['re.Match'], Fields]:
+    def extract(match: 're.Match') -> Fields:
+        ts, level, message = match.groups()
+        return parse_ts(ts), level.upper(), message
+    return extract
+
+
+def _extract_level_date(match: 're.Match') -> Fields:
+    level, ts, message = match.groups()
+    return parse_iso_timestamp(ts), level.upper(), message
+
+
+def _extract_level_only(match: 're.Match') -> Fields:
+    level, message = match.groups()
+    level = level.upper()
+    if level in KNOWN_LEVELS:
+        return None, level, message
+    return None, None, match.string
+
+
+FORMATS: List[LogFormat] = [
+    # ISO timestamp with level: 2024-01-15T10:30:45.123Z [ERROR] Message
+    LogFormat('iso_bracket',
+              re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z?)\s*\[(\w+)\]\s*(.+)'),
+              _extract_timestamp_first(parse_iso_timestamp)),
+    # Standard format: 2024-01-15 10:30:45 ERROR Message
+    LogFormat('standard',
+              re.compile(r'(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}(?:\.\d+)?)\s+(\w+)\s+(.+)'),
+              _extract_timestamp_first(parse_iso_timestamp)),
+    # Syslog format: Jan 15 10:30:45 hostname ERROR: Message
+    LogFormat('syslog',
+              re.compile(r'(\w+\s+\d+\s+\d{2}:\d{2}:\d{2})\s+\S+\s+(\w+):\s*(.+)'),
+              _extract_timestamp_first(parse_syslog_timestamp)),
+    # Level first: ERROR: 2024-01-15 Message
+    LogFormat('level_date',
+              re.compile(r'(\w+):\s*(\d{4}-\d{2}-\d{2})\s+(.+)'),
+              _extract_level_date),
+    # Just level: ERROR Message
+    LogFormat('level_only',
+              re.compile(r'(\w+)\s+(.+)'),
+              _extract_level_only),
+]
+FORMATS_BY_NAME = {fmt.name: fmt for fmt in FORMATS}
+
+
+def detect_format(sample: Iterable[str]) -> Optional[LogFormat]:
+    """Выбирает формат, которому соответствует больше всего строк из выборки"""
+    hits = {fmt.name: 0 for fmt in FORMATS}
+    checked = 0
+    for line in sample:
+        if not line.strip():
+            continue
+        for fmt in FORMATS:
+            if fmt.pattern.fullmatch(line):
+                hits[fmt.name] += 1
+                break
+        checked += 1
+        if checked >= DETECT_SAMPLE_LINES:
+            break
+    best = max(FORMATS, key=lambda fmt: hits[fmt.name])
+    return best if hits[best.name] else None
+
+
+class LogParser:
+    """Парсер с зафиксированным основным форматом и запасным перебором остальных"""
+
+    def __init__(self, primary: Optional[LogFormat] = None):
+        self.primary = primary
+        self.fallback = [fmt for fmt in FORMATS if fmt is not primary]
+
+    @classmethod
+    def for_lines(cls, sample: Iterable[str]) -> 'LogParser':
+        return cls(detect_format(sample))
+
+    @classmethod
+    def for_format(cls, name: Optional[str]) -> 'LogParser':
+        return cls(FORMATS_BY_NAME.get(name or ''))
+
+    @property
+    def format_name(self) -> Optional[str]:
+        return self.primary.name if self.primary else None
+
+    def parse_fields(self, line: str) -> Fields:
+        primary = self.primary
+        if primary is not None:
+            match = primary.pattern.fullmatch(line)
+            if match:
+                timestamp, level, message = primary.extract(match)
+                if level or timestamp:
+                    return timestamp, level, message
+        for fmt in self.fallback:
+            match = fmt.pattern.fullmatch(line)
+            if match:
+                timestamp, level, message = fmt.extract(match)
+                if level or timestamp:
+                    return timestamp, level, message
+        return None, None, line
+
+    def parse_line(self, line: str, line_number: int) -> Dict[str, Any]:
+        timestamp, level, message = self.parse_fields(line)
+        return {
+            'line_number': line_number,
+            'timestamp': timestamp,
+            'level': level,
+            'message': message.strip(),
+            'raw_line': line
+        }
+
+
+_default_parser = LogParser()
+
+
+def parse_log_line(line: str, line_number: int) -> Dict[str, Any]:
+    """Парсит одну строку без автоопределения формата"""
+    return _default_parser.parse_line(line, line_number)
+
+
+def iter_lines(data: bytes):
+    """Построчно отдаёт строки из буфера без промежуточного списка"""
+    start = 0
+    length = len(data)
+    while start < length:
+        end = data.find(b'\n', start)
+        if end == -1:
+            end = length
+        line = data[start:end]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        yield line.decode('utf-8', errors='replace')
+        start = end + 1
+
+
+def copy_escape(value: Any) -> str:
+    """Экранирует значение для COPY в текстовом формате"""
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def split_blocks(data: bytes, block_size: int) -> List[Tuple[int, int, int]]:
+    """
+    Делит буфер на блоки по границам строк.
+    Возвращает (start, end, число строк до блока) для каждого блока.
+    """
+    blocks = []
+    start = 0
+    lines_before = 0
+    length = len(data)
+    while start < length:
+        end = data.find(b'\n', min(start + block_size, length) - 1)
+        end = length if end == -1 else end + 1
+        blocks.append((start, end, lines_before))
+        lines_before += data.count(b'\n', start, end)
+        start = end
+    return blocks
+
+
+def parse_block(data: bytes, first_line_number: int, file_id: int,
+                format_name: Optional[str]) -> Tuple[str, Dict[str, int]]:
+    """
+    Парсит блок строк и возвращает готовый текст для COPY в log_entries
+    (file_id, line_number, timestamp, level, message, raw_line) и статистику по уровням.
+    Функция уровня модуля - её можно выполнять в пуле процессов.
+    """
+    parser = LogParser.for_format(format_name)
+    out: List[str] = []
+    stats: Dict[str, int] = {}
+    line_number = first_line_number - 1
+    for line in iter_lines(data):
+        line_number += 1
+        if not line.strip():
+            continue
+        timestamp, level, message = parser.parse_fields(line)
+        out.append('\t'.join((
+            str(file_id),
+            str(line_number),
+            copy_escape(timestamp),
+            copy_escape(level),
+            copy_escape(message.strip()),
+            copy_escape(line)
+        )))
+        key = level or 'UNKNOWN'
+        stats[key] = stats.get(key, 0) + 1
+    if out:
+        out.append('')
+    return '\n'.join(out), stats
+
+
+def benchmark(lines: List[str]) -> None:
+    """Печатает скорость разбора в строках в секунду"""
+    for title, parser in (('auto-detected', LogParser.for_lines(lines)), ('no detection', LogParser())):
+        started = time.perf_counter()
+        for idx, line in enumerate(lines, 1):
+            parser.parse_line(line, idx)
+        elapsed = time.perf_counter() - started
+        print(f"{title:>14} [{parser.format_name}]: {len(lines) / elapsed:,.0f} lines/s ({len(lines)} lines, {elapsed:.2f}s)")
+
+
+def benchmark_parallel(lines: List[str], workers: int, block_size: int = 4 * 1024 * 1024) -> None:
+    """Сравнивает разбор блоками в одном процессе и в пуле из workers процессов"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    data = '\n'.join(lines).encode('utf-8')
+    format_name = LogParser.for_lines(lines).format_name
+    blocks = split_blocks(data, block_size)
+    args = [(data[start:end], lines_before + 1, 0, format_name) for start, end, lines_before in blocks]
+
+    started = time.perf_counter()
+    for block_args in args:
+        parse_block(*block_args)
+    serial = time.perf_counter() - started
+    print(f"{'1 process':>14}: {len(lines) / serial:,.0f} lines/s")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(parse_block, *zip(*args[:workers])))  # прогрев пула
+        started = time.perf_counter()
+        list(pool.map(parse_block, *zip(*args)))
+        parallel = time.perf_counter() - started
+    print(f"{f'{workers} processes':>14}: {len(lines) / parallel:,.0f} lines/s (x{serial / parallel:.1f})")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    bench_workers = 0
+    if args[:1] == ['--workers']:
+        bench_workers = int(args[1])
+        args = args[2:]
+    if args:
+        with open(args[0], encoding='utf-8', errors='replace') as f:
+            bench_lines = [line.rstrip('\n') for line in f]
+    else:
+        bench_lines = [
+            f"2024-01-15T10:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d}Z [{('INFO', 'WARN', 'ERROR', 'DEBUG')[i % 4]}] Request {i} handled"
+            for i in range(200000)
+        ]
+    benchmark(bench_lines)
+    if bench_workers:
+        benchmark_parallel(bench_lines, bench_workers)
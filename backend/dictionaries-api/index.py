@@ -1,3 +1,5 @@
+import base64
+import gzip
 import json
 import os
 import sys
@@ -166,9 +168,91 @@ def is_admin_user(conn, user_id: int) -> bool:
     finally:
         cur.close()
 
+SNAPSHOT_QUERIES = {
+    'categories': 'SELECT id, name, icon FROM {schema}.categories ORDER BY name',
+    'legal_entities': 'SELECT id, name, inn, kpp, address, postal_code FROM {schema}.legal_entities WHERE is_active = true ORDER BY name',
+    'contractors': """
+        SELECT id, name, inn, kpp, ogrn, legal_address, actual_address,
+               phone, email, contact_person, bank_name, bank_bik,
+               bank_account, correspondent_account, notes
+        FROM {schema}.contractors WHERE is_active = true ORDER BY name
+    """,
+    'customer_departments': 'SELECT id, name, description FROM {schema}.customer_departments ORDER BY name',
+    'services': """
+        SELECT s.id, s.name, s.description, s.intermediate_approver_id, s.final_approver_id,
+               s.customer_department_id, s.category_id, s.legal_entity_id, s.contractor_id,
+               c.name as category_name, c.icon as category_icon,
+               cd.name as customer_department_name,
+               u1.username as intermediate_approver_name,
+               u2.username as final_approver_name,
+               le.name as legal_entity_name,
+               ct.name as contractor_name
+        FROM {schema}.services s
+        LEFT JOIN {schema}.categories c ON s.category_id = c.id
+        LEFT JOIN {schema}.customer_departments cd ON s.customer_department_id = cd.id
+        LEFT JOIN {schema}.users u1 ON s.intermediate_approver_id = u1.id
+        LEFT JOIN {schema}.users u2 ON s.final_approver_id = u2.id
+        LEFT JOIN {schema}.legal_entities le ON s.legal_entity_id = le.id
+        LEFT JOIN {schema}.contractors ct ON s.contractor_id = ct.id
+        ORDER BY s.name
+    """,
+    'saving_reasons': 'SELECT id, name, icon, is_active FROM {schema}.saving_reasons ORDER BY name',
+    'custom_fields': 'SELECT id, name, field_type, options FROM {schema}.custom_fields ORDER BY name',
+}
+
+# Последний собранный снапшот справочников: версия, JSON и gzip-версия тела
+_snapshot_cache: Dict[str, Any] = {'version': None, 'body': None, 'gzip_body': None}
+
+def get_header(event: Dict[str, Any], name: str) -> str:
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value or ''
+    return ''
+
+def get_dictionary_version(cur) -> int:
+    cur.execute(f'SELECT version FROM {SCHEMA}.dictionary_version WHERE id = 1')
+    row = cur.fetchone()
+    return row['version'] if row else 0
+
+def snapshot_response(event: Dict[str, Any], cur) -> Dict[str, Any]:
+    """Все справочники одним ответом с ETag по глобальной версии; 304 если версия не изменилась"""
+    version = get_dictionary_version(cur)
+    etag = f'"dict-{version}"'
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'private, no-cache',
+        'ETag': etag
+    }
+    
+    if etag in [tag.strip() for tag in get_header(event, 'If-None-Match').split(',')]:
+        return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    
+    if _snapshot_cache['version'] != version:
+        snapshot = {'version': version}
+        for name, query in SNAPSHOT_QUERIES.items():
+            cur.execute(query.format(schema=SCHEMA))
+            snapshot[name] = [dict(row) for row in cur.fetchall()]
+        body = json.dumps(snapshot, ensure_ascii=False, default=str)
+        _snapshot_cache.update(version=version, body=body, gzip_body=gzip.compress(body.encode('utf-8')))
+    
+    if 'gzip' in get_header(event, 'Accept-Encoding'):
+        headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': base64.b64encode(_snapshot_cache['gzip_body']).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    
+    return {'statusCode': 200, 'headers': headers, 'body': _snapshot_cache['body'], 'isBase64Encoded': False}
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     API для управления справочниками: категории, юрлица, контрагенты, подразделения, сервисы, кастомные поля.
+    endpoint=snapshot отдаёт все справочники одним версионированным ответом (ETag / If-None-Match).
     '''
     method = event.get('httpMethod', 'GET')
     endpoint = event.get('queryStringParameters', {}).get('endpoint', '')
@@ -179,7 +263,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Authorization, X-Auth-Token, X-User-Id, X-Session-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Authorization, X-Auth-Token, X-User-Id, X-Session-Id, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -201,6 +285,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         is_admin = is_admin_user(conn, user_id)
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
+        # Snapshot of all dictionaries
+        if endpoint == 'snapshot':
+            if method != 'GET':
+                conn.close()
+                return response(405, {'error': 'Method not allowed'})
+            if not is_admin and not check_user_permission(conn, user_id, 'payments.read'):
+                conn.close()
+                return response(403, {'error': 'Forbidden'})
+            
+            result = snapshot_response(event, cur)
+            cur.close()
+            conn.close()
+            return result
+        
         # Categories
         if endpoint == 'categories':
             if method == 'GET':
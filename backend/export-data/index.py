@@ -1,8 +1,32 @@
+import gzip
+import io
+import json
 import os
+import secrets
+import shutil
+import tempfile
 import psycopg2
-from datetime import datetime, date, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, time, timedelta, timezone
 from decimal import Decimal
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, TextIO, Tuple
+
+
+# Rows fetched per round trip by the server-side cursors
+EXPORT_ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', '2000'))
+EXPORT_S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+# The default bucket is served publicly by the CDN: dumps go under a random,
+# unguessable prefix there and are deleted once their link has expired.
+# Point EXPORT_S3_BUCKET at a private bucket where one is available.
+EXPORT_S3_BUCKET = os.environ.get('EXPORT_S3_BUCKET', 'files')
+EXPORT_PREFIX = 'exports/'
+EXPORT_URL_TTL = int(os.environ.get('EXPORT_URL_TTL', '3600'))
+# Parallel connections for per-table export under one exported snapshot (output=url;
+# the text response stays on a single connection unless workers= is passed)
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', '4'))
+WATERMARK_NAME = 'export-data'
+# Columns used to find rows changed since the last export
+CHANGE_COLUMNS = ('updated_at', 'created_at')
 
 
 TABLES = [
@@ -49,7 +73,6 @@ def format_value(val, col_type: str = '') -> str:
 
     if isinstance(val, dict):
         # JSON / JSONB — output as a quoted JSON string cast
-        import json
         json_str = json.dumps(val, ensure_ascii=False, default=str)
         escaped = json_str.replace("'", "''")
         return f"'{escaped}'::jsonb"
@@ -69,8 +92,315 @@ def format_value(val, col_type: str = '') -> str:
     return f"'{escaped}'"
 
 
+def get_columns(cur, schema: str) -> Dict[str, List[str]]:
+    """Column names of all exported tables, loaded with a single catalog query."""
+    cur.execute(
+        "SELECT table_name, column_name "
+        "FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = ANY(%s) "
+        "ORDER BY table_name, ordinal_position",
+        (schema, TABLES),
+    )
+    columns: Dict[str, List[str]] = {}
+    for table_name, column_name in cur.fetchall():
+        columns.setdefault(table_name, []).append(column_name)
+    return columns
+
+
+def change_condition(col_names: List[str]) -> Optional[str]:
+    """WHERE clause selecting rows changed since the watermark, or None if the table has no timestamps."""
+    present = [c for c in CHANGE_COLUMNS if c in col_names]
+    if not present:
+        return None
+    return f"GREATEST({', '.join(present)}) > %(since)s"
+
+
+def write_table(conn, table: str, col_names: List[str], out: TextIO, fmt: str,
+                since: Optional[datetime] = None) -> int:
+    """
+    Write data for one table to out. Returns the number of rows written.
+    A full export truncates the table first; an incremental one (since is set)
+    upserts only the rows changed after since.
+    """
+    col_list = ', '.join(col_names)
+    where = ''
+    suffix = ''
+
+    out.write("-- =============================================\n")
+    out.write(f"-- Table: {table}\n")
+    out.write("-- =============================================\n")
+
+    if since is None:
+        out.write(f"TRUNCATE {table} CASCADE;\n\n")
+    else:
+        # Upserts need INSERT statements even when format=copy was requested
+        fmt = 'insert'
+        condition = change_condition(col_names)
+        if condition:
+            where = f" WHERE {condition}"
+        else:
+            out.write(f"-- {table} has no created_at/updated_at, exporting all rows\n")
+        if 'id' in col_names:
+            updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in col_names if c != 'id')
+            suffix = f" ON CONFLICT (id) DO UPDATE SET {updates}" if updates else " ON CONFLICT (id) DO NOTHING"
+        else:
+            suffix = " ON CONFLICT DO NOTHING"
+
+    if fmt == 'copy':
+        # The server renders rows in COPY text format, we only pipe them through
+        counter = CountingWriter(out)
+        out.write(f"COPY {table} ({col_list}) FROM stdin;\n")
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY (SELECT {col_list} FROM {table} ORDER BY 1) TO STDOUT", counter)
+        out.write("\\.\n\n")
+        row_count = counter.lines
+    else:
+        row_count = 0
+        # Named (server-side) cursor streams rows instead of fetchall()
+        with conn.cursor(name=f'export_{table}') as cur:
+            cur.itersize = EXPORT_ITERSIZE
+            cur.execute(f'SELECT {col_list} FROM {table}{where} ORDER BY 1', {'since': since})
+            for row in cur:
+                values_str = ', '.join(format_value(val) for val in row)
+                out.write(f"INSERT INTO {table} ({col_list}) VALUES ({values_str}){suffix};\n")
+                row_count += 1
+        out.write("\n")
+
+    if row_count:
+        # Reset sequence if there is an 'id' column
+        if 'id' in col_names:
+            seq_name = f"{table}_id_seq"
+            out.write(
+                f"SELECT setval('{seq_name}', "
+                f"(SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false);\n"
+            )
+    else:
+        out.write(f"-- No data in {table}\n")
+
+    out.write("\n")
+    return row_count
+
+
+class CountingWriter:
+    """File-like wrapper that counts lines passing through copy_expert."""
+
+    def __init__(self, out: TextIO):
+        self.out = out
+        self.lines = 0
+
+    def write(self, data) -> None:
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        self.lines += data.count('\n')
+        self.out.write(data)
+
+
+def begin_snapshot(conn) -> datetime:
+    """
+    Start the REPEATABLE READ read-only transaction the dump is taken from.
+    Returns the watermark for the next incremental export: the snapshot time,
+    moved back to the start of any transaction still running, so rows it
+    commits later are picked up next time.
+    """
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT LEAST(now(), COALESCE(("
+            "  SELECT MIN(xact_start) FROM pg_stat_activity "
+            "  WHERE backend_xid IS NOT NULL AND pid <> pg_backend_pid()"
+            "), now()))::timestamp"
+        )
+        return cur.fetchone()[0]
+
+
+def dump_table_in_snapshot(database_url: str, schema: str, snapshot_id: str, table: str,
+                           col_names: List[str], fmt: str, since: Optional[datetime]) -> Tuple[TextIO, int]:
+    """Dump one table on its own connection that shares the exported snapshot. Returns a rewound temp file."""
+    conn = psycopg2.connect(database_url)
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+            cur.execute(f"SET search_path TO {schema}")
+        part = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        row_count = write_table(conn, table, col_names, part, fmt, since)
+        conn.rollback()
+        part.seek(0)
+        return part, row_count
+    finally:
+        conn.close()
+
+
+def write_dump(conn, schema: str, out: TextIO, fmt: str, since: Optional[datetime] = None,
+               workers: int = 1, database_url: Optional[str] = None) -> Dict[str, int]:
+    """
+    Stream the whole dump to out. Returns row counts per table.
+    conn must be inside the transaction opened by begin_snapshot(); with workers > 1
+    the snapshot is exported and tables are dumped in parallel on separate connections.
+    """
+    with conn.cursor() as cur:
+        # Set search path to the project schema
+        cur.execute(f"SET search_path TO {schema}")
+        columns = get_columns(cur, schema)
+        snapshot_id = None
+        if workers > 1:
+            cur.execute("SELECT pg_export_snapshot()")
+            snapshot_id = cur.fetchone()[0]
+
+    out.write(f"-- Export from schema: {schema}\n")
+    out.write(f"-- Generated at: {datetime.utcnow().isoformat()}Z\n")
+    if since is not None:
+        out.write(f"-- Incremental: rows changed after {since.isoformat()}\n")
+    out.write(f"SET search_path TO {schema};\n\n")
+    out.write("BEGIN;\n\n")
+
+    row_counts: Dict[str, int] = {}
+    existing = [table for table in TABLES if table in columns]
+
+    if snapshot_id:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                table: pool.submit(dump_table_in_snapshot, database_url, schema, snapshot_id,
+                                   table, columns[table], fmt, since)
+                for table in existing
+            }
+            parts = {}
+            for table in TABLES:
+                if table not in futures:
+                    continue
+                # Results are collected in TABLES order, so the dump layout is stable
+                parts[table] = futures[table].result()
+
+    for table in TABLES:
+        if table not in columns:
+            out.write(f"-- Table {table} does not exist, skipping\n\n")
+            continue
+        if snapshot_id:
+            part, row_counts[table] = parts[table]
+            with part:
+                shutil.copyfileobj(part, out)
+        else:
+            row_counts[table] = write_table(conn, table, columns[table], out, fmt, since)
+
+    out.write("COMMIT;\n")
+    return row_counts
+
+
+def get_watermark(conn, schema: str) -> Optional[datetime]:
+    """Snapshot time of the last successful export."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT exported_at FROM {schema}.export_watermarks WHERE name = %s", (WATERMARK_NAME,))
+        row = cur.fetchone()
+    conn.rollback()
+    return row[0] if row else None
+
+
+def save_watermark(conn, schema: str, watermark: datetime) -> None:
+    """Remember the snapshot time of a finished export. conn must not be in a transaction."""
+    conn.set_session(isolation_level='READ COMMITTED', readonly=False)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"INSERT INTO {schema}.export_watermarks (name, exported_at) VALUES (%s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET exported_at = EXCLUDED.exported_at, updated_at = CURRENT_TIMESTAMP",
+                (WATERMARK_NAME, watermark),
+            )
+        conn.commit()
+    except psycopg2.Error as e:
+        # The dump itself is complete; a missing watermark only disables the next incremental run
+        conn.rollback()
+        print(f"[EXPORT] Could not save watermark: {e}")
+
+
+def is_admin(conn, schema: str, user_id: Optional[str]) -> bool:
+    """True if the X-User-Id header belongs to a shop administrator."""
+    if not user_id or not str(user_id).isdigit():
+        return False
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT is_admin FROM {schema}.users WHERE id = %s", (int(user_id),))
+        row = cur.fetchone()
+    conn.rollback()
+    return bool(row and row[0])
+
+
+def delete_expired_exports(s3) -> int:
+    """Delete uploaded dumps whose download links have expired."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=EXPORT_URL_TTL)
+    expired = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=EXPORT_S3_BUCKET, Prefix=EXPORT_PREFIX):
+        expired.extend({'Key': obj['Key']} for obj in page.get('Contents', []) if obj['LastModified'] < cutoff)
+    for offset in range(0, len(expired), 1000):
+        s3.delete_objects(Bucket=EXPORT_S3_BUCKET, Delete={'Objects': expired[offset:offset + 1000], 'Quiet': True})
+    return len(expired)
+
+
+def upload_dump(conn, schema: str, fmt: str, **dump_options) -> Dict[str, Any]:
+    """
+    Write a gzip-compressed dump to a temp file, upload it to object storage and return a download URL.
+    The key carries a random token so it cannot be guessed from the CDN URL scheme;
+    dumps older than EXPORT_URL_TTL are removed on every upload.
+    """
+    import boto3
+
+    s3 = boto3.client(
+        's3',
+        endpoint_url=EXPORT_S3_ENDPOINT_URL,
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    )
+    try:
+        delete_expired_exports(s3)
+    except Exception as e:
+        print(f"[EXPORT] Could not delete expired exports: {e}")
+
+    kind = 'incremental' if dump_options.get('since') else 'export'
+    key = f"{EXPORT_PREFIX}{secrets.token_urlsafe(32)}/{kind}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.sql.gz"
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=EXPORT_URL_TTL)
+
+    with tempfile.NamedTemporaryFile(suffix='.sql.gz') as tmp:
+        with gzip.open(tmp, 'wt', encoding='utf-8') as out:
+            row_counts = write_dump(conn, schema, out, fmt, **dump_options)
+        tmp.flush()
+        size = tmp.tell()
+        # upload_file streams the file in multipart chunks
+        s3.upload_file(tmp.name, EXPORT_S3_BUCKET, key,
+                       ExtraArgs={'ContentType': 'application/gzip', 'CacheControl': 'private, no-store',
+                                  'Expires': expires_at})
+
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': EXPORT_S3_BUCKET, 'Key': key},
+        ExpiresIn=EXPORT_URL_TTL,
+    )
+    return {
+        'url': url,
+        'size': size,
+        'expires_in': EXPORT_URL_TTL,
+        'format': fmt,
+        'tables': row_counts,
+        'total_rows': sum(row_counts.values()),
+    }
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    """Export all database tables as SQL INSERT statements."""
+    """
+    Export all database tables as SQL.
+
+    Query parameters:
+    - format=insert|copy  INSERT statements (default) or COPY ... FROM stdin blocks
+    - output=text|url     dump in the response body (default) or a gzip file
+                          in object storage with a presigned download URL
+                          (admins only, X-User-Id; the file is deleted after the link expires)
+    - mode=incremental    only rows changed since the last export watermark
+                          (or since=<ISO timestamp>), written as upserts
+    - baseline=true       full export that becomes the new incremental watermark
+    - workers=N           tables dumped in parallel under one exported snapshot
+                          (default 1, EXPORT_WORKERS for output=url)
+
+    The watermark only advances after mode=incremental without since, or after baseline=true.
+    Incremental exports only carry inserted and updated rows: deleted rows leave no trace
+    in created_at/updated_at, so deletions reach the target only with a new full export.
+    """
 
     method = event.get('httpMethod', 'GET')
 
@@ -88,109 +418,113 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False,
         }
 
+    params = event.get('queryStringParameters') or {}
+    # format=copy emits COPY ... FROM stdin blocks instead of row-by-row INSERTs
+    fmt = 'copy' if params.get('format') == 'copy' else 'insert'
+    # output=url uploads a gzip dump to object storage and returns a download link
+    output = params.get('output', 'text')
+    incremental = params.get('mode') == 'incremental'
+    # Only scheduled runs move the shared watermark: an incremental export from the last
+    # watermark, or a full export explicitly requested as the new baseline
+    advance_watermark = (incremental and not params.get('since')) or (
+        not incremental and params.get('baseline') == 'true')
+
+    try:
+        workers = max(1, int(params.get('workers', EXPORT_WORKERS if output == 'url' else 1)))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'text/plain',
+                'Access-Control-Allow-Origin': '*',
+            },
+            'body': '-- ERROR: workers must be an integer',
+            'isBase64Encoded': False,
+        }
+
     database_url = os.environ['DATABASE_URL']
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
 
     conn = None
     try:
         conn = psycopg2.connect(database_url)
-        cur = conn.cursor()
-
-        # Set search path to the project schema
-        cur.execute(f"SET search_path TO {schema}")
-
-        lines: List[str] = []
-        lines.append(f"-- Export from schema: {schema}")
-        lines.append(f"-- Generated at: {datetime.utcnow().isoformat()}Z")
-        lines.append(f"SET search_path TO {schema};")
-        lines.append("")
-        lines.append("BEGIN;")
-        lines.append("")
-
-        for table in TABLES:
-            # Check if table exists
-            cur.execute(
-                "SELECT EXISTS ("
-                "  SELECT 1 FROM information_schema.tables "
-                "  WHERE table_schema = %s AND table_name = %s"
-                ")",
-                (schema, table),
-            )
-            exists = cur.fetchone()[0]
-            if not exists:
-                lines.append(f"-- Table {table} does not exist, skipping")
-                lines.append("")
-                continue
-
-            lines.append(f"-- =============================================")
-            lines.append(f"-- Table: {table}")
-            lines.append(f"-- =============================================")
-
-            # TRUNCATE before inserts
-            lines.append(f"TRUNCATE {table} CASCADE;")
-            lines.append("")
 
-            # Get column names and types
-            cur.execute(
-                "SELECT column_name, data_type "
-                "FROM information_schema.columns "
-                "WHERE table_schema = %s AND table_name = %s "
-                "ORDER BY ordinal_position",
-                (schema, table),
-            )
-            columns_info = cur.fetchall()
-            if not columns_info:
-                lines.append(f"-- No columns found for {table}")
-                lines.append("")
-                continue
-
-            col_names = [c[0] for c in columns_info]
-            col_types = [c[1] for c in columns_info]
-            col_list = ', '.join(col_names)
-
-            # Fetch all rows
-            cur.execute(f'SELECT * FROM {table} ORDER BY 1')
-            rows = cur.fetchall()
-
-            if rows:
-                for row in rows:
-                    values = []
-                    for i, val in enumerate(row):
-                        ct = col_types[i] if i < len(col_types) else ''
-                        values.append(format_value(val, ct))
-                    values_str = ', '.join(values)
-                    lines.append(f"INSERT INTO {table} ({col_list}) VALUES ({values_str});")
-
-                lines.append("")
-
-                # Reset sequence if there is an 'id' column
-                if 'id' in col_names:
-                    seq_name = f"{table}_id_seq"
-                    lines.append(
-                        f"SELECT setval('{seq_name}', "
-                        f"(SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false);"
-                    )
+        since = None
+        if incremental:
+            if params.get('since'):
+                try:
+                    since = datetime.fromisoformat(params['since'])
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {
+                            'Content-Type': 'text/plain',
+                            'Access-Control-Allow-Origin': '*',
+                        },
+                        'body': '-- ERROR: since must be an ISO timestamp',
+                        'isBase64Encoded': False,
+                    }
             else:
-                lines.append(f"-- No data in {table}")
-
-            lines.append("")
-
-        lines.append("COMMIT;")
-        lines.append("")
-
-        sql_text = '\n'.join(lines)
-
-        cur.close()
-        conn.close()
-        conn = None
+                since = get_watermark(conn, schema)
+                if since is None:
+                    return {
+                        'statusCode': 400,
+                        'headers': {
+                            'Content-Type': 'text/plain',
+                            'Access-Control-Allow-Origin': '*',
+                        },
+                        'body': '-- ERROR: no previous export watermark, pass since=<ISO timestamp> or run a full export with baseline=true',
+                        'isBase64Encoded': False,
+                    }
+
+        if output == 'url':
+            headers = event.get('headers') or {}
+            user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+            if not is_admin(conn, schema, user_id):
+                return {
+                    'statusCode': 403,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                    },
+                    'body': json.dumps({'error': 'Admin access required'}),
+                    'isBase64Encoded': False,
+                }
+
+        # One REPEATABLE READ snapshot for all tables; server-side cursors need the transaction anyway
+        watermark = begin_snapshot(conn)
+        dump_options = {'since': since, 'workers': workers, 'database_url': database_url}
+
+        if output == 'url':
+            result = upload_dump(conn, schema, fmt, **dump_options)
+            conn.rollback()
+            if advance_watermark:
+                save_watermark(conn, schema, watermark)
+            result['watermark'] = watermark.isoformat()
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*',
+                },
+                'body': json.dumps(result),
+                'isBase64Encoded': False,
+            }
+
+        out = io.StringIO()
+        write_dump(conn, schema, out, fmt, **dump_options)
+        conn.rollback()
+        if advance_watermark:
+            save_watermark(conn, schema, watermark)
 
         return {
             'statusCode': 200,
             'headers': {
                 'Content-Type': 'text/plain',
                 'Access-Control-Allow-Origin': '*',
+                'X-Export-Watermark': watermark.isoformat(),
             },
-            'body': sql_text,
+            'body': out.getvalue(),
             'isBase64Encoded': False,
         }
 
@@ -1,18 +1,127 @@
 import json
 import os
+import re
 import base64
+import threading
+import time
+import uuid
 import boto3
 import requests
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 SCHEMA = os.environ.get('MAIN_DB_SCHEMA', 't_p61788166_html_to_frontend')
 HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
 
 
+YANDEX_GPT_URL = os.environ.get('YANDEX_GPT_URL', 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion')
+YANDEX_VISION_URL = os.environ.get('YANDEX_VISION_URL', 'https://vision.api.cloud.yandex.net/vision/v1/batchAnalyze')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+OCR_MAX_WORKERS = int(os.environ.get('OCR_MAX_WORKERS', '4'))
+OCR_BATCH_MAX_FILES = int(os.environ.get('OCR_BATCH_MAX_FILES', '50'))
+
+
+class RateLimiter:
+    """Ограничивает частоту запросов к Yandex API общим для всех потоков интервалом"""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+LEGAL_FORMS = ('ооо', 'оао', 'зао', 'пао', 'ао', 'ип', 'нко', 'ано', 'фгуп', 'гуп', 'муп')
+NAME_MATCH_THRESHOLD = float(os.environ.get('NAME_MATCH_THRESHOLD', '0.55'))
+
+
+def normalize_name(name: str) -> str:
+    words = re.sub(r'[^\w\s]', ' ', (name or '').lower().replace('ё', 'е')).split()
+    return ' '.join(w for w in words if w not in LEGAL_FORMS)
+
+
+def name_trigrams(name: str) -> set:
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CounterpartyIndex:
+    """Хэш-индексы контрагентов/юрлиц по id, ИНН, ИНН+КПП и триграммный индекс нормализованных названий"""
+
+    def __init__(self, items: list):
+        self.by_id = {}
+        self.by_inn = {}
+        self.by_inn_kpp = {}
+        self.trigrams = {}
+        self.name_sizes = {}
+        for item in items:
+            self.by_id[item['id']] = item
+            inn = (item.get('inn') or '').strip()
+            if inn:
+                self.by_inn.setdefault(inn, item)
+                kpp = (item.get('kpp') or '').strip()
+                if kpp:
+                    self.by_inn_kpp.setdefault((inn, kpp), item)
+            grams = name_trigrams(normalize_name(item.get('name')))
+            self.name_sizes[item['id']] = len(grams)
+            for gram in grams:
+                self.trigrams.setdefault(gram, []).append(item['id'])
+
+    def match(self, candidate: dict) -> tuple:
+        """
+        Возвращает (id, confidence, method) или (None, 0.0, None).
+        ИНН из документа решающий: если он указан, но не найден, id и название не сопоставляются -
+        иначе счёт привязался бы к контрагенту, чей ИНН противоречит документу
+        """
+        cand_id = candidate.get('id')
+        inn = str(candidate.get('inn') or '').strip()
+        kpp = str(candidate.get('kpp') or '').strip()
+
+        if inn:
+            if kpp and (inn, kpp) in self.by_inn_kpp:
+                return self.by_inn_kpp[(inn, kpp)]['id'], 1.0, 'inn_kpp'
+            if inn in self.by_inn:
+                return self.by_inn[inn]['id'], 0.98, 'inn'
+            return None, 0.0, None
+        if cand_id in self.by_id:
+            return cand_id, 0.9, 'id'
+        return self.match_name(candidate.get('name'))
+
+    def match_name(self, name: str) -> tuple:
+        grams = name_trigrams(normalize_name(name))
+        if not grams or not name:
+            return None, 0.0, None
+        overlap = {}
+        for gram in grams:
+            for item_id in self.trigrams.get(gram, ()):
+                overlap[item_id] = overlap.get(item_id, 0) + 1
+        best_id, best_score = None, 0.0
+        for item_id, common in overlap.items():
+            score = common / (len(grams) + self.name_sizes[item_id] - common)
+            if score > best_score:
+                best_id, best_score = item_id, score
+        if best_score < NAME_MATCH_THRESHOLD:
+            return None, round(best_score, 3), None
+        return best_id, round(best_score, 3), 'name'
+
+
+_rate_limiter = RateLimiter(float(os.environ.get('YANDEX_API_RPS', '5')))
+_ref_cache = {'version': None, 'data': None}
+_s3_client = None
+
+
 def handler(event: dict, context) -> dict:
-    """Обработка финансовых документов: загрузка → Yandex GPT → сохранение в БД"""
+    """Обработка финансовых документов: загрузка → Yandex GPT → сохранение в БД.
+    POST с полем files запускает пакетную обработку, GET ?job_id= возвращает её статус."""
 
     method = event.get('httpMethod', 'POST')
 
@@ -21,7 +130,7 @@ def handler(event: dict, context) -> dict:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Authorization, X-Auth-Token, X-User-Id, X-Session-Id',
                 'Access-Control-Max-Age': '86400'
             },
@@ -29,17 +138,53 @@ def handler(event: dict, context) -> dict:
             'isBase64Encoded': False
         }
 
+    if method == 'GET':
+        job_id = (event.get('queryStringParameters') or {}).get('job_id')
+        if not job_id:
+            return resp(400, {'error': 'job_id is required'})
+        try:
+            job = get_job(str(uuid.UUID(job_id)))
+        except ValueError:
+            return resp(400, {'error': 'Invalid job_id'})
+        if not job:
+            return resp(404, {'error': 'Job not found'})
+        return resp(200, job)
+
     if method != 'POST':
         return resp(405, {'error': 'Method not allowed'})
 
     body = json.loads(event.get('body', '{}') or '{}')
+    files = body.get('files')
     file_data = body.get('file')
     file_name = body.get('fileName', 'invoice.jpg')
     user_id = body.get('user_id')
 
-    if not file_data:
+    if files is not None:
+        if not isinstance(files, list) or not files:
+            return resp(400, {'error': 'files must be a non-empty list'})
+        if len(files) > OCR_BATCH_MAX_FILES:
+            return resp(400, {'error': f'Не более {OCR_BATCH_MAX_FILES} файлов за один запрос'})
+        if any(not isinstance(f, dict) or not f.get('file') for f in files):
+            return resp(400, {'error': 'File data is required for every item'})
+    elif not file_data:
         return resp(400, {'error': 'File data is required'})
 
+    api_key, folder_id, error = resolve_credentials()
+    if error:
+        return resp(500, {'error': error})
+
+    if files is not None:
+        job_id, public_id = create_job(user_id, len(files))
+        if body.get('wait'):
+            run_job(job_id, files, user_id, api_key, folder_id)
+            return resp(200, get_job(public_id))
+        threading.Thread(target=run_job, args=(job_id, files, user_id, api_key, folder_id)).start()
+        return resp(202, {'job_id': public_id, 'status': 'queued', 'total': len(files)})
+
+    return resp(200, process_invoice(file_data, file_name, user_id, api_key, folder_id, load_reference_data()))
+
+
+def resolve_credentials() -> tuple:
     all_candidates = [
         os.environ.get('YANDEX_GPT_API_KEY', ''),
         os.environ.get('API_KEY', ''),
@@ -61,15 +206,28 @@ def handler(event: dict, context) -> dict:
                 folder_id = val
 
     if not api_key:
-        return resp(500, {
-            'error': 'Отсутствует API-ключ Yandex GPT. Необходимо сохранить ключ в переменной окружения с именем: YANDEX_GPT_API_KEY'
-        })
+        return '', '', 'Отсутствует API-ключ Yandex GPT. Необходимо сохранить ключ в переменной окружения с именем: YANDEX_GPT_API_KEY'
 
     if not folder_id:
         folder_id = resolve_folder_id(api_key)
     if not folder_id:
-        return resp(500, {'error': 'Не удалось определить FOLDER_ID для Yandex GPT'})
+        return api_key, '', 'Не удалось определить FOLDER_ID для Yandex GPT'
+
+    return api_key, folder_id, None
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3',
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    return _s3_client
 
+
+def process_invoice(file_data: str, file_name: str, user_id, api_key: str, folder_id: str, ref_data: dict) -> dict:
     # ===== ШАГ 1: Загрузка файла на сервер =====
     print(f"[STEP 1] Загрузка файла: {file_name}, user_id: {user_id}")
 
@@ -77,17 +235,11 @@ def handler(event: dict, context) -> dict:
         file_data = file_data.split(',')[1]
     file_bytes = base64.b64decode(file_data)
 
-    s3 = boto3.client('s3',
-        endpoint_url='https://bucket.poehali.dev',
-        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
-    )
-
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    s3_key = f'invoices/{timestamp}_{file_name}'
+    s3_key = f'invoices/{timestamp}_{uuid.uuid4().hex[:8]}_{file_name}'
     content_type = 'application/pdf' if file_name.lower().endswith('.pdf') else 'image/jpeg'
 
-    s3.put_object(Bucket='files', Key=s3_key, Body=file_bytes, ContentType=content_type)
+    get_s3_client().put_object(Bucket='files', Key=s3_key, Body=file_bytes, ContentType=content_type)
     cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{s3_key}"
 
     upload_date = datetime.now().isoformat()
@@ -96,15 +248,37 @@ def handler(event: dict, context) -> dict:
     # ===== ШАГ 2: Отправка в Yandex GPT =====
     print(f"[STEP 2] Отправка в Yandex GPT, folder_id: {folder_id[:8]}...")
 
-    ref_data = load_reference_data()
+    gpt_prompt = build_prompt(ref_data)
+    gpt_result = call_yandex_gpt(api_key, folder_id, gpt_prompt, file_data)
 
-    categories_list = ', '.join([f'id={c["id"]} "{c["name"]}"' for c in ref_data['categories']])
-    services_list = ', '.join([f'id={s["id"]} "{s["name"]}"' for s in ref_data['services']])
-    departments_list = ', '.join([f'id={d["id"]} "{d["name"]}"' for d in ref_data['departments']])
+    if not gpt_result:
+        return {
+            'file_url': cdn_url,
+            'extracted_data': None,
+            'step': 2,
+            'warning': 'Yandex GPT не вернул результат'
+        }
+
+    print(f"[STEP 2] GPT ответ: {json.dumps(gpt_result, ensure_ascii=False)[:500]}")
+
+    # ===== ШАГ 3: Сохранение в БД =====
+    print("[STEP 3] Сохранение данных в БД")
+
+    extracted = map_gpt_to_db(gpt_result, ref_data)
+    print(f"[STEP 3] Mapped data: {json.dumps(extracted, ensure_ascii=False, default=str)}")
+
+    return {
+        'file_url': cdn_url,
+        'extracted_data': extracted,
+        'gpt_raw': gpt_result
+    }
+
+
+def build_prompt(ref_data: dict) -> str:
     legal_entities_list = ', '.join([f'id={le["id"]} "{le["name"]}" ИНН:{le.get("inn","")}'.strip() for le in ref_data['legal_entities']])
     contractors_list = ', '.join([f'id={c["id"]} "{c["name"]}" ИНН:{c.get("inn","")}'.strip() for c in ref_data['contractors']])
 
-    gpt_prompt = f"""Ты — финансовый аналитик. Проанализируй изображение счёта/финансового документа и извлеки данные.
+    return f"""Ты — финансовый аналитик. Проанализируй изображение счёта/финансового документа и извлеки данные.
 
 Верни СТРОГО JSON с ТОЛЬКО этими полями:
 {{
@@ -128,38 +302,83 @@ def handler(event: dict, context) -> dict:
 
 ВАЖНО: Верни ТОЛЬКО JSON без markdown-разметки, без комментариев, без дополнительного текста."""
 
-    gpt_result = call_yandex_gpt(api_key, folder_id, gpt_prompt, file_data)
 
-    if not gpt_result:
-        return resp(200, {
-            'file_url': cdn_url,
-            'extracted_data': None,
-            'step': 2,
-            'warning': 'Yandex GPT не вернул результат'
-        })
+def create_job(user_id, total: int) -> tuple:
+    """Создаёт задание; возвращает (внутренний id, публичный UUID для опроса статуса)"""
+    public_id = str(uuid.uuid4())
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"INSERT INTO {SCHEMA}.invoice_ocr_jobs (user_id, total, public_id) VALUES (%s, %s, %s) RETURNING id",
+            (user_id, total, public_id)
+        )
+        job_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+        return job_id, public_id
+    finally:
+        conn.close()
 
-    print(f"[STEP 2] GPT ответ: {json.dumps(gpt_result, ensure_ascii=False)[:500]}")
 
-    # ===== ШАГ 3: Сохранение в БД =====
-    print("[STEP 3] Сохранение данных в БД")
-
-    extracted = map_gpt_to_db(gpt_result, ref_data)
-    print(f"[STEP 3] Mapped data: {json.dumps(extracted, ensure_ascii=False, default=str)}")
+def get_job(public_id: str) -> dict | None:
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(f"""
+            SELECT public_id::text as job_id, status, total, processed, failed, results, created_at, updated_at
+            FROM {SCHEMA}.invoice_ocr_jobs WHERE public_id = %s
+        """, (public_id,))
+        row = cur.fetchone()
+        cur.close()
+        if not row:
+            return None
+        job = dict(row)
+        job['results'] = sorted(job['results'] or [], key=lambda r: r['index'])
+        return job
+    finally:
+        conn.close()
 
-    return resp(200, {
-        'file_url': cdn_url,
-        'extracted_data': extracted,
-        'gpt_raw': gpt_result
-    })
 
+def run_job(job_id: int, files: list, user_id, api_key: str, folder_id: str):
+    """Параллельная обработка пакета; результат каждого файла сохраняется в задание по мере готовности"""
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    lock = threading.Lock()
+    cur = conn.cursor()
+
+    def save(item: dict, failed: bool):
+        with lock:
+            cur.execute(f"""
+                UPDATE {SCHEMA}.invoice_ocr_jobs
+                SET processed = processed + 1,
+                    failed = failed + %s,
+                    results = results || %s::jsonb,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (1 if failed else 0, json.dumps([item], ensure_ascii=False, default=str), job_id))
+
+    def work(index: int, item: dict):
+        file_name = item.get('fileName', f'invoice_{index + 1}.jpg')
+        try:
+            result = process_invoice(item['file'], file_name, user_id, api_key, folder_id, ref_data)
+            save({'index': index, 'fileName': file_name, **result}, False)
+        except Exception as e:
+            print(f"[BATCH] job={job_id} file={file_name} error: {e}")
+            save({'index': index, 'fileName': file_name, 'error': str(e)}, True)
 
-def resp(status: int, body: dict) -> dict:
-    return {
-        'statusCode': status,
-        'headers': HEADERS,
-        'body': json.dumps(body, ensure_ascii=False, default=str),
-        'isBase64Encoded': False
-    }
+    try:
+        cur.execute(f"UPDATE {SCHEMA}.invoice_ocr_jobs SET status = 'processing', updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+        ref_data = load_reference_data()
+        with ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS) as pool:
+            list(pool.map(work, range(len(files)), files))
+        cur.execute(f"UPDATE {SCHEMA}.invoice_ocr_jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+    except Exception as e:
+        print(f"[BATCH] job={job_id} failed: {e}")
+        cur.execute(f"UPDATE {SCHEMA}.invoice_ocr_jobs SET status = 'failed', updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+    finally:
+        cur.close()
+        conn.close()
 
 
 def resolve_folder_id(api_key: str) -> str:
@@ -197,29 +416,40 @@ def resolve_folder_id(api_key: str) -> str:
 
 
 def load_reference_data() -> dict:
+    """Справочники для сопоставления; перечитываются только при смене dictionary_version"""
     conn = psycopg2.connect(os.environ['DATABASE_URL'])
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    ref = {}
-    queries = {
-        'categories': f'SELECT id, name FROM {SCHEMA}.categories ORDER BY name',
-        'services': f'SELECT id, name, category_id FROM {SCHEMA}.services ORDER BY name',
-        'departments': f'SELECT id, name FROM {SCHEMA}.customer_departments ORDER BY name',
-        'legal_entities': f'SELECT id, name, inn, kpp FROM {SCHEMA}.legal_entities WHERE is_active = true ORDER BY name',
-        'contractors': f'SELECT id, name, inn, kpp FROM {SCHEMA}.contractors ORDER BY name',
-    }
+    try:
+        cur.execute(f'SELECT version FROM {SCHEMA}.dictionary_version WHERE id = 1')
+        row = cur.fetchone()
+        version = row['version'] if row else None
+        if version is not None and _ref_cache['version'] == version:
+            return _ref_cache['data']
+
+        ref = {}
+        queries = {
+            'categories': f'SELECT id, name FROM {SCHEMA}.categories ORDER BY name',
+            'services': f'SELECT id, name, category_id FROM {SCHEMA}.services ORDER BY name',
+            'departments': f'SELECT id, name FROM {SCHEMA}.customer_departments ORDER BY name',
+            'legal_entities': f'SELECT id, name, inn, kpp FROM {SCHEMA}.legal_entities WHERE is_active = true ORDER BY name',
+            'contractors': f'SELECT id, name, inn, kpp FROM {SCHEMA}.contractors ORDER BY name',
+        }
 
-    for key, query in queries.items():
-        cur.execute(query)
-        ref[key] = [dict(row) for row in cur.fetchall()]
+        for key, query in queries.items():
+            cur.execute(query)
+            ref[key] = [dict(row) for row in cur.fetchall()]
+        ref['indexes'] = build_indexes(ref)
 
-    cur.close()
-    conn.close()
-    return ref
+        _ref_cache.update(version=version, data=ref)
+        return ref
+    finally:
+        cur.close()
+        conn.close()
 
 
 def call_yandex_gpt(api_key: str, folder_id: str, prompt: str, image_base64: str) -> dict | None:
-    url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
+    url = YANDEX_GPT_URL
 
     headers = {
         'Content-Type': 'application/json',
@@ -246,6 +476,7 @@ def call_yandex_gpt(api_key: str, folder_id: str, prompt: str, image_base64: str
     }
 
     try:
+        _rate_limiter.wait()
         r = requests.post(url, headers=headers, json=payload, timeout=60)
         print(f"[GPT] Status: {r.status_code}")
 
@@ -272,8 +503,9 @@ def call_yandex_gpt(api_key: str, folder_id: str, prompt: str, image_base64: str
 
 
 def run_vision_ocr(image_base64: str, api_key: str, folder_id: str) -> str:
+    _rate_limiter.wait()
     r = requests.post(
-        'https://vision.api.cloud.yandex.net/vision/v1/batchAnalyze',
+        YANDEX_VISION_URL,
         headers={'Authorization': f'Api-Key {api_key}', 'Content-Type': 'application/json'},
         json={
             'folderId': folder_id,
@@ -306,7 +538,7 @@ def run_vision_ocr(image_base64: str, api_key: str, folder_id: str) -> str:
 
 
 def call_gpt_text_only(api_key: str, folder_id: str, original_prompt: str, ocr_text: str) -> dict | None:
-    url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
+    url = YANDEX_GPT_URL
 
     prompt_with_text = original_prompt + f"\n\nТекст документа (распознан через OCR):\n{ocr_text[:4000]}"
 
@@ -326,6 +558,7 @@ def call_gpt_text_only(api_key: str, folder_id: str, original_prompt: str, ocr_t
     }
 
     try:
+        _rate_limiter.wait()
         r = requests.post(url, headers={
             'Content-Type': 'application/json',
             'Authorization': f'Api-Key {api_key}',
@@ -358,7 +591,6 @@ def parse_gpt_json(text: str) -> dict | None:
     try:
         return json.loads(text)
     except json.JSONDecodeError:
-        import re
         match = re.search(r'\{[\s\S]*\}', text)
         if match:
             try:
@@ -369,6 +601,13 @@ def parse_gpt_json(text: str) -> dict | None:
     return None
 
 
+def build_indexes(ref_data: dict) -> dict:
+    return {
+        'contractors': CounterpartyIndex(ref_data['contractors']),
+        'legal_entities': CounterpartyIndex(ref_data['legal_entities']),
+    }
+
+
 def map_gpt_to_db(gpt_data: dict, ref_data: dict) -> dict:
     result = {
         'amount': None,
@@ -384,6 +623,8 @@ def map_gpt_to_db(gpt_data: dict, ref_data: dict) -> dict:
         'contractor_id': None,
         'contractor_name': None,
         'contractor_inn': None,
+        'contractor_match': None,
+        'legal_entity_match': None,
     }
 
     result['amount'] = gpt_data.get('amount')
@@ -391,35 +632,25 @@ def map_gpt_to_db(gpt_data: dict, ref_data: dict) -> dict:
     result['invoice_date'] = gpt_data.get('invoice_date')
     result['description'] = gpt_data.get('purpose')
 
+    indexes = ref_data.get('indexes') or build_indexes(ref_data)
+
     counterparty = gpt_data.get('counterparty') or {}
     if isinstance(counterparty, dict):
-        cp_id = counterparty.get('id')
-        if cp_id and any(c['id'] == cp_id for c in ref_data['contractors']):
-            result['contractor_id'] = cp_id
-        else:
-            if counterparty.get('inn'):
-                for c in ref_data['contractors']:
-                    if c.get('inn') and c['inn'].strip() == str(counterparty['inn']).strip():
-                        result['contractor_id'] = c['id']
-                        break
-            if not result['contractor_id'] and counterparty.get('name'):
-                result['contractor_name'] = counterparty['name']
-                result['contractor_inn'] = counterparty.get('inn')
+        cp_id, confidence, method = indexes['contractors'].match(counterparty)
+        result['contractor_id'] = cp_id
+        result['contractor_match'] = {'confidence': confidence, 'method': method}
+        if not cp_id and counterparty.get('name'):
+            result['contractor_name'] = counterparty['name']
+            result['contractor_inn'] = counterparty.get('inn')
 
     legal_entity = gpt_data.get('legal_entity') or {}
     if isinstance(legal_entity, dict):
-        le_id = legal_entity.get('id')
-        if le_id and any(le['id'] == le_id for le in ref_data['legal_entities']):
-            result['legal_entity_id'] = le_id
-        else:
-            if legal_entity.get('inn'):
-                for le in ref_data['legal_entities']:
-                    if le.get('inn') and le['inn'].strip() == str(legal_entity['inn']).strip():
-                        result['legal_entity_id'] = le['id']
-                        break
-            if not result['legal_entity_id'] and legal_entity.get('name'):
-                result['legal_entity_name'] = legal_entity['name']
-                result['legal_entity_inn'] = legal_entity.get('inn')
+        le_id, confidence, method = indexes['legal_entities'].match(legal_entity)
+        result['legal_entity_id'] = le_id
+        result['legal_entity_match'] = {'confidence': confidence, 'method': method}
+        if not le_id and legal_entity.get('name'):
+            result['legal_entity_name'] = legal_entity['name']
+            result['legal_entity_inn'] = legal_entity.get('inn')
 
     if result['description']:
         desc_lower = result['description'].lower()
@@ -439,4 +670,12 @@ def map_gpt_to_db(gpt_data: dict, ref_data: dict) -> dict:
             if best_svc.get('category_id'):
                 result['category_id'] = best_svc['category_id']
 
-    return result
\ No newline at end of file
+    return result
+
+def resp(status: int, body: dict) -> dict:
+    return {
+        'statusCode': status,
+        'headers': HEADERS,
+        'body': json.dumps(body, ensure_ascii=False, default=str),
+        'isBase64Encoded': False
+    }
@@ -1,11 +1,28 @@
 import json
 import os
-import re
 import base64
-from datetime import datetime
-from typing import Dict, Any, List, Optional
+import io
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from log_parser import LogParser, iter_lines, parse_block, split_blocks
+
+# Размер блока разбора (и одного COPY) при загрузке
+LOG_PARSE_BLOCK_BYTES = int(os.environ.get('LOG_PARSE_BLOCK_BYTES', str(4 * 1024 * 1024)))
+# Параллельный разбор в пуле процессов для кусков от этого размера. Включается только явным
+# LOG_PARSE_WORKERS > 1: под docker/server.py пул форкал бы многопоточный процесс uvicorn целиком,
+# а на инстансе с одним CPU выигрыша нет (python log_parser.py --workers N)
+LOG_PARSE_WORKERS = int(os.environ.get('LOG_PARSE_WORKERS', '1'))
+LOG_PARALLEL_MIN_BYTES = int(os.environ.get('LOG_PARALLEL_MIN_BYTES', str(8 * 1024 * 1024)))
+_parse_pool: Optional[ProcessPoolExecutor] = None
+SEARCH_PAGE_SIZE = 100
+SEARCH_MAX_PAGE_SIZE = 1000
+# Загрузка без новых кусков дольше этого срока (секунды) считается прерванной
+LOG_UPLOAD_TIMEOUT = int(os.environ.get('LOG_UPLOAD_TIMEOUT', '3600'))
+# Ниже этого порога оценка планировщика уточняется ограниченным COUNT
+EXACT_COUNT_LIMIT = 10000
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -32,81 +49,65 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     try:
         if method == 'POST':
-            # Загрузка и парсинг лог-файла
-            body_data = json.loads(event.get('body', '{}'))
+            # Загрузка и парсинг лог-файла: целиком или частями (file_id + chunk_index + is_last)
+            params = event.get('queryStringParameters') or {}
+            headers = event.get('headers') or {}
             
-            if 'file_content' not in body_data or 'filename' not in body_data:
+            if params.get('action') == 'abort':
+                # Явная отмена загрузки: после неё повтор кусков не принимается
+                if not str(params.get('file_id', '')).isdigit():
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'file_id обязателен'})
+                    }
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        UPDATE log_files SET status = 'failed', error = %s, pending_tail = NULL, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = %s AND status = 'uploading'
+                        RETURNING id, status
+                    """, ('Загрузка отменена', int(params['file_id'])))
+                    aborted = cur.fetchone()
+                conn.commit()
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200 if aborted else 404,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'file_content и filename обязательны'})
+                    'body': json.dumps(dict(aborted) if aborted else {'error': 'Незавершённая загрузка не найдена'})
                 }
+            content_type = (headers.get('Content-Type') or headers.get('content-type') or 'application/json').lower()
             
-            # Декодируем base64 контент
-            file_content = base64.b64decode(body_data['file_content']).decode('utf-8')
-            filename = body_data['filename']
-            
-            # Создаём запись о файле
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    "INSERT INTO log_files (filename, file_size, total_lines, status) VALUES (%s, %s, %s, %s) RETURNING id",
-                    (filename, len(file_content), file_content.count('\n'), 'processing')
-                )
-                file_id = cur.fetchone()['id']
-                conn.commit()
-            
-            # Парсим логи
-            lines = file_content.split('\n')
-            parsed_entries = []
-            stats = {}
+            if content_type.startswith('application/json'):
+                body_data = json.loads(event.get('body') or '{}')
+                if 'file_content' not in body_data or ('filename' not in body_data and not body_data.get('file_id')):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'file_content и filename обязательны'})
+                    }
+                chunk = base64.b64decode(body_data['file_content'])
+            else:
+                # Сырой чанк (application/octet-stream, text/plain), параметры в query string
+                body_data = params
+                raw_body = event.get('body') or ''
+                chunk = base64.b64decode(raw_body) if event.get('isBase64Encoded') else raw_body.encode('utf-8')
+                if 'filename' not in body_data and not body_data.get('file_id'):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'filename или file_id обязательны'})
+                    }
             
-            for idx, line in enumerate(lines, 1):
-                if not line.strip():
-                    continue
-                
-                entry = parse_log_line(line, idx)
-                parsed_entries.append((
-                    file_id,
-                    entry['line_number'],
-                    entry['timestamp'],
-                    entry['level'],
-                    entry['message'],
-                    entry['raw_line']
-                ))
-                
-                # Статистика
-                level = entry['level'] or 'UNKNOWN'
-                stats[level] = stats.get(level, 0) + 1
+            is_last = str(body_data.get('is_last', 'true')).lower() in ('true', '1')
+            file_id = int(body_data['file_id']) if body_data.get('file_id') else None
+            chunk_index = int(body_data.get('chunk_index', 0))
             
-            # Сохраняем записи логов
-            with conn.cursor() as cur:
-                cur.executemany(
-                    "INSERT INTO log_entries (file_id, line_number, timestamp, level, message, raw_line) VALUES (%s, %s, %s, %s, %s, %s)",
-                    parsed_entries
-                )
-                
-                # Сохраняем статистику
-                for level, count in stats.items():
-                    cur.execute(
-                        "INSERT INTO log_statistics (file_id, level, count) VALUES (%s, %s, %s)",
-                        (file_id, level, count)
-                    )
-                
-                # Обновляем статус файла
-                cur.execute(
-                    "UPDATE log_files SET status = %s WHERE id = %s",
-                    ('completed', file_id)
-                )
-                conn.commit()
+            result = ingest_chunk(conn, file_id, body_data.get('filename'), chunk, chunk_index, is_last)
+            status_code = result.pop('status_code', 200)
             
             return {
-                'statusCode': 200,
+                'statusCode': status_code,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'file_id': file_id,
-                    'total_lines': len(parsed_entries),
-                    'statistics': stats
-                })
+                'body': json.dumps(result)
             }
         
         elif method == 'GET':
@@ -116,8 +117,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             if action == 'list':
                 # Список всех файлов
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    fail_stale_uploads(cur)
+                    conn.commit()
                     cur.execute("""
-                        SELECT lf.*, 
+                        SELECT lf.id, lf.filename, lf.file_size, lf.uploaded_at, lf.total_lines,
+                               lf.status, lf.chunks_received, lf.lines_processed, lf.error, lf.log_format,
                                COALESCE(json_agg(
                                    json_build_object('level', ls.level, 'count', ls.count)
                                ) FILTER (WHERE ls.id IS NOT NULL), '[]') as statistics
@@ -184,6 +188,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     }, default=str)
                 }
             
+            elif action == 'search':
+                # Индексный поиск с keyset-пагинацией по (file_id, line_number)
+                try:
+                    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                        result = search_entries(cur, params)
+                except ValueError as e:
+                    # Некорректные cursor, limit или file_id
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': str(e)})
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps(result, default=str)
+                }
+            
             elif action == 'stats':
                 # Статистика по файлу
                 file_id = params.get('file_id')
@@ -211,70 +234,301 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn.close()
 
 
-def parse_log_line(line: str, line_number: int) -> Dict[str, Any]:
+def get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """Пул процессов для разбора, переиспользуется между вызовами; None - если недоступен"""
+    global _parse_pool
+    if _parse_pool is None and LOG_PARSE_WORKERS > 1:
+        try:
+            pool = ProcessPoolExecutor(max_workers=LOG_PARSE_WORKERS)
+            # Процессы стартуют лениво - проверяем, что среда их поддерживает
+            pool.submit(int).result()
+            _parse_pool = pool
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            print(f"[LOG-ANALYZER] Process pool unavailable, parsing serially: {e}")
+            return None
+    return _parse_pool
+
+
+def parse_blocks(data: bytes, first_line_number: int, file_id: int, format_name: Optional[str]):
     """
-    Парсит строку лога и извлекает timestamp, level, message.
-    Поддерживает различные форматы логов.
+    Разбирает буфер блоками и отдаёт (copy_text, stats) в порядке строк.
+    Большие буферы разбираются в пуле процессов.
     """
-    # Паттерны для парсинга
-    patterns = [
-        # ISO timestamp with level: 2024-01-15T10:30:45.123Z [ERROR] Message
-        r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z?)\s*\[(\w+)\]\s*(.+)$',
-        # Standard format: 2024-01-15 10:30:45 ERROR Message
-        r'^(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})\s+(\w+)\s+(.+)$',
-        # Syslog format: Jan 15 10:30:45 hostname ERROR: Message
-        r'^(\w+\s+\d+\s+\d{2}:\d{2}:\d{2})\s+\S+\s+(\w+):\s*(.+)$',
-        # Level first: ERROR: 2024-01-15 Message
-        r'^(\w+):\s*(\d{4}-\d{2}-\d{2})\s+(.+)$',
-        # Just level: ERROR Message
-        r'^(\w+)\s+(.+)$'
-    ]
+    blocks = split_blocks(data, LOG_PARSE_BLOCK_BYTES)
+    pool = get_parse_pool() if len(data) >= LOG_PARALLEL_MIN_BYTES and len(blocks) > 1 else None
     
-    timestamp = None
-    level = None
-    message = line
+    if pool is None:
+        for start, end, lines_before in blocks:
+            yield parse_block(data[start:end], first_line_number + lines_before, file_id, format_name)
+        return
     
-    for pattern in patterns:
-        match = re.match(pattern, line)
-        if match:
-            groups = match.groups()
-            if len(groups) == 3:
-                try:
-                    timestamp = parse_timestamp(groups[0])
-                    level = groups[1].upper()
-                    message = groups[2]
-                except:
-                    pass
-            elif len(groups) == 2:
-                level = groups[0].upper() if groups[0].upper() in ['ERROR', 'WARN', 'INFO', 'DEBUG', 'TRACE', 'FATAL'] else None
-                message = groups[1] if level else line
+    # map сохраняет порядок блоков; одновременно в работе не больше 2 блоков на процесс
+    window = LOG_PARSE_WORKERS * 2
+    for offset in range(0, len(blocks), window):
+        part = blocks[offset:offset + window]
+        yield from pool.map(
+            parse_block,
+            [data[start:end] for start, end, _ in part],
+            [first_line_number + lines_before for _, _, lines_before in part],
+            [file_id] * len(part),
+            [format_name] * len(part)
+        )
+
+
+def fail_stale_uploads(cur) -> None:
+    """Загрузки, по которым куски не приходили дольше LOG_UPLOAD_TIMEOUT, помечаются как failed"""
+    cur.execute("""
+        UPDATE log_files SET status = 'failed', error = %s, pending_tail = NULL
+        WHERE status = 'uploading' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+    """, ('Загрузка прервана по таймауту', LOG_UPLOAD_TIMEOUT))
+
+
+def ingest_chunk(conn, file_id: Optional[int], filename: Optional[str], chunk: bytes,
+                 chunk_index: int, is_last: bool) -> Dict[str, Any]:
+    """
+    Принимает очередной кусок лог-файла и сразу пишет распарсенные строки в log_entries.
+    Незавершённая последняя строка хранится в log_files.pending_tail до следующего куска,
+    прогресс - в log_files.status / chunks_received / lines_processed.
+    Каждый кусок обрабатывается в одной транзакции, поэтому повтор куска безопасен: ошибка
+    записывается в log_files.error, а файл остаётся в статусе uploading. В failed файл
+    переводится только явной отменой (action=abort) или по таймауту LOG_UPLOAD_TIMEOUT.
+    """
+    # Строка нового файла создаётся в транзакции первого куска и при его ошибке откатывается
+    is_new_file = file_id is None
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        if file_id is None:
+            cur.execute(
+                "INSERT INTO log_files (filename, file_size, total_lines, status) VALUES (%s, 0, 0, %s) RETURNING *",
+                (filename, 'uploading')
+            )
+        else:
+            cur.execute("""
+                SELECT *, updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s) AS timed_out
+                FROM log_files WHERE id = %s FOR UPDATE
+            """, (LOG_UPLOAD_TIMEOUT, file_id))
+        log_file = cur.fetchone()
+        
+        if not log_file:
+            conn.rollback()
+            return {'status_code': 404, 'error': 'Файл не найден'}
+        
+        file_id = log_file['id']
+        chunks_received = log_file['chunks_received'] or 0
+        
+        if log_file['status'] == 'uploading' and log_file.get('timed_out'):
+            fail_stale_uploads(cur)
+            conn.commit()
+            return {'status_code': 410, 'error': 'Загрузка прервана по таймауту', 'file_id': file_id}
+        
+        if log_file['status'] != 'uploading' or chunk_index < chunks_received:
+            conn.rollback()
+            return {'file_id': file_id, 'status': log_file['status'], 'chunks_received': chunks_received,
+                    'lines_processed': log_file['lines_processed'], 'duplicate': True}
+        if chunk_index > chunks_received:
+            conn.rollback()
+            return {'status_code': 409, 'error': f'Ожидается кусок {chunks_received}', 'file_id': file_id}
+        
+        data = bytes(log_file['pending_tail'] or b'') + chunk
+        if is_last:
+            tail = b''
+        else:
+            cut = data.rfind(b'\n') + 1
+            data, tail = data[:cut], data[cut:]
+        
+        # Формат определяется по первым строкам файла и запоминается для следующих кусков
+        if log_file['log_format']:
+            parser = LogParser.for_format(log_file['log_format'])
+        else:
+            parser = LogParser.for_lines(iter_lines(data))
+        
+        line_number = log_file['lines_processed'] or 0
+        stats: Dict[str, int] = {}
+        
+        try:
+            for copy_text, block_stats in parse_blocks(data, line_number + 1, file_id, parser.format_name):
+                if copy_text:
+                    cur.copy_expert(
+                        "COPY log_entries (file_id, line_number, timestamp, level, message, raw_line) FROM STDIN",
+                        io.StringIO(copy_text)
+                    )
+                # Статистика блоков складывается без повторного прохода по строкам
+                for level, count in block_stats.items():
+                    stats[level] = stats.get(level, 0) + count
+            
+            line_number += data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
             
-            if level or timestamp:
-                break
+            for level, count in stats.items():
+                cur.execute("""
+                    INSERT INTO log_statistics (file_id, level, count) VALUES (%s, %s, %s)
+                    ON CONFLICT (file_id, level) DO UPDATE SET count = log_statistics.count + EXCLUDED.count
+                """, (file_id, level, count))
+            
+            status = 'completed' if is_last else 'uploading'
+            cur.execute("""
+                UPDATE log_files
+                SET status = %s,
+                    file_size = file_size + %s,
+                    chunks_received = chunks_received + 1,
+                    lines_processed = %s,
+                    total_lines = %s,
+                    pending_tail = %s,
+                    log_format = COALESCE(log_format, %s),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (status, len(chunk), line_number, line_number, psycopg2.Binary(tail) if tail else None,
+                  parser.format_name, file_id))
+            conn.commit()
+        except Exception as e:
+            # Кусок откатывается целиком; файл остаётся uploading, клиент повторяет тот же chunk_index
+            conn.rollback()
+            print(f"[LOG-ANALYZER] Chunk {chunk_index} of file {file_id} failed: {e}")
+            if not is_new_file:
+                cur.execute(
+                    "UPDATE log_files SET error = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (str(e), file_id)
+                )
+                conn.commit()
+            return {
+                'status_code': 500,
+                'error': f'Не удалось обработать кусок {chunk_index}: {e}',
+                'file_id': None if is_new_file else file_id,
+                'chunks_received': chunks_received,
+                'retryable': True
+            }
+        
+        cur.execute("SELECT level, count FROM log_statistics WHERE file_id = %s", (file_id,))
+        statistics = {row['level']: row['count'] for row in cur.fetchall()}
     
     return {
-        'line_number': line_number,
-        'timestamp': timestamp,
-        'level': level,
-        'message': message.strip(),
-        'raw_line': line
+        'file_id': file_id,
+        'status': status,
+        'chunks_received': chunks_received + 1,
+        'lines_processed': line_number,
+        'total_lines': sum(statistics.values()),
+        'statistics': statistics
     }
 
 
-def parse_timestamp(ts_str: str) -> Optional[datetime]:
-    """Пытается распарсить различные форматы timestamp"""
-    formats = [
-        '%Y-%m-%dT%H:%M:%S.%fZ',
-        '%Y-%m-%dT%H:%M:%SZ',
-        '%Y-%m-%d %H:%M:%S',
-        '%Y-%m-%d',
-        '%b %d %H:%M:%S'
-    ]
+def parse_cursor(cursor: str) -> Tuple[int, int]:
+    """Разбирает cursor вида "file_id:line_number"; ValueError - если формат неверный"""
+    file_part, sep, line_part = cursor.partition(':')
+    if not sep or not file_part.isdigit() or not line_part.isdigit():
+        raise ValueError('Некорректный cursor, ожидается file_id:line_number')
+    return int(file_part), int(line_part)
+
+
+def search_entries(cur, params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Поиск по записям логов.
+    Режимы: substring (ILIKE по триграммному индексу) и fulltext (tsvector).
+    Фильтры: file_id, level (через запятую), time_from, time_to.
+    Пагинация: cursor вида "file_id:line_number" из next_cursor предыдущей страницы.
+    """
+    file_id = params.get('file_id')
+    query_text = (params.get('q') or params.get('search') or '').strip()
+    mode = params.get('mode', 'substring')
+    levels = [lvl.strip().upper() for lvl in (params.get('level') or '').split(',') if lvl.strip()]
+    time_from = params.get('time_from')
+    time_to = params.get('time_to')
+    limit = min(int(params.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+    cursor = params.get('cursor')
     
-    for fmt in formats:
-        try:
-            return datetime.strptime(ts_str, fmt)
-        except:
-            continue
+    conditions = []
+    values: List[Any] = []
+    
+    if file_id:
+        conditions.append("file_id = %s")
+        values.append(int(file_id))
+    
+    if levels:
+        # В статистике строки без уровня учитываются как UNKNOWN
+        if 'UNKNOWN' in levels:
+            conditions.append("(level = ANY(%s) OR level IS NULL)")
+        else:
+            conditions.append("level = ANY(%s)")
+        values.append(levels)
+    
+    if time_from:
+        conditions.append("timestamp >= %s")
+        values.append(time_from)
+    
+    if time_to:
+        conditions.append("timestamp <= %s")
+        values.append(time_to)
+    
+    if query_text:
+        if mode == 'fulltext':
+            # Выражение совпадает с idx_log_entries_message
+            conditions.append("to_tsvector('english', message) @@ websearch_to_tsquery('english', %s)")
+            values.append(query_text)
+        else:
+            escaped = query_text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            conditions.append("message ILIKE %s")
+            values.append(f'%{escaped}%')
+    
+    where = ' AND '.join(conditions) if conditions else 'TRUE'
+    
+    page_where = where
+    page_values = list(values)
+    if cursor:
+        cursor_file_id, cursor_line = parse_cursor(cursor)
+        page_where += " AND (file_id, line_number) > (%s, %s)"
+        page_values.extend([cursor_file_id, cursor_line])
+    
+    cur.execute(
+        f"SELECT * FROM log_entries WHERE {page_where} ORDER BY file_id, line_number LIMIT %s",
+        page_values + [limit + 1]
+    )
+    entries = [dict(e) for e in cur.fetchall()]
+    
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = f"{entries[-1]['file_id']}:{entries[-1]['line_number']}"
+    
+    total, is_estimate = count_entries(cur, where, values, file_id, levels,
+                                       exact_stats=not (query_text or time_from or time_to))
+    
+    return {
+        'entries': entries,
+        'next_cursor': next_cursor,
+        'total': total,
+        'total_is_estimate': is_estimate,
+        'limit': limit
+    }
+
+
+def count_entries(cur, where: str, values: List[Any], file_id: Optional[str],
+                  levels: List[str], exact_stats: bool) -> tuple:
+    """
+    Возвращает (total, is_estimate).
+    Без текстового и временного фильтра берёт точное число из log_statistics,
+    иначе использует оценку планировщика и уточняет её, если она небольшая.
+    """
+    if exact_stats:
+        query = "SELECT COALESCE(SUM(count), 0) AS total FROM log_statistics WHERE TRUE"
+        stats_values: List[Any] = []
+        if file_id:
+            query += " AND file_id = %s"
+            stats_values.append(int(file_id))
+        if levels:
+            query += " AND level = ANY(%s)"
+            stats_values.append(levels)
+        cur.execute(query, stats_values)
+        return int(cur.fetchone()['total']), False
+    
+    cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM log_entries WHERE {where}", values)
+    plan = cur.fetchone()['QUERY PLAN']
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    
+    if estimate > EXACT_COUNT_LIMIT:
+        return estimate, True
     
-    return None
\ No newline at end of file
+    cur.execute(
+        f"SELECT COUNT(*) AS total FROM (SELECT 1 FROM log_entries WHERE {where} LIMIT %s) t",
+        values + [EXACT_COUNT_LIMIT + 1]
+    )
+    total = cur.fetchone()['total']
+    return total, total > EXACT_COUNT_LIMIT
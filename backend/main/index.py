@@ -1,10 +1,13 @@
+import csv
+import io
 import json
 import os
 import sys
+import time
 import jwt 
 import bcrypt
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
@@ -125,7 +128,7 @@ def get_db_connection():
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
         raise Exception('DATABASE_URL not found')
-    return psycopg2.connect(dsn)
+    return psycopg2.connect(dsn, connection_factory=AuditedConnection)
 
 def create_jwt_token(user_id: int, email: str) -> str:
     secret = os.environ.get('JWT_SECRET')
@@ -267,6 +270,45 @@ def verify_token_and_permission(event: Dict[str, Any], conn, required_permission
     
     return payload, None
 
+AUDIT_LOG_COLUMNS = ('entity_type', 'entity_id', 'action', 'user_id', 'username',
+                     'changed_fields', 'old_values', 'new_values', 'metadata', 'created_at')
+AUDIT_SPOOL_PATH = os.environ.get('AUDIT_SPOOL_PATH', '/tmp/audit_logs_spool.jsonl')
+AUDIT_QUARANTINE_PATH = os.environ.get('AUDIT_QUARANTINE_PATH', '/tmp/audit_logs_rejected.jsonl')
+
+# Буфер записей аудита текущего запроса, длина его закоммиченной части
+# и кэш имён пользователей (живёт между тёплыми вызовами)
+_audit_buffer: list = []
+_audit_committed = 0
+_username_cache: Dict[int, str] = {}
+
+class AuditedConnection(psycopg2.extensions.connection):
+    """Rollback отбрасывает записи аудита, поставленные в буфер после последнего commit"""
+
+    def commit(self):
+        global _audit_committed
+        super().commit()
+        _audit_committed = len(_audit_buffer)
+
+    def rollback(self):
+        del _audit_buffer[_audit_committed:]
+        super().rollback()
+
+def get_cached_username(conn, user_id: Optional[int]) -> Optional[str]:
+    """Имя пользователя для подписи записей аудита с кэшированием по id"""
+    if not user_id:
+        return None
+    if user_id not in _username_cache:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (user_id,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        if not row:
+            return None
+        _username_cache[user_id] = row[0]
+    return _username_cache[user_id]
+
 def create_audit_log(
     conn,
     entity_type: str,
@@ -279,30 +321,101 @@ def create_audit_log(
     new_values: Optional[Dict] = None,
     metadata: Optional[Dict] = None
 ):
-    """Создание записи в audit log"""
+    """Постановка записи audit log в буфер; запись в БД выполняет flush_audit_logs"""
+    _audit_buffer.append((
+        entity_type,
+        entity_id,
+        action,
+        user_id,
+        username,
+        json.dumps(changed_fields, default=str) if changed_fields else None,
+        json.dumps(old_values, default=str) if old_values else None,
+        json.dumps(new_values, default=str) if new_values else None,
+        json.dumps(metadata, default=str) if metadata else None,
+        datetime.now().isoformat()
+    ))
+
+def _write_audit_lines(path: str, lines: list, mode: str):
+    with open(path, mode, encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def _read_audit_spool() -> list:
+    """Записи, отложенные прошлыми flush; нечитаемые строки уходят в карантин"""
+    if not os.path.exists(AUDIT_SPOOL_PATH):
+        return []
+    entries, broken = [], []
+    with open(AUDIT_SPOOL_PATH, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entries.append(tuple(json.loads(line)))
+            except ValueError:
+                broken.append(line.rstrip('\n'))
+    if broken:
+        log(f"[AUDIT] Quarantined {len(broken)} unreadable spool lines")
+        _write_audit_lines(AUDIT_QUARANTINE_PATH, broken, 'a')
+    return entries
+
+def _copy_audit_entries(cur, entries: list):
+    data = io.StringIO()
+    csv.writer(data).writerows(entries)
+    data.seek(0)
+    cur.copy_expert(
+        f"COPY {SCHEMA}.audit_logs ({', '.join(AUDIT_LOG_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        data
+    )
+
+def flush_audit_logs(conn):
+    """
+    Пакетная запись буфера аудита через COPY.
+    Если БД недоступна, записи сохраняются на диск до следующего flush.
+    Если БД отвергла данные, пакет пишется по одной записи, а отвергнутые уходят в карантин -
+    одна испорченная запись не блокирует отложенный пакет навсегда.
+    """
+    global _audit_committed
+    if not _audit_buffer and not os.path.exists(AUDIT_SPOOL_PATH):
+        return
+    entries = _read_audit_spool() + _audit_buffer
+    _audit_buffer.clear()
+    _audit_committed = 0
+    if not entries:
+        if os.path.exists(AUDIT_SPOOL_PATH):
+            os.remove(AUDIT_SPOOL_PATH)
+        return
+
+    rejected = []
     cur = conn.cursor()
     try:
-        cur.execute(f"""
-            INSERT INTO {SCHEMA}.audit_logs 
-            (entity_type, entity_id, action, user_id, username, changed_fields, old_values, new_values, metadata)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            entity_type,
-            entity_id,
-            action,
-            user_id,
-            username,
-            json.dumps(changed_fields) if changed_fields else None,
-            json.dumps(old_values) if old_values else None,
-            json.dumps(new_values) if new_values else None,
-            json.dumps(metadata) if metadata else None
-        ))
+        try:
+            _copy_audit_entries(cur, entries)
+        except (psycopg2.DataError, psycopg2.IntegrityError):
+            conn.rollback()
+            for entry in entries:
+                cur.execute("SAVEPOINT audit_entry")
+                try:
+                    _copy_audit_entries(cur, [entry])
+                except (psycopg2.DataError, psycopg2.IntegrityError):
+                    cur.execute("ROLLBACK TO SAVEPOINT audit_entry")
+                    rejected.append(entry)
         conn.commit()
+        if os.path.exists(AUDIT_SPOOL_PATH):
+            os.remove(AUDIT_SPOOL_PATH)
     except Exception as e:
-        print(f"Failed to create audit log: {e}")
+        conn.rollback()
+        log(f"[AUDIT] Failed to flush {len(entries)} audit logs, spooling to disk: {e}")
+        _write_audit_lines(AUDIT_SPOOL_PATH, [json.dumps(entry, ensure_ascii=False) for entry in entries], 'w')
+        return
     finally:
         cur.close()
 
+    if rejected:
+        log(f"[AUDIT] Quarantined {len(rejected)} audit logs rejected by the database")
+        _write_audit_lines(AUDIT_QUARANTINE_PATH, [json.dumps(entry, ensure_ascii=False) for entry in rejected], 'a')
+
 def verify_token(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
     if not token:
@@ -1162,9 +1275,7 @@ def handle_payments(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
                 conn.commit()
                 
                 # Audit log
-                cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (payload['user_id'],))
-                username_row = cur.fetchone()
-                username = username_row['username'] if username_row else 'Unknown'
+                username = get_cached_username(conn, payload['user_id']) or 'Unknown'
                 
                 payment_data = {
                     'id': row['id'],
@@ -1240,9 +1351,7 @@ def handle_payments(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
             conn.commit()
             
             # Audit log
-            cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (payload['user_id'],))
-            username_row = cur.fetchone()
-            username = username_row['username'] if username_row else 'Unknown'
+            username = get_cached_username(conn, payload['user_id']) or 'Unknown'
             
             new_payment_data = {
                 'id': row['id'],
@@ -1328,9 +1437,7 @@ def handle_payments(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
             conn.commit()
             
             # Audit log
-            cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (payload['user_id'],))
-            username_row = cur.fetchone()
-            username = username_row['username'] if username_row else 'Unknown'
+            username = get_cached_username(conn, payload['user_id']) or 'Unknown'
             
             create_audit_log(
                 conn,
@@ -2207,36 +2314,40 @@ def handle_roles(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
                     } for pr in perm_rows]
                 })
             
-            cur.execute(f'SELECT id, name, description, created_at FROM {SCHEMA}.roles ORDER BY id')
+            cur.execute(f'''SELECT r.id, r.name, r.description, r.created_at, COALESCE(uc.user_count, 0)
+                           FROM {SCHEMA}.roles r
+                           LEFT JOIN (
+                               SELECT role_id, COUNT(*) AS user_count
+                               FROM {SCHEMA}.user_roles
+                               GROUP BY role_id
+                           ) uc ON uc.role_id = r.id
+                           ORDER BY r.id''')
             rows = cur.fetchall()
-            result = []
-            for row in rows:
-                cur.execute(
-                    f'''SELECT p.id, p.name, p.resource, p.action, p.description 
-                       FROM {SCHEMA}.permissions p 
-                       JOIN {SCHEMA}.role_permissions rp ON p.id = rp.permission_id 
-                       WHERE rp.role_id = %s''',
-                    (row[0],)
-                )
-                perm_rows = cur.fetchall()
-                
-                cur.execute(f'SELECT COUNT(*) FROM {SCHEMA}.user_roles WHERE role_id = %s', (row[0],))
-                user_count = cur.fetchone()[0]
-                
-                result.append({
-                    'id': row[0],
-                    'name': row[1],
-                    'description': row[2],
-                    'created_at': row[3].isoformat() if row[3] else None,
-                    'user_count': user_count,
-                    'permissions': [{
-                        'id': pr[0],
-                        'name': pr[1],
-                        'resource': pr[2],
-                        'action': pr[3],
-                        'description': pr[4]
-                    } for pr in perm_rows]
+            
+            # Права всех ролей одним запросом
+            cur.execute(
+                f'''SELECT rp.role_id, p.id, p.name, p.resource, p.action, p.description 
+                   FROM {SCHEMA}.permissions p 
+                   JOIN {SCHEMA}.role_permissions rp ON p.id = rp.permission_id'''
+            )
+            perms_by_role = {}
+            for pr in cur.fetchall():
+                perms_by_role.setdefault(pr[0], []).append({
+                    'id': pr[1],
+                    'name': pr[2],
+                    'resource': pr[3],
+                    'action': pr[4],
+                    'description': pr[5]
                 })
+            
+            result = [{
+                'id': row[0],
+                'name': row[1],
+                'description': row[2],
+                'created_at': row[3].isoformat() if row[3] else None,
+                'user_count': row[4],
+                'permissions': perms_by_role.get(row[0], [])
+            } for row in rows]
             return response(200, result)
         
         elif method == 'POST':
@@ -2544,174 +2655,6 @@ def handle_customer_departments(method: str, event: Dict[str, Any], conn) -> Dic
     finally:
         cur.close()
 
-def handle_approvals(method: str, event: Dict[str, Any], conn, payload: Dict[str, Any]) -> Dict[str, Any]:
-    if not payload:
-        return response(401, {'error': 'Требуется авторизация'})
-    
-    if method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        payment_id = body_data.get('payment_id')
-        
-        if not payment_id:
-            return response(400, {'error': 'payment_id обязателен'})
-        
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(f"""
-            SELECT p.status, p.created_by, p.service_id, 
-                   s.intermediate_approver_id, s.final_approver_id
-            FROM {SCHEMA}.payments p
-            LEFT JOIN {SCHEMA}.services s ON p.service_id = s.id
-            WHERE p.id = %s
-        """, (payment_id,))
-        
-        payment = cur.fetchone()
-        if not payment:
-            cur.close()
-            return response(404, {'error': 'Платеж не найден'})
-        
-        if payment['status'] != 'draft':
-            cur.close()
-            return response(400, {'error': 'Платеж уже отправлен на согласование'})
-        
-        if not payment['service_id']:
-            cur.close()
-            return response(400, {'error': 'Для отправки на согласование необходимо указать сервис'})
-        
-        moscow_tz = ZoneInfo('Europe/Moscow')
-        now_moscow = datetime.now(moscow_tz).replace(tzinfo=None)
-        
-        cur.execute(f"""
-            UPDATE {SCHEMA}.payments 
-            SET status = 'pending_ceo', submitted_at = %s
-            WHERE id = %s
-        """, (now_moscow, payment_id))
-        
-        cur.execute(f"""
-            INSERT INTO {SCHEMA}.approvals (payment_id, approver_id, approver_role, action, comment)
-            VALUES (%s, %s, 'creator', 'submitted', 'Отправлено на согласование')
-        """, (payment_id, payload['user_id']))
-        
-        conn.commit()
-        cur.close()
-        
-        return response(200, {'message': 'Платеж отправлен на согласование', 'status': 'pending_ceo'})
-    
-    elif method == 'PUT':
-        body_data = json.loads(event.get('body', '{}'))
-        
-        req = ApprovalActionRequest(**body_data)
-        user_id = payload['user_id']
-        user_role = get_user_role(conn, user_id)
-        
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(f"""
-            SELECT p.status, p.service_id, 
-                   s.intermediate_approver_id, s.final_approver_id
-            FROM {SCHEMA}.payments p
-            LEFT JOIN {SCHEMA}.services s ON p.service_id = s.id
-            WHERE p.id = %s
-        """, (req.payment_id,))
-        
-        payment = cur.fetchone()
-        if not payment:
-            cur.close()
-            return response(404, {'error': 'Платеж не найден'})
-        
-        current_status = payment['status']
-        intermediate_approver = payment.get('intermediate_approver_id')
-        final_approver = payment.get('final_approver_id')
-        
-        if current_status == 'pending_ceo' and user_id == final_approver:
-            moscow_tz = ZoneInfo('Europe/Moscow')
-            now_moscow = datetime.now(moscow_tz).replace(tzinfo=None)
-            
-            if req.action == 'approve':
-                new_status = 'approved'
-                cur.execute(f"""
-                    UPDATE {SCHEMA}.payments 
-                    SET status = %s, ceo_approved_at = %s, ceo_approved_by = %s
-                    WHERE id = %s
-                """, (new_status, now_moscow, user_id, req.payment_id))
-            else:
-                new_status = 'rejected'
-                cur.execute(f"""
-                    UPDATE {SCHEMA}.payments 
-                    SET status = %s, ceo_approved_at = %s, ceo_approved_by = %s
-                    WHERE id = %s
-                """, (new_status, now_moscow, user_id, req.payment_id))
-        
-        else:
-            cur.close()
-            return response(403, {'error': 'У вас нет прав для этого действия'})
-        
-        try:
-            print(f"[DEBUG] Inserting approval: payment_id={req.payment_id}, user_id={user_id}, user_role={user_role}, action={req.action}, comment={req.comment}")
-            cur.execute(f"""
-                INSERT INTO {SCHEMA}.approvals (payment_id, approver_id, approver_role, action, comment)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (req.payment_id, user_id, user_role, req.action, req.comment))
-            
-            conn.commit()
-        except Exception as e:
-            print(f"[ERROR] Error saving to DB: {str(e)}")
-            conn.rollback()
-            cur.close()
-            return response(500, {'error': f'Error saving to DB: {str(e)}'})
-        
-        # Audit log
-        cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (user_id,))
-        username_row = cur.fetchone()
-        username = username_row['username'] if username_row else 'Unknown'
-        
-        action_name = 'approved' if req.action == 'approve' else 'rejected'
-        create_audit_log(
-            conn,
-            'payment',
-            req.payment_id,
-            action_name,
-            user_id,
-            username,
-            changed_fields={'status': {'old': current_status, 'new': new_status}},
-            metadata={'comment': req.comment, 'role': user_role}
-        )
-        
-        cur.close()
-        
-        return response(200, {'message': 'Решение принято', 'status': new_status})
-    
-    elif method == 'GET':
-        params = event.get('queryStringParameters') or {}
-        payment_id = params.get('payment_id')
-        
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        if payment_id:
-            cur.execute(f"""
-                SELECT a.*, u.full_name as approver_name
-                FROM {SCHEMA}.approvals a
-                JOIN {SCHEMA}.users u ON a.approver_id = u.id
-                WHERE a.payment_id = %s
-                ORDER BY a.created_at DESC
-            """, (payment_id,))
-        else:
-            cur.execute(f"""
-                SELECT a.*, u.full_name as approver_name, p.amount, p.description
-                FROM {SCHEMA}.approvals a
-                JOIN {SCHEMA}.users u ON a.approver_id = u.id
-                JOIN {SCHEMA}.payments p ON a.payment_id = p.id
-                ORDER BY a.created_at DESC
-                LIMIT 100
-            """)
-        
-        approvals = [dict(row) for row in cur.fetchall()]
-        cur.close()
-        
-        return response(200, approvals)
-    
-    return response(405, {'error': 'Метод не поддерживается'})
-
 def handle_services(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
@@ -2832,35 +2775,25 @@ def handle_services(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
                 if not service_id:
                     return response(400, {'error': 'ID is required'})
                 
-                cur.execute(f"SELECT COUNT(*) as cnt FROM {SCHEMA}.payments WHERE service_id = %s", (service_id,))
-                payment_count = cur.fetchone()['cnt']
-                
-                cur.execute(f"SELECT COUNT(*) as cnt FROM {SCHEMA}.savings WHERE service_id = %s", (service_id,))
-                saving_count = cur.fetchone()['cnt']
-
-                cur.execute(f"SELECT COUNT(*) as cnt FROM {SCHEMA}.tickets WHERE service_id = %s", (service_id,))
-                ticket_count = cur.fetchone()['cnt']
-
-                cur.execute(f"SELECT COUNT(*) as cnt FROM {SCHEMA}.planned_payments WHERE service_id = %s", (service_id,))
-                planned_count = cur.fetchone()['cnt']
-                
-                log(f"[DELETE SERVICE] Dependencies: payments={payment_count}, savings={saving_count}, tickets={ticket_count}, planned_payments={planned_count}")
+                # Какие таблицы ссылаются на сервис - одним запросом по EXISTS
+                cur.execute(f"""
+                    SELECT 'payments' AS tbl WHERE EXISTS (SELECT 1 FROM {SCHEMA}.payments WHERE service_id = %(id)s)
+                    UNION ALL
+                    SELECT 'savings' WHERE EXISTS (SELECT 1 FROM {SCHEMA}.savings WHERE service_id = %(id)s)
+                    UNION ALL
+                    SELECT 'tickets' WHERE EXISTS (SELECT 1 FROM {SCHEMA}.tickets WHERE service_id = %(id)s)
+                    UNION ALL
+                    SELECT 'planned_payments' WHERE EXISTS (SELECT 1 FROM {SCHEMA}.planned_payments WHERE service_id = %(id)s)
+                """, {'id': service_id})
+                dependent_tables = [r['tbl'] for r in cur.fetchall()]
                 
-                if payment_count > 0:
-                    cur.execute(f"UPDATE {SCHEMA}.payments SET service_id = NULL WHERE service_id = %s", (service_id,))
-                    log(f"[DELETE SERVICE] Detached {payment_count} payments")
+                log(f"[DELETE SERVICE] Dependencies: {', '.join(dependent_tables) or 'none'}")
                 
-                if saving_count > 0:
-                    cur.execute(f"UPDATE {SCHEMA}.savings SET service_id = NULL WHERE service_id = %s", (service_id,))
-                    log(f"[DELETE SERVICE] Detached {saving_count} savings")
-
-                if ticket_count > 0:
-                    cur.execute(f"UPDATE {SCHEMA}.tickets SET service_id = NULL WHERE service_id = %s", (service_id,))
-                    log(f"[DELETE SERVICE] Detached {ticket_count} tickets")
-
-                if planned_count > 0:
-                    cur.execute(f"UPDATE {SCHEMA}.planned_payments SET service_id = NULL WHERE service_id = %s", (service_id,))
-                    log(f"[DELETE SERVICE] Detached {planned_count} planned_payments")
+                detached = {'payments': 0, 'savings': 0, 'tickets': 0, 'planned_payments': 0}
+                for table in dependent_tables:
+                    cur.execute(f"UPDATE {SCHEMA}.{table} SET service_id = NULL WHERE service_id = %s", (service_id,))
+                    detached[table] = cur.rowcount
+                    log(f"[DELETE SERVICE] Detached {cur.rowcount} {table}")
                 
                 cur.execute(f"DELETE FROM {SCHEMA}.services WHERE id = %s RETURNING id, name", (service_id,))
                 row = cur.fetchone()
@@ -2876,26 +2809,19 @@ def handle_services(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
                     user_id=payload['user_id'],
                     username=payload.get('email', 'unknown'),
                     old_values={'id': row['id'], 'name': row['name']},
-                    metadata={'detached_payments': payment_count, 'detached_savings': saving_count, 'detached_tickets': ticket_count, 'detached_planned': planned_count}
+                    metadata={'detached_payments': detached['payments'], 'detached_savings': detached['savings'], 'detached_tickets': detached['tickets'], 'detached_planned': detached['planned_payments']}
                 )
                 
                 conn.commit()
                 log(f"[DELETE SERVICE] Successfully deleted service_id={service_id}")
                 
                 message = "Услуга удалена"
-                parts = []
-                if payment_count > 0:
-                    parts.append(f"платежей {payment_count}")
-                if saving_count > 0:
-                    parts.append(f"экономий {saving_count}")
-                if ticket_count > 0:
-                    parts.append(f"заявок {ticket_count}")
-                if planned_count > 0:
-                    parts.append(f"плановых платежей {planned_count}")
+                labels = (('payments', 'платежей'), ('savings', 'экономий'), ('tickets', 'заявок'), ('planned_payments', 'плановых платежей'))
+                parts = [f"{label} {detached[table]}" for table, label in labels if detached[table] > 0]
                 if parts:
                     message += f" (отвязано: {', '.join(parts)})"
                 
-                return response(200, {'message': message, 'detached_payments': payment_count, 'detached_savings': saving_count})
+                return response(200, {'message': message, 'detached_payments': detached['payments'], 'detached_savings': detached['savings']})
             except Exception as e:
                 conn.rollback()
                 log(f"[DELETE SERVICE ERROR] {str(e)}")
@@ -3178,16 +3104,57 @@ def handle_stats(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return response(500, {'error': str(e)})
 
 # Comments handlers
+COMMENTS_PAGE_MAX_LIMIT = int(os.environ.get('COMMENTS_PAGE_MAX_LIMIT', '200'))
+
+def parse_comments_page(query_params: Dict[str, Any]) -> tuple:
+    """
+    Параметры постраничной загрузки ветки комментариев: (paged, limit, before_id, error).
+    limit ограничивается COMMENTS_PAGE_MAX_LIMIT; before_id без limit отдаёт страницу максимального размера
+    """
+    limit = query_params.get('limit')
+    before_id = query_params.get('before_id')
+    paged = bool(limit or before_id)
+    try:
+        limit = int(limit) if limit else None
+        before_id = int(before_id) if before_id else None
+    except ValueError:
+        return paged, None, None, response(400, {'error': 'limit and before_id must be integers'})
+    if limit is not None and limit < 1:
+        return paged, None, None, response(400, {'error': 'limit must be positive'})
+    if before_id is not None and before_id < 1:
+        return paged, None, None, response(400, {'error': 'before_id must be positive'})
+    if paged:
+        limit = min(limit or COMMENTS_PAGE_MAX_LIMIT, COMMENTS_PAGE_MAX_LIMIT)
+    return paged, limit, before_id, None
+
 def handle_comments(method: str, event: Dict[str, Any], conn, current_user: Dict[str, Any]) -> Dict[str, Any]:
     if method == 'GET':
-        payment_id = event.get('queryStringParameters', {}).get('payment_id')
+        query_params = event.get('queryStringParameters') or {}
+        payment_id = query_params.get('payment_id')
         if not payment_id:
             return response(400, {'error': 'payment_id is required'})
         
+        # Постраничная загрузка длинных веток: limit и before_id (id самого старого загруженного комментария).
+        # Без них - прежний ответ со всей веткой списком
+        paged, limit, before_id, error = parse_comments_page(query_params)
+        if error:
+            return error
+        
+        cur = None
         try:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
-            cur.execute(f"""
+            if before_id:
+                cur.execute(
+                    f"SELECT created_at, id FROM {SCHEMA}.payment_comments WHERE id = %s AND payment_id = %s",
+                    (before_id, int(payment_id))
+                )
+                anchor = cur.fetchone()
+                if not anchor:
+                    cur.close()
+                    return response(404, {'error': 'before_id comment not found'})
+            
+            query = f"""
                 SELECT 
                     c.id,
                     c.payment_id,
@@ -3198,18 +3165,43 @@ def handle_comments(method: str, event: Dict[str, Any], conn, current_user: Dict
                     c.comment_text,
                     c.created_at,
                     c.updated_at,
-                    (SELECT COUNT(*) FROM {SCHEMA}.comment_likes WHERE comment_id = c.id) as likes_count,
-                    EXISTS(SELECT 1 FROM {SCHEMA}.comment_likes WHERE comment_id = c.id AND user_id = %s) as user_liked
+                    COALESCE(l.likes_count, 0) as likes_count,
+                    COALESCE(l.user_liked, FALSE) as user_liked
                 FROM {SCHEMA}.payment_comments c
                 JOIN {SCHEMA}.users u ON c.user_id = u.id
+                LEFT JOIN (
+                    SELECT cl.comment_id, COUNT(*) as likes_count, BOOL_OR(cl.user_id = %s) as user_liked
+                    FROM {SCHEMA}.comment_likes cl
+                    JOIN {SCHEMA}.payment_comments pc ON pc.id = cl.comment_id
+                    WHERE pc.payment_id = %s
+                    GROUP BY cl.comment_id
+                ) l ON l.comment_id = c.id
                 WHERE c.payment_id = %s
-                ORDER BY c.created_at ASC
-            """, (current_user['id'], int(payment_id)))
+            """
+            params = [current_user['id'], int(payment_id), int(payment_id)]
+            if before_id:
+                query += " AND (c.created_at, c.id) < (%s, %s)"
+                params.extend([anchor['created_at'], anchor['id']])
+            if not paged:
+                query += " ORDER BY c.created_at ASC, c.id ASC"
+                cur.execute(query, tuple(params))
+                comments = cur.fetchall()
+                cur.close()
+                return response(200, [dict(c) for c in comments])
             
-            comments = cur.fetchall()
+            # Страница берётся с конца ветки, внутри страницы порядок прежний - от старых к новым
+            query += " ORDER BY c.created_at DESC, c.id DESC LIMIT %s"
+            params.append(limit + 1)
+            cur.execute(query, tuple(params))
+            rows = cur.fetchall()
             cur.close()
             
-            return response(200, [dict(c) for c in comments])
+            has_more = len(rows) > limit
+            if has_more:
+                rows = rows[:limit]
+            rows.reverse()
+            
+            return response(200, {'comments': [dict(c) for c in rows], 'has_more': has_more})
         except Exception as e:
             if cur:
                 cur.close()
@@ -3353,6 +3345,89 @@ def handle_approvals(method: str, event: Dict[str, Any], conn, payload: Dict[str
     
     return response(405, {'error': 'Method not allowed'})
 
+AUDIT_LOG_RETENTION_DAYS = int(os.environ.get('AUDIT_LOG_RETENTION_DAYS', '365'))
+AUDIT_LOG_ARCHIVE_BATCH = 5000
+
+def encode_audit_cursor(row: Dict[str, Any]) -> str:
+    """Курсор keyset-пагинации: created_at|id последней записи страницы"""
+    return f"{row['created_at'].isoformat()}|{row['id']}"
+
+def decode_audit_cursor(cursor: str) -> tuple:
+    created_at, log_id = cursor.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(log_id)
+
+def create_audit_archive_partition(cur, month_start: datetime) -> None:
+    """
+    Создаёт месячную секцию audit_logs_archive.
+    Строки этого месяца, уже попавшие в DEFAULT-секцию, переносятся в новую таблицу
+    до присоединения - иначе PostgreSQL не даёт создать секцию поверх DEFAULT.
+    """
+    partition = f'{SCHEMA}.audit_logs_archive_{month_start:%Y%m}'
+    cur.execute('SELECT to_regclass(%s)', (partition,))
+    if cur.fetchone()[0] is not None:
+        return
+    month_end = (month_start + timedelta(days=32)).replace(day=1)
+    cur.execute(f"""
+        CREATE TABLE {partition}
+        (LIKE {SCHEMA}.audit_logs_archive INCLUDING DEFAULTS)
+    """)
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {SCHEMA}.audit_logs_archive_default
+            WHERE created_at >= %s AND created_at < %s
+            RETURNING *
+        )
+        INSERT INTO {partition} SELECT * FROM moved
+    """, (month_start, month_end))
+    cur.execute(f"""
+        ALTER TABLE {SCHEMA}.audit_logs_archive
+        ATTACH PARTITION {partition} FOR VALUES FROM (%s) TO (%s)
+    """, (month_start, month_end))
+
+def archive_audit_logs(conn, retention_days: int) -> int:
+    """Переносит записи старше retention_days в audit_logs_archive пачками"""
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+            SELECT DISTINCT date_trunc('month', created_at)
+            FROM {SCHEMA}.audit_logs
+            WHERE created_at < %s
+        """, (cutoff,))
+        for (month_start,) in cur.fetchall():
+            create_audit_archive_partition(cur, month_start)
+        conn.commit()
+        
+        archived = 0
+        while True:
+            cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM {SCHEMA}.audit_logs
+                    WHERE id IN (
+                        SELECT id FROM {SCHEMA}.audit_logs
+                        WHERE created_at < %s
+                        ORDER BY created_at, id
+                        LIMIT %s
+                    )
+                    RETURNING id, entity_type, entity_id, action, user_id, username,
+                              changed_fields, old_values, new_values, metadata, created_at
+                )
+                INSERT INTO {SCHEMA}.audit_logs_archive
+                (id, entity_type, entity_id, action, user_id, username,
+                 changed_fields, old_values, new_values, metadata, created_at)
+                SELECT * FROM moved
+            """, (cutoff, AUDIT_LOG_ARCHIVE_BATCH))
+            moved = cur.rowcount
+            conn.commit()
+            archived += moved
+            if moved < AUDIT_LOG_ARCHIVE_BATCH:
+                return archived
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
 def handle_audit_logs(method: str, event: Dict[str, Any], conn, payload: Dict[str, Any]) -> Dict[str, Any]:
     '''Обработка запросов к audit logs'''
     if method == 'GET':
@@ -3363,6 +3438,9 @@ def handle_audit_logs(method: str, event: Dict[str, Any], conn, payload: Dict[st
         action = params.get('action')
         limit = int(params.get('limit', 100))
         offset = int(params.get('offset', 0))
+        # Наличие параметра cursor (даже пустого) включает keyset-пагинацию
+        use_cursor = 'cursor' in params
+        cursor = params.get('cursor')
         
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
@@ -3386,8 +3464,19 @@ def handle_audit_logs(method: str, event: Dict[str, Any], conn, payload: Dict[st
                 query += " AND action = %s"
                 query_params.append(action)
             
-            query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-            query_params.extend([limit, offset])
+            if use_cursor:
+                if cursor:
+                    try:
+                        query += " AND (created_at, id) < (%s, %s)"
+                        query_params.extend(decode_audit_cursor(cursor))
+                    except ValueError:
+                        cur.close()
+                        return response(400, {'error': 'Invalid cursor'})
+                query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+                query_params.append(limit + 1)
+            else:
+                query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
+                query_params.extend([limit, offset])
             
             cur.execute(query, tuple(query_params))
             logs = cur.fetchall()
@@ -3395,12 +3484,37 @@ def handle_audit_logs(method: str, event: Dict[str, Any], conn, payload: Dict[st
             result = [dict(log) for log in logs]
             cur.close()
             
+            if use_cursor:
+                has_more = len(result) > limit
+                result = result[:limit]
+                next_cursor = encode_audit_cursor(result[-1]) if has_more else None
+                return response(200, {'logs': result, 'next_cursor': next_cursor})
+            
             return response(200, result)
         except Exception as e:
             if cur:
                 cur.close()
             return response(500, {'error': str(e)})
     
+    elif method == 'POST':
+        admin_payload, error = verify_token_and_permission(event, conn, 'audit_logs.delete')
+        if error:
+            return error
+        
+        body = json.loads(event.get('body') or '{}')
+        try:
+            retention_days = int(body.get('retention_days', AUDIT_LOG_RETENTION_DAYS))
+        except (TypeError, ValueError):
+            return response(400, {'error': 'retention_days must be an integer'})
+        if retention_days < 1:
+            return response(400, {'error': 'retention_days must be positive'})
+        
+        try:
+            archived = archive_audit_logs(conn, retention_days)
+            return response(200, {'success': True, 'archived': archived, 'retention_days': retention_days})
+        except Exception as e:
+            return response(500, {'error': str(e)})
+    
     elif method == 'DELETE':
         params = event.get('queryStringParameters', {})
         log_id = params.get('id')
@@ -3627,12 +3741,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         payload = verify_token(event)
         if not payload:
-            conn.close()
             return response(401, {'error': 'Unauthorized'})
-        
+
         if endpoint == 'me':
             user_data = get_user_with_permissions(conn, payload['user_id'])
-            conn.close()
             if not user_data:
                 return response(404, {'error': 'User not found'})
             return response(200, user_data)
@@ -3704,17 +3816,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             result = handle_payment_views(method, event, conn)
         else:
             result = response(404, {'error': f'Endpoint not found: {endpoint}'})
-        
-        conn.close()
+
         return result
-        
+
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
         print(f"Error: {str(e)}")
         print(f"Traceback: {error_details}")
-        conn.close()
+        conn.rollback()
         return response(500, {'error': str(e), 'details': error_details})
+    finally:
+        # Записи аудита пишутся на любом пути выхода, включая ранние return
+        flush_audit_logs(conn)
+        conn.close()
 
 def handle_payment_views(method: str, event: Dict[str, Any], conn) -> Dict[str, Any]:
     """Запись и чтение фактов просмотра платежа согласующим"""
@@ -3767,6 +3882,34 @@ def handle_payment_views(method: str, event: Dict[str, Any], conn) -> Dict[str,
         cur.close()
 
 
+TICKET_DICT_CACHE_TTL = int(os.environ.get('TICKET_DICT_CACHE_TTL', '300'))
+
+# Кэш небольших справочников заявок: {kind: {id: name}}; перечитывается по TTL или при промахе по id
+_ticket_dict_cache: Dict[str, Any] = {'loaded_at': 0.0, 'names': {}}
+
+def get_ticket_dictionary_name(conn, kind: str, item_id: Optional[int]) -> Optional[str]:
+    """Название приоритета/категории/отдела/статуса заявки из кэша справочников"""
+    if not item_id:
+        return None
+    names = _ticket_dict_cache['names']
+    if time.monotonic() - _ticket_dict_cache['loaded_at'] > TICKET_DICT_CACHE_TTL or int(item_id) not in names.get(kind, {}):
+        cur = conn.cursor()
+        try:
+            cur.execute(f"""
+                SELECT 'priority', id, name FROM {SCHEMA}.ticket_priorities
+                UNION ALL SELECT 'category', id, name FROM {SCHEMA}.ticket_categories
+                UNION ALL SELECT 'department', id, name FROM {SCHEMA}.departments
+                UNION ALL SELECT 'status', id, name FROM {SCHEMA}.ticket_statuses
+            """)
+            names = {}
+            for row_kind, row_id, row_name in cur.fetchall():
+                names.setdefault(row_kind, {})[row_id] = row_name
+        finally:
+            cur.close()
+        _ticket_dict_cache['names'] = names
+        _ticket_dict_cache['loaded_at'] = time.monotonic()
+    return names.get(kind, {}).get(int(item_id))
+
 # Tickets handlers
 def handle_tickets_api(method: str, event: Dict[str, Any], conn, payload: Dict[str, Any]) -> Dict[str, Any]:
     """Обработчик для управления заявками"""
@@ -3881,17 +4024,11 @@ def handle_tickets_api(method: str, event: Dict[str, Any], conn, payload: Dict[s
             conn.commit()
             
             # Записываем в audit_logs
-            cur.execute(f"""
-                SELECT username FROM {SCHEMA}.users WHERE id = %s
-            """, (user_id,))
-            username = cur.fetchone()['username']
-            
-            cur.execute(f"""
-                INSERT INTO {SCHEMA}.audit_logs 
-                (entity_type, entity_id, action, user_id, username, new_values)
-                VALUES ('ticket', %s, 'created', %s, %s, %s::jsonb)
-            """, (ticket_id, user_id, username, json.dumps({'title': title, 'description': description})))
-            conn.commit()
+            create_audit_log(
+                conn, 'ticket', ticket_id, 'created', user_id,
+                get_cached_username(conn, user_id),
+                new_values={'title': title, 'description': description}
+            )
             
             return response(201, {'id': ticket_id, 'message': 'Заявка создана'})
         
@@ -3938,57 +4075,27 @@ def handle_tickets_api(method: str, event: Dict[str, Any], conn, payload: Dict[s
             if priority_id is not None and priority_id != old_data['priority_id']:
                 update_parts.append('priority_id = %s')
                 params.append(priority_id)
-                
-                if old_data['priority_id']:
-                    cur.execute(f"SELECT name FROM {SCHEMA}.ticket_priorities WHERE id = %s", (old_data['priority_id'],))
-                    old_priority = cur.fetchone()
-                else:
-                    old_priority = None
-                    
-                cur.execute(f"SELECT name FROM {SCHEMA}.ticket_priorities WHERE id = %s", (priority_id,))
-                new_priority = cur.fetchone()
-                
                 changed_fields['priority'] = {
-                    'old': old_priority['name'] if old_priority else None,
-                    'new': new_priority['name'] if new_priority else None
+                    'old': get_ticket_dictionary_name(conn, 'priority', old_data['priority_id']),
+                    'new': get_ticket_dictionary_name(conn, 'priority', priority_id)
                 }
             
             # Проверяем изменение категории
             if category_id is not None and category_id != old_data['category_id']:
                 update_parts.append('category_id = %s')
                 params.append(category_id)
-                
-                if old_data['category_id']:
-                    cur.execute(f"SELECT name FROM {SCHEMA}.ticket_categories WHERE id = %s", (old_data['category_id'],))
-                    old_category = cur.fetchone()
-                else:
-                    old_category = None
-                    
-                cur.execute(f"SELECT name FROM {SCHEMA}.ticket_categories WHERE id = %s", (category_id,))
-                new_category = cur.fetchone()
-                
                 changed_fields['category'] = {
-                    'old': old_category['name'] if old_category else None,
-                    'new': new_category['name'] if new_category else None
+                    'old': get_ticket_dictionary_name(conn, 'category', old_data['category_id']),
+                    'new': get_ticket_dictionary_name(conn, 'category', category_id)
                 }
             
             # Проверяем изменение отдела
             if department_id is not None and department_id != old_data['department_id']:
                 update_parts.append('department_id = %s')
                 params.append(department_id)
-                
-                if old_data['department_id']:
-                    cur.execute(f"SELECT name FROM {SCHEMA}.departments WHERE id = %s", (old_data['department_id'],))
-                    old_dept = cur.fetchone()
-                else:
-                    old_dept = None
-                    
-                cur.execute(f"SELECT name FROM {SCHEMA}.departments WHERE id = %s", (department_id,))
-                new_dept = cur.fetchone()
-                
                 changed_fields['department'] = {
-                    'old': old_dept['name'] if old_dept else None,
-                    'new': new_dept['name'] if new_dept else None
+                    'old': get_ticket_dictionary_name(conn, 'department', old_data['department_id']),
+                    'new': get_ticket_dictionary_name(conn, 'department', department_id)
                 }
             
             # Проверяем изменение дедлайна
@@ -4000,38 +4107,17 @@ def handle_tickets_api(method: str, event: Dict[str, Any], conn, payload: Dict[s
             if status_id is not None and status_id != old_data['status_id']:
                 update_parts.append('status_id = %s')
                 params.append(status_id)
-                
-                # Получаем названия статусов
-                cur.execute(f"SELECT name FROM {SCHEMA}.ticket_statuses WHERE id = %s", (old_data['status_id'],))
-                old_status = cur.fetchone()
-                cur.execute(f"SELECT name FROM {SCHEMA}.ticket_statuses WHERE id = %s", (status_id,))
-                new_status = cur.fetchone()
-                
                 changed_fields['status'] = {
-                    'old': old_status['name'] if old_status else None,
-                    'new': new_status['name'] if new_status else None
+                    'old': get_ticket_dictionary_name(conn, 'status', old_data['status_id']),
+                    'new': get_ticket_dictionary_name(conn, 'status', status_id)
                 }
             
             if 'assigned_to' in data and assigned_to != old_data['assigned_to']:
                 update_parts.append('assigned_to = %s')
                 params.append(assigned_to)
-                
-                # Получаем имена пользователей
-                if old_data['assigned_to']:
-                    cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (old_data['assigned_to'],))
-                    old_assignee = cur.fetchone()
-                else:
-                    old_assignee = None
-                
-                if assigned_to:
-                    cur.execute(f"SELECT username FROM {SCHEMA}.users WHERE id = %s", (assigned_to,))
-                    new_assignee = cur.fetchone()
-                else:
-                    new_assignee = None
-                
                 changed_fields['assigned_to'] = {
-                    'old': old_assignee['username'] if old_assignee else None,
-                    'new': new_assignee['username'] if new_assignee else None
+                    'old': get_cached_username(conn, old_data['assigned_to']),
+                    'new': get_cached_username(conn, assigned_to)
                 }
             
             if not update_parts:
@@ -4049,19 +4135,13 @@ def handle_tickets_api(method: str, event: Dict[str, Any], conn, payload: Dict[s
             
             # Записываем в audit_logs
             if changed_fields:
-                cur.execute(f"""
-                    SELECT username FROM {SCHEMA}.users WHERE id = %s
-                """, (user_id,))
-                username = cur.fetchone()['username']
-                
                 action = 'status_changed' if 'status' in changed_fields else 'assigned' if 'assigned_to' in changed_fields else 'updated'
                 
-                cur.execute(f"""
-                    INSERT INTO {SCHEMA}.audit_logs 
-                    (entity_type, entity_id, action, user_id, username, changed_fields)
-                    VALUES ('ticket', %s, %s, %s, %s, %s::jsonb)
-                """, (ticket_id, action, user_id, username, json.dumps(changed_fields)))
-                conn.commit()
+                create_audit_log(
+                    conn, 'ticket', ticket_id, action, user_id,
+                    get_cached_username(conn, user_id),
+                    changed_fields=changed_fields
+                )
             
             return response(200, {'message': 'Заявка обновлена'})
         
@@ -4137,6 +4217,21 @@ def handle_ticket_comments_api(method: str, event: Dict[str, Any], conn, payload
             if not ticket_id:
                 return response(400, {'error': 'ticket_id обязателен'})
             
+            # Постраничная загрузка длинных веток: limit и before_id (id последнего загруженного комментария)
+            paged, limit, before_id, error = parse_comments_page(query_params)
+            if error:
+                return error
+            
+            anchor = None
+            if before_id:
+                cur.execute(
+                    f"SELECT created_at, id FROM {SCHEMA}.ticket_comments WHERE id = %s AND ticket_id = %s",
+                    (before_id, ticket_id)
+                )
+                anchor = cur.fetchone()
+                if not anchor:
+                    return response(404, {'error': 'Комментарий before_id не найден'})
+            
             # Помечаем все комментарии в заявке как прочитанные для текущего пользователя
             cur.execute(f"""
                 UPDATE {SCHEMA}.ticket_comments 
@@ -4145,7 +4240,7 @@ def handle_ticket_comments_api(method: str, event: Dict[str, Any], conn, payload
             """, (ticket_id, user_id))
             conn.commit()
             
-            cur.execute(f"""
+            query = f"""
                 SELECT 
                     tc.id, tc.ticket_id, tc.user_id, tc.comment, tc.is_internal, tc.created_at,
                     tc.parent_comment_id, tc.mentioned_user_ids,
@@ -4153,31 +4248,51 @@ def handle_ticket_comments_api(method: str, event: Dict[str, Any], conn, payload
                 FROM {SCHEMA}.ticket_comments tc
                 LEFT JOIN {SCHEMA}.users u ON tc.user_id = u.id
                 WHERE tc.ticket_id = %s
-                ORDER BY tc.created_at DESC
-            """, (ticket_id,))
-            
-            comments = []
-            for row in cur.fetchall():
-                comment_id = row['id']
-                
-                # Загружаем вложения
+            """
+            params = [ticket_id]
+            if anchor:
+                query += " AND (tc.created_at, tc.id) < (%s, %s)"
+                params.extend([anchor['created_at'], anchor['id']])
+            query += " ORDER BY tc.created_at DESC, tc.id DESC"
+            if paged:
+                query += " LIMIT %s"
+                params.append(limit + 1)
+            
+            cur.execute(query, tuple(params))
+            rows = cur.fetchall()
+            has_more = paged and len(rows) > limit
+            if has_more:
+                rows = rows[:limit]
+            comment_ids = [row['id'] for row in rows]
+            
+            # Вложения и реакции загружаются одним запросом на всю страницу
+            attachments_by_comment = {}
+            reactions_by_comment = {}
+            if comment_ids:
                 cur.execute(f"""
-                    SELECT id, filename, url, size
+                    SELECT comment_id, id, filename, url, size
                     FROM {SCHEMA}.comment_attachments
-                    WHERE comment_id = %s
+                    WHERE comment_id = ANY(%s)
                     ORDER BY created_at ASC
-                """, (comment_id,))
-                attachments = [dict(a) for a in cur.fetchall()]
+                """, (comment_ids,))
+                for a in cur.fetchall():
+                    attachments_by_comment.setdefault(a['comment_id'], []).append(
+                        {'id': a['id'], 'filename': a['filename'], 'url': a['url'], 'size': a['size']}
+                    )
                 
-                # Загружаем реакции с агрегацией
                 cur.execute(f"""
-                    SELECT emoji, COUNT(*) as count, ARRAY_AGG(user_id) as users
+                    SELECT comment_id, emoji, COUNT(*) as count, ARRAY_AGG(user_id) as users
                     FROM {SCHEMA}.comment_reactions
-                    WHERE comment_id = %s
-                    GROUP BY emoji
-                """, (comment_id,))
-                reactions = [{'emoji': r['emoji'], 'count': r['count'], 'users': r['users']} for r in cur.fetchall()]
-                
+                    WHERE comment_id = ANY(%s)
+                    GROUP BY comment_id, emoji
+                """, (comment_ids,))
+                for r in cur.fetchall():
+                    reactions_by_comment.setdefault(r['comment_id'], []).append(
+                        {'emoji': r['emoji'], 'count': r['count'], 'users': r['users']}
+                    )
+            
+            comments = []
+            for row in rows:
                 comments.append({
                     'id': row['id'],
                     'ticket_id': row['ticket_id'],
@@ -4189,11 +4304,11 @@ def handle_ticket_comments_api(method: str, event: Dict[str, Any], conn, payload
                     'created_at': row['created_at'].isoformat() if row['created_at'] else None,
                     'parent_comment_id': row['parent_comment_id'],
                     'mentioned_user_ids': row['mentioned_user_ids'] or [],
-                    'attachments': attachments,
-                    'reactions': reactions
+                    'attachments': attachments_by_comment.get(row['id'], []),
+                    'reactions': reactions_by_comment.get(row['id'], [])
                 })
             
-            return response(200, {'comments': comments})
+            return response(200, {'comments': comments, 'has_more': has_more})
         
         elif method == 'POST':
             data = json.loads(event.get('body', '{}'))
@@ -4247,16 +4362,11 @@ def handle_ticket_comments_api(method: str, event: Dict[str, Any], conn, payload
                 """, (comment_id, attachment['filename'], attachment['url'], attachment['size']))
             
             # Записываем в audit_logs
-            cur.execute(f"""
-                SELECT username FROM {SCHEMA}.users WHERE id = %s
-            """, (user_id,))
-            username = cur.fetchone()['username']
-            
-            cur.execute(f"""
-                INSERT INTO {SCHEMA}.audit_logs 
-                (entity_type, entity_id, action, user_id, username, metadata)
-                VALUES ('ticket', %s, 'comment_added', %s, %s, %s::jsonb)
-            """, (ticket_id, user_id, username, json.dumps({'is_ping': is_ping})))
+            create_audit_log(
+                conn, 'ticket', ticket_id, 'comment_added', user_id,
+                get_cached_username(conn, user_id),
+                metadata={'is_ping': is_ping}
+            )
             
             conn.commit()
             
@@ -4417,8 +4527,15 @@ def handle_ticket_history(method: str, event: Dict[str, Any], conn, payload: Dic
     finally:
         cur.close()
 
+TICKETS_BULK_CHUNK_SIZE = 500
+
 def handle_tickets_bulk_actions(method: str, event: Dict[str, Any], conn, payload: Dict[str, Any]) -> Dict[str, Any]:
-    """Массовые операции над заявками"""
+    """
+    Массовые операции над заявками: set-based UPDATE/DELETE пачками по TICKETS_BULK_CHUNK_SIZE.
+    Каждая пачка коммитится отдельно, ход выполнения возвращается в chunks. Если пачка упала,
+    предыдущие уже применены: ответ 500 содержит их results и failed_from - позицию в ticket_ids,
+    с которой запрос можно повторить
+    """
     if method != 'POST':
         return response(405, {'error': 'Метод не поддерживается'})
     
@@ -4433,59 +4550,71 @@ def handle_tickets_bulk_actions(method: str, event: Dict[str, Any], conn, payloa
         if not ticket_ids or not action:
             return response(400, {'error': 'Не указаны ticket_ids или action'})
         
-        results = []
+        ticket_ids = [int(ticket_id) for ticket_id in ticket_ids]
         
         if action == 'change_status':
-            status_id = body.get('status_id')
-            if not status_id:
+            value = body.get('status_id')
+            if not value:
                 return response(400, {'error': 'Не указан status_id'})
-            
-            for ticket_id in ticket_ids:
-                try:
-                    cur.execute(
-                        f'UPDATE {SCHEMA}.tickets SET status_id = %s, updated_at = NOW() WHERE id = %s',
-                        (status_id, ticket_id)
-                    )
-                    results.append({'ticket_id': ticket_id, 'success': True})
-                except Exception as e:
-                    results.append({'ticket_id': ticket_id, 'success': False, 'error': str(e)})
-        
+            column, field = 'status_id', 'status'
         elif action == 'change_priority':
-            priority_id = body.get('priority_id')
-            if not priority_id:
+            value = body.get('priority_id')
+            if not value:
                 return response(400, {'error': 'Не указан priority_id'})
-            
-            for ticket_id in ticket_ids:
-                try:
-                    cur.execute(
-                        f'UPDATE {SCHEMA}.tickets SET priority_id = %s, updated_at = NOW() WHERE id = %s',
-                        (priority_id, ticket_id)
-                    )
-                    results.append({'ticket_id': ticket_id, 'success': True})
-                except Exception as e:
-                    results.append({'ticket_id': ticket_id, 'success': False, 'error': str(e)})
-        
+            column, field = 'priority_id', 'priority'
         elif action == 'delete':
-            for ticket_id in ticket_ids:
-                try:
-                    cur.execute(f'DELETE FROM {SCHEMA}.ticket_comments WHERE ticket_id = %s', (ticket_id,))
-                    cur.execute(f'DELETE FROM {SCHEMA}.tickets WHERE id = %s', (ticket_id,))
-                    results.append({'ticket_id': ticket_id, 'success': True})
-                except Exception as e:
-                    results.append({'ticket_id': ticket_id, 'success': False, 'error': str(e)})
-        
+            value = column = field = None
         else:
             return response(400, {'error': f'Неизвестное действие: {action}'})
         
-        conn.commit()
+        username = get_cached_username(conn, user_id)
+        new_name = get_ticket_dictionary_name(conn, field, value) if value else None
+        processed_ids = set()
+        chunks = []
         
+        def bulk_results(done: int) -> list:
+            return [
+                {'ticket_id': ticket_id, 'success': True} if ticket_id in processed_ids
+                else {'ticket_id': ticket_id, 'success': False, 'error': 'Заявка не найдена'}
+                for ticket_id in ticket_ids[:done]
+            ]
+        
+        for offset in range(0, len(ticket_ids), TICKETS_BULK_CHUNK_SIZE):
+            chunk = ticket_ids[offset:offset + TICKETS_BULK_CHUNK_SIZE]
+            try:
+                rows = apply_tickets_bulk_chunk(cur, conn, action, chunk, column, field, value,
+                                                new_name, user_id, username)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                log(f"[TICKETS BULK] {action}: chunk from {offset} failed: {e}")
+                results = bulk_results(offset)
+                return response(500, {
+                    'success': False,
+                    'error': str(e),
+                    'total': len(ticket_ids),
+                    'processed': offset,
+                    'failed_from': offset,
+                    'successful': sum(1 for r in results if r['success']),
+                    'chunks': chunks,
+                    'results': results
+                })
+            
+            processed_ids.update(row['id'] for row in rows)
+            done = min(offset + len(chunk), len(ticket_ids))
+            chunks.append({'from': offset, 'to': done, 'processed': len(rows)})
+            log(f"[TICKETS BULK] {action}: {done}/{len(ticket_ids)} processed")
+        
+        results = bulk_results(len(ticket_ids))
         success_count = sum(1 for r in results if r['success'])
         
         return response(200, {
             'success': True,
             'total': len(ticket_ids),
+            'processed': len(ticket_ids),
             'successful': success_count,
             'failed': len(ticket_ids) - success_count,
+            'chunks': chunks,
             'results': results
         })
     
@@ -4495,6 +4624,64 @@ def handle_tickets_bulk_actions(method: str, event: Dict[str, Any], conn, payloa
     finally:
         cur.close()
 
+def apply_tickets_bulk_chunk(cur, conn, action: str, chunk: list, column: Optional[str], field: Optional[str],
+                             value, new_name: Optional[str], user_id: int, username: Optional[str]) -> list:
+    """Одна пачка массовой операции; возвращает строки обработанных заявок (с полем id)"""
+    if action == 'delete':
+        cur.execute(f"""
+            DELETE FROM {SCHEMA}.comment_reactions
+            WHERE comment_id IN (SELECT id FROM {SCHEMA}.ticket_comments WHERE ticket_id = ANY(%s))
+        """, (chunk,))
+        cur.execute(f"""
+            DELETE FROM {SCHEMA}.comment_attachments
+            WHERE comment_id IN (SELECT id FROM {SCHEMA}.ticket_comments WHERE ticket_id = ANY(%s))
+        """, (chunk,))
+        cur.execute(f'DELETE FROM {SCHEMA}.ticket_comments WHERE ticket_id = ANY(%s)', (chunk,))
+        cur.execute(f'DELETE FROM {SCHEMA}.tickets WHERE id = ANY(%s) RETURNING id', (chunk,))
+        rows = cur.fetchall()
+        for row in rows:
+            create_audit_log(conn, 'ticket', row['id'], 'deleted', user_id, username,
+                             metadata={'bulk': True})
+    else:
+        cur.execute(f"""
+            UPDATE {SCHEMA}.tickets t
+            SET {column} = %s, updated_at = NOW()
+            FROM {SCHEMA}.tickets old
+            WHERE t.id = old.id AND t.id = ANY(%s) AND t.{column} IS DISTINCT FROM %s
+            RETURNING t.id, old.{column} AS old_value, t.created_by
+        """, (value, chunk, value))
+        rows = cur.fetchall()
+    
+        action_name = 'status_changed' if action == 'change_status' else 'updated'
+        for row in rows:
+            create_audit_log(
+                conn, 'ticket', row['id'], action_name, user_id, username,
+                changed_fields={field: {
+                    'old': get_ticket_dictionary_name(conn, field, row['old_value']),
+                    'new': new_name
+                }},
+                metadata={'bulk': True}
+            )
+    
+        if action == 'change_status':
+            notifications = [
+                (row['created_by'], row['id'], 'status_changed',
+                 f'Статус заявки #{row["id"]} изменён на «{new_name}»')
+                for row in rows if row['created_by'] and row['created_by'] != user_id
+            ]
+            if notifications:
+                execute_values(cur, f"""
+                    INSERT INTO {SCHEMA}.notifications (user_id, ticket_id, type, message)
+                    VALUES %s
+                """, notifications)
+    
+        # Заявки, уже имеющие нужное значение, тоже считаются обработанными
+        cur.execute(f'SELECT id FROM {SCHEMA}.tickets WHERE id = ANY(%s) AND {column} = %s', (chunk, value))
+        rows = cur.fetchall()
+    return rows
+
+NOTIFICATIONS_ARCHIVE_DAYS = int(os.environ.get('NOTIFICATIONS_ARCHIVE_DAYS', '90'))
+
 def handle_notifications(method: str, event: Dict[str, Any], conn, payload: Dict[str, Any]) -> Dict[str, Any]:
     """Управление уведомлениями пользователей"""
     user_id = payload['user_id']
@@ -4505,6 +4692,25 @@ def handle_notifications(method: str, event: Dict[str, Any], conn, payload: Dict
             params = event.get('queryStringParameters') or {}
             unread_only = params.get('unread_only') == 'true'
             limit = int(params.get('limit', 50))
+            since_id = int(params.get('since_id') or 0)
+            
+            cur.execute(f"""
+                SELECT unread_count, last_notification_id
+                FROM {SCHEMA}.notification_counters
+                WHERE user_id = %s
+            """, (user_id,))
+            counter = cur.fetchone()
+            unread_count = counter['unread_count'] if counter else 0
+            last_notification_id = counter['last_notification_id'] if counter else 0
+            
+            # Опрос колокольчика: новых уведомлений нет - ленту не читаем
+            if since_id and last_notification_id <= since_id:
+                return response(200, {
+                    'notifications': [],
+                    'unread_count': unread_count,
+                    'last_notification_id': last_notification_id,
+                    'has_more': False
+                })
             
             query = f"""
                 SELECT 
@@ -4520,25 +4726,31 @@ def handle_notifications(method: str, event: Dict[str, Any], conn, payload: Dict
                 WHERE n.user_id = %s
             """
             
+            query_params = [user_id]
             if unread_only:
                 query += " AND n.is_read = false"
+            if since_id:
+                query += " AND n.id > %s"
+                query_params.append(since_id)
+            
+            if since_id:
+                # Новые уведомления отдаются от старых к новым, чтобы при большом числе новых
+                # клиент дочитал остальные повторным запросом с since_id последнего полученного
+                query += " ORDER BY n.id ASC LIMIT %s"
+            else:
+                query += " ORDER BY n.id DESC LIMIT %s"
+            query_params.append(limit + 1)
             
-            query += " ORDER BY n.created_at DESC LIMIT %s"
-            
-            cur.execute(query, (user_id, limit))
+            cur.execute(query, query_params)
             notifications = cur.fetchall()
-            
-            cur.execute(f"""
-                SELECT COUNT(*) as unread_count
-                FROM {SCHEMA}.notifications
-                WHERE user_id = %s AND is_read = false
-            """, (user_id,))
-            
-            unread_count = cur.fetchone()['unread_count']
+            has_more = len(notifications) > limit
+            notifications = notifications[:limit]
             
             return response(200, {
                 'notifications': [dict(n) for n in notifications],
-                'unread_count': unread_count
+                'unread_count': unread_count,
+                'last_notification_id': last_notification_id,
+                'has_more': has_more
             })
         
         elif method == 'PUT':
@@ -4561,8 +4773,13 @@ def handle_notifications(method: str, event: Dict[str, Any], conn, payload: Dict
             else:
                 return response(400, {'error': 'notification_ids or mark_all is required'})
             
-            conn.commit()
             affected_rows = cur.rowcount
+            conn.commit()
+            
+            # Старые прочитанные уведомления пользователя уходят в архив
+            cur.execute(f"SELECT {SCHEMA}.archive_notifications(%s, %s) AS archived",
+                        (user_id, NOTIFICATIONS_ARCHIVE_DAYS))
+            conn.commit()
             
             return response(200, {'message': f'Отмечено как прочитанные: {affected_rows}'})
         
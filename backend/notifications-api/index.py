@@ -9,6 +9,8 @@ from psycopg2.extras import RealDictCursor
 # Environment
 SCHEMA = 't_p61788166_html_to_frontend'
 DSN = os.environ['DATABASE_URL']
+NOTIFICATIONS_PAGE_SIZE = 50
+NOTIFICATIONS_ARCHIVE_DAYS = int(os.environ.get('NOTIFICATIONS_ARCHIVE_DAYS', '90'))
 
 def response(status: int, body: Any) -> Dict[str, Any]:
     """Формирует HTTP ответ"""
@@ -47,12 +49,62 @@ def verify_token(event: Dict[str, Any], conn=None) -> tuple:
     except jwt.InvalidTokenError:
         return None, response(401, {'error': 'Invalid token'})
 
+def get_unread_counter(cur, user_id: int) -> dict:
+    """Возвращает счётчик непрочитанных и id последнего уведомления пользователя"""
+    cur.execute(f"""
+        SELECT unread_count, last_notification_id
+        FROM {SCHEMA}.notification_counters
+        WHERE user_id = %s
+    """, (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return {'unread_count': 0, 'last_notification_id': 0}
+    return dict(row)
+
+def handle_notifications_list(cur, user_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Лента уведомлений: полная (с пагинацией по before_id) или инкрементальная по since_id"""
+    limit = min(int(params.get('limit', NOTIFICATIONS_PAGE_SIZE)), 200)
+    since_id = int(params.get('since_id') or 0)
+    before_id = int(params.get('before_id') or 0)
+    
+    counter = get_unread_counter(cur, user_id)
+    
+    # Новых уведомлений нет - ленту не читаем
+    if since_id and counter['last_notification_id'] <= since_id:
+        return response(200, {'notifications': [], 'has_more': False, **counter})
+    
+    conditions = ['user_id = %s']
+    query_params = [user_id]
+    if since_id:
+        conditions.append('id > %s')
+        query_params.append(since_id)
+    if before_id:
+        conditions.append('id < %s')
+        query_params.append(before_id)
+    query_params.append(limit + 1)
+    # С since_id новые уведомления идут от старых к новым: остаток дочитывается
+    # повторным запросом с since_id последнего полученного
+    order = 'ASC' if since_id else 'DESC'
+    
+    cur.execute(f"""
+        SELECT id, user_id, type, title, message, is_read, created_at, data
+        FROM {SCHEMA}.notifications
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id {order}
+        LIMIT %s
+    """, query_params)
+    
+    notifications = [dict(row) for row in cur.fetchall()]
+    has_more = len(notifications) > limit
+    
+    return response(200, {'notifications': notifications[:limit], 'has_more': has_more, **counter})
+
 def handler(event: dict, context) -> dict:
     """
     API для уведомлений.
     
     Endpoints:
-    - GET /notifications - получить список уведомлений
+    - GET /notifications - получить список уведомлений (since_id, before_id, limit)
     - PUT /notifications/{id}/read - отметить как прочитанное
     """
     method = event.get('httpMethod', 'GET')
@@ -74,18 +126,11 @@ def handler(event: dict, context) -> dict:
         
         if method == 'GET':
             # Получить уведомления пользователя
-            cur.execute(f"""
-                SELECT id, user_id, type, title, message, is_read, created_at, data
-                FROM {SCHEMA}.notifications
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-                LIMIT 50
-            """, (user_id,))
-            
-            notifications = [dict(row) for row in cur.fetchall()]
+            params = event.get('queryStringParameters') or {}
+            result = handle_notifications_list(cur, user_id, params)
             cur.close()
             
-            return response(200, {'notifications': notifications})
+            return result
         
         elif method == 'PUT':
             # Отметить уведомление как прочитанное
@@ -108,6 +153,11 @@ def handler(event: dict, context) -> dict:
                 return response(404, {'error': 'Уведомление не найдено'})
             
             conn.commit()
+            
+            # Старые прочитанные уведомления пользователя уходят в архив
+            cur.execute(f"SELECT {SCHEMA}.archive_notifications(%s, %s) AS archived",
+                        (user_id, NOTIFICATIONS_ARCHIVE_DAYS))
+            conn.commit()
             cur.close()
             
             return response(200, {'message': 'Уведомление прочитано'})
@@ -17,10 +17,121 @@ def get_db_connection():
     """Создание подключения к БД"""
     return psycopg2.connect(DATABASE_URL)
 
+CHUNK_SIZE = int(os.environ.get('SCHEDULED_PAYMENTS_CHUNK_SIZE', '500'))
+
+def next_planned_date(current_date: datetime, recurrence_type: str):
+    """Следующая дата повторяющегося платежа"""
+    if recurrence_type == 'daily':
+        return current_date + timedelta(days=1)
+    elif recurrence_type == 'weekly':
+        return current_date + timedelta(weeks=1)
+    elif recurrence_type == 'monthly':
+        # Прибавляем месяц (приблизительно 30 дней)
+        return current_date + timedelta(days=30)
+    elif recurrence_type == 'yearly':
+        return current_date + timedelta(days=365)
+    return None
+
+def convert_chunk(cur, now_moscow: datetime, skip_ids: list) -> list:
+    """Конвертирует одну пачку просроченных запланированных платежей набором запросов.
+    Строки блокируются FOR UPDATE SKIP LOCKED, поэтому параллельные воркеры не берут одни и те же платежи."""
+    cur.execute(f"""
+        SELECT id, amount, description, planned_date, recurrence_type, recurrence_end_date
+        FROM {SCHEMA}.planned_payments
+        WHERE is_active = true
+        AND planned_date <= %s
+        AND converted_to_payment_id IS NULL
+        AND NOT (id = ANY(%s))
+        ORDER BY planned_date ASC, id ASC
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (now_moscow, skip_ids, CHUNK_SIZE))
+    planned_payments = cur.fetchall()
+    if not planned_payments:
+        return []
+    
+    cur.execute(f"""
+        SELECT nextval(pg_get_serial_sequence('{SCHEMA}.payments', 'id')) AS id
+        FROM generate_series(1, %s)
+    """, (len(planned_payments),))
+    planned_ids = [planned['id'] for planned in planned_payments]
+    payment_ids = [row['id'] for row in cur.fetchall()]
+    
+    # Создаём обычные платежи
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.payments 
+        (id, category_id, amount, description, payment_date, legal_entity_id,
+         contractor_id, department_id, service_id, invoice_number, invoice_date,
+         status, created_by, created_at, category)
+        SELECT v.payment_id, pp.category_id, pp.amount, pp.description, pp.planned_date, pp.legal_entity_id,
+               pp.contractor_id, pp.department_id, pp.service_id, pp.invoice_number, pp.invoice_date,
+               'draft', pp.created_by, %s, c.name
+        FROM unnest(%s::int[], %s::int[]) AS v(planned_id, payment_id)
+        JOIN {SCHEMA}.planned_payments pp ON pp.id = v.planned_id
+        LEFT JOIN {SCHEMA}.categories c ON c.id = pp.category_id
+    """, (now_moscow, planned_ids, payment_ids))
+    
+    # Копируем кастомные поля
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.payment_custom_field_values (payment_id, custom_field_id, value)
+        SELECT v.payment_id, f.custom_field_id, f.value
+        FROM unnest(%s::int[], %s::int[]) AS v(planned_id, payment_id)
+        JOIN {SCHEMA}.planned_payment_custom_field_values f ON f.planned_payment_id = v.planned_id
+    """, (planned_ids, payment_ids))
+    
+    # Повторяющиеся платежи переносим на следующую дату, остальные помечаем как конвертированные
+    rescheduled_ids, next_dates = [], []
+    converted_ids, converted_payment_ids, deactivate = [], [], []
+    for planned, payment_id in zip(planned_payments, payment_ids):
+        recurrence_type = planned['recurrence_type']
+        if recurrence_type and recurrence_type != 'once':
+            next_date = next_planned_date(planned['planned_date'], recurrence_type)
+            recurrence_end = planned['recurrence_end_date']
+            if next_date and (not recurrence_end or next_date.date() <= recurrence_end):
+                rescheduled_ids.append(planned['id'])
+                next_dates.append(next_date)
+                continue
+            # Период повторения закончился
+            deactivate.append(True)
+        else:
+            deactivate.append(False)
+        converted_ids.append(planned['id'])
+        converted_payment_ids.append(payment_id)
+    
+    if rescheduled_ids:
+        cur.execute(f"""
+            UPDATE {SCHEMA}.planned_payments pp
+            SET planned_date = v.next_date,
+                converted_to_payment_id = NULL,
+                converted_at = NULL
+            FROM unnest(%s::int[], %s::timestamp[]) AS v(id, next_date)
+            WHERE pp.id = v.id
+        """, (rescheduled_ids, next_dates))
+    
+    if converted_ids:
+        cur.execute(f"""
+            UPDATE {SCHEMA}.planned_payments pp
+            SET converted_to_payment_id = v.payment_id,
+                converted_at = %s,
+                is_active = pp.is_active AND NOT v.deactivate
+            FROM unnest(%s::int[], %s::int[], %s::boolean[]) AS v(id, payment_id, deactivate)
+            WHERE pp.id = v.id
+        """, (now_moscow, converted_ids, converted_payment_ids, deactivate))
+    
+    return [
+        {
+            'planned_payment_id': planned['id'],
+            'new_payment_id': payment_id,
+            'description': planned['description'],
+            'amount': float(planned['amount']),
+            'recurrence_type': planned['recurrence_type']
+        }
+        for planned, payment_id in zip(planned_payments, payment_ids)
+    ]
+
 def process_scheduled_payments() -> Dict[str, Any]:
-    """Обработка всех запланированных платежей, которые должны быть созданы"""
+    """Обработка всех запланированных платежей, которые должны быть созданы, пачками по CHUNK_SIZE"""
     conn = get_db_connection()
-    processed_count = 0
     created_payments = []
     
     moscow_tz = ZoneInfo('Europe/Moscow')
@@ -28,120 +139,17 @@ def process_scheduled_payments() -> Dict[str, Any]:
     
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Получаем все активные запланированные платежи, у которых planned_date <= сегодня
-            cur.execute(f"""
-                SELECT * FROM {SCHEMA}.planned_payments
-                WHERE is_active = true
-                AND planned_date <= %s
-                AND converted_to_payment_id IS NULL
-                ORDER BY planned_date ASC
-            """, (now_moscow,))
-            
-            planned_payments = cur.fetchall()
-            
-            for planned in planned_payments:
-                try:
-                    # Создаём обычный платёж
-                    cur.execute(f"""
-                        INSERT INTO {SCHEMA}.payments 
-                        (category_id, amount, description, payment_date, legal_entity_id,
-                         contractor_id, department_id, service_id, invoice_number, invoice_date,
-                         status, created_by, created_at, category)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'draft', %s, %s, 
-                                (SELECT name FROM {SCHEMA}.categories WHERE id = %s))
-                        RETURNING id
-                    """, (
-                        planned['category_id'],
-                        planned['amount'],
-                        planned['description'],
-                        planned['planned_date'],
-                        planned['legal_entity_id'],
-                        planned['contractor_id'],
-                        planned['department_id'],
-                        planned['service_id'],
-                        planned['invoice_number'],
-                        planned['invoice_date'],
-                        planned['created_by'],
-                        now_moscow,
-                        planned['category_id']
-                    ))
-                    
-                    new_payment_id = cur.fetchone()['id']
-                    
-                    # Копируем кастомные поля
-                    cur.execute(f"""
-                        INSERT INTO {SCHEMA}.payment_custom_field_values (payment_id, custom_field_id, value)
-                        SELECT %s, custom_field_id, value
-                        FROM {SCHEMA}.planned_payment_custom_field_values
-                        WHERE planned_payment_id = %s
-                    """, (new_payment_id, planned['id']))
-                    
-                    # Обрабатываем повторяющиеся платежи
-                    recurrence_type = planned['recurrence_type']
-                    
-                    if recurrence_type and recurrence_type != 'once':
-                        # Вычисляем следующую дату
-                        current_date = planned['planned_date']
-                        next_date = None
-                        
-                        if recurrence_type == 'daily':
-                            next_date = current_date + timedelta(days=1)
-                        elif recurrence_type == 'weekly':
-                            next_date = current_date + timedelta(weeks=1)
-                        elif recurrence_type == 'monthly':
-                            # Прибавляем месяц (приблизительно 30 дней)
-                            next_date = current_date + timedelta(days=30)
-                        elif recurrence_type == 'yearly':
-                            next_date = current_date + timedelta(days=365)
-                        
-                        # Проверяем, не закончился ли период повторения
-                        recurrence_end = planned['recurrence_end_date']
-                        if next_date and (not recurrence_end or next_date <= recurrence_end):
-                            # Обновляем дату следующего запуска
-                            cur.execute(f"""
-                                UPDATE {SCHEMA}.planned_payments 
-                                SET planned_date = %s,
-                                    converted_to_payment_id = NULL,
-                                    converted_at = NULL
-                                WHERE id = %s
-                            """, (next_date, planned['id']))
-                        else:
-                            # Период повторения закончился, помечаем как конвертированный
-                            cur.execute(f"""
-                                UPDATE {SCHEMA}.planned_payments 
-                                SET converted_to_payment_id = %s,
-                                    converted_at = %s,
-                                    is_active = false
-                                WHERE id = %s
-                            """, (new_payment_id, now_moscow, planned['id']))
-                    else:
-                        # Одноразовый платёж, помечаем как конвертированный
-                        cur.execute(f"""
-                            UPDATE {SCHEMA}.planned_payments 
-                            SET converted_to_payment_id = %s,
-                                converted_at = %s
-                            WHERE id = %s
-                        """, (new_payment_id, now_moscow, planned['id']))
-                    
-                    processed_count += 1
-                    created_payments.append({
-                        'planned_payment_id': planned['id'],
-                        'new_payment_id': new_payment_id,
-                        'description': planned['description'],
-                        'amount': float(planned['amount']),
-                        'recurrence_type': recurrence_type
-                    })
-                    
-                except Exception as e:
-                    # Логируем ошибку, но продолжаем обработку остальных
-                    print(f"Error processing planned payment {planned['id']}: {str(e)}")
-                    continue
-            
-            conn.commit()
+            # Каждая пачка — отдельная транзакция; платёж конвертируется не более одного раза за запуск
+            while True:
+                chunk = convert_chunk(cur, now_moscow, [p['planned_payment_id'] for p in created_payments])
+                conn.commit()
+                created_payments.extend(chunk)
+                if len(chunk) < CHUNK_SIZE:
+                    break
             
             return {
                 'success': True,
-                'processed_count': processed_count,
+                'processed_count': len(created_payments),
                 'created_payments': created_payments,
                 'timestamp': datetime.now().isoformat()
             }
@@ -1,6 +1,66 @@
 import json
 import os
-from typing import Dict, Any
+import re
+from typing import Dict, Any, List, Optional
+
+# Варианты, которые создаёт upload-image, в порядке возрастания размера
+IMAGE_VARIANTS = ['thumb', 'card', 'full']
+VARIANT_URL_RE = re.compile(r'^.+/products/(?P<image_id>[0-9a-f]{64})/(?:thumb|card|full)\.(?:jpg|webp)$')
+
+
+def upload_image_id(url: Optional[str]) -> Optional[str]:
+    '''image_id (хеш содержимого) из URL варианта upload-image: .../products/{image_id}/{вариант}.{jpg|webp}'''
+    match = VARIANT_URL_RE.match(url or '')
+    return match.group('image_id') if match else None
+
+
+def load_upload_variants(cur, urls: List[Optional[str]]) -> Dict[str, Dict[str, Any]]:
+    '''
+    Варианты загрузок из image_uploads.result по image_id, одним запросом.
+    Там записаны фактические размеры файлов - они зависят от исходника и max_width,
+    поэтому по одному URL ширину не восстановить.
+    '''
+    image_ids = list({image_id for image_id in map(upload_image_id, urls) if image_id})
+    if not image_ids:
+        return {}
+    cur.execute(
+        "SELECT content_hash, result -> 'variants' AS variants FROM image_uploads WHERE content_hash = ANY(%s)",
+        (image_ids,)
+    )
+    return {row['content_hash']: row['variants'] for row in cur.fetchall() if row['variants']}
+
+
+def image_variants(image: Dict[str, Any], uploads: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    '''
+    Варианты изображения: переданные клиентом либо, если клиент прислал только image_url от upload-image,
+    записанные upload-image для этой загрузки. Неизвестная загрузка - без вариантов.
+    '''
+    variants = image.get('variants')
+    if isinstance(variants, dict) and variants:
+        return variants
+    return uploads.get(upload_image_id(image.get('image_url')))
+
+
+def variants_sql(image: Dict[str, Any], uploads: Dict[str, Dict[str, Any]]) -> str:
+    variants = image_variants(image, uploads)
+    if not variants:
+        return 'NULL'
+    return "'" + json.dumps(variants).replace("'", "''") + "'::jsonb"
+
+
+def build_srcset(variants: Optional[Dict[str, Any]], fmt: str) -> Optional[str]:
+    '''srcset вида "url 320w, url 640w, url 1920w" для формата jpeg или webp'''
+    if not variants:
+        return None
+    seen = set()
+    parts = []
+    for name in IMAGE_VARIANTS:
+        variant = variants.get(name) or {}
+        if not variant.get(fmt) or not variant.get('width') or variant['width'] in seen:
+            continue
+        seen.add(variant['width'])
+        parts.append(f"{variant[fmt]} {variant['width']}w")
+    return ', '.join(parts) or None
 
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -93,7 +153,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             ids_str = ','.join(map(str, product_ids))
             
             cur.execute(
-                f"""SELECT id, product_id, image_url, is_primary, sort_order, width, height, object_fit 
+                f"""SELECT id, product_id, image_url, is_primary, sort_order, width, height, object_fit, variants 
                    FROM product_images 
                    WHERE product_id IN ({ids_str}) AND image_url != '' AND image_url IS NOT NULL
                    ORDER BY product_id, sort_order"""
@@ -108,12 +168,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             all_variants = cur.fetchall()
             
+            uploads = load_upload_variants(cur, [p.get('image_url') for p in products_list])
+            
             images_by_product = {}
             for img in all_images:
                 pid = img['product_id']
                 if pid not in images_by_product:
                     images_by_product[pid] = []
-                images_by_product[pid].append(dict(img))
+                image = dict(img)
+                variants = image.get('variants')
+                image['srcset'] = build_srcset(variants, 'jpeg')
+                image['srcset_webp'] = build_srcset(variants, 'webp')
+                image['thumb_url'] = ((variants or {}).get('thumb') or {}).get('jpeg') or image['image_url']
+                images_by_product[pid].append(image)
             
             variants_by_product = {}
             for var in all_variants:
@@ -125,6 +192,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             for product in products_list:
                 product['images'] = images_by_product.get(product['id'], [])
                 product['variants'] = variants_by_product.get(product['id'], [])
+                main_variants = image_variants({'image_url': product.get('image_url')}, uploads)
+                product['image_srcset'] = build_srcset(main_variants, 'jpeg')
+                product['image_srcset_webp'] = build_srcset(main_variants, 'webp')
             
             return {
                 'statusCode': 200,
@@ -162,6 +232,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             product = cur.fetchone()
             product_id = product['id']
             
+            uploads = load_upload_variants(cur, [image.get('image_url') for image in images])
             for image in images:
                 img_url = image['image_url'].replace("'", "''")
                 is_primary = 'TRUE' if image.get('is_primary', False) else 'FALSE'
@@ -172,8 +243,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 width_sql = str(width) if width else 'NULL'
                 height_sql = str(height) if height else 'NULL'
                 cur.execute(
-                    f"""INSERT INTO product_images (product_id, image_url, is_primary, sort_order, width, height, object_fit) 
-                       VALUES ({product_id}, '{img_url}', {is_primary}, {sort_order}, {width_sql}, {height_sql}, '{object_fit}')"""
+                    f"""INSERT INTO product_images (product_id, image_url, is_primary, sort_order, width, height, object_fit, variants) 
+                       VALUES ({product_id}, '{img_url}', {is_primary}, {sort_order}, {width_sql}, {height_sql}, '{object_fit}', {variants_sql(image, uploads)})"""
                 )
             
             for variant in variants:
@@ -228,6 +299,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             cur.execute(f"SELECT id FROM product_images WHERE product_id = {product_id}")
             existing_ids = [row['id'] for row in cur.fetchall()]
             
+            uploads = load_upload_variants(cur, [image.get('image_url') for image in images])
             for image in images:
                 img_url = image['image_url'].replace("'", "''")
                 is_primary = 'TRUE' if image.get('is_primary', False) else 'FALSE'
@@ -242,14 +314,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     cur.execute(
                         f"""UPDATE product_images 
                            SET image_url = '{img_url}', is_primary = {is_primary}, sort_order = {sort_order}, 
-                               width = {width_sql}, height = {height_sql}, object_fit = '{object_fit}'
+                               width = {width_sql}, height = {height_sql}, object_fit = '{object_fit}',
+                               variants = {variants_sql(image, uploads)}
                            WHERE id = {image['id']}"""
                     )
                     existing_ids.remove(image['id'])
                 else:
                     cur.execute(
-                        f"""INSERT INTO product_images (product_id, image_url, is_primary, sort_order, width, height, object_fit) 
-                           VALUES ({product_id}, '{img_url}', {is_primary}, {sort_order}, {width_sql}, {height_sql}, '{object_fit}')"""
+                        f"""INSERT INTO product_images (product_id, image_url, is_primary, sort_order, width, height, object_fit, variants) 
+                           VALUES ({product_id}, '{img_url}', {is_primary}, {sort_order}, {width_sql}, {height_sql}, '{object_fit}', {variants_sql(image, uploads)})"""
                     )
             
             for old_id in existing_ids:
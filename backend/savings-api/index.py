@@ -12,6 +12,7 @@ from pydantic import BaseModel, Field
 # Environment
 SCHEMA = 't_p61788166_html_to_frontend'
 DSN = os.environ['DATABASE_URL']
+PAGE_SIZE = 50
 
 def response(status: int, body: Any) -> Dict[str, Any]:
     """Формирует HTTP ответ"""
@@ -128,6 +129,11 @@ def handle_savings_get(event: Dict[str, Any], conn, path: str) -> Dict[str, Any]
         service_id = query_params.get('service_id')
         employee_id = query_params.get('employee_id')
         saving_reason_id = query_params.get('saving_reason_id')
+        date_from = query_params.get('date_from')
+        date_to = query_params.get('date_to')
+        # Keyset-пагинация включается параметром limit или cursor (created_at|id последней записи)
+        cursor = query_params.get('cursor')
+        limit = int(query_params['limit']) if query_params.get('limit') else (PAGE_SIZE if cursor else None)
         
         query = f"""
             SELECT s.id, s.service_id, s.description, s.amount, s.frequency, 
@@ -157,32 +163,109 @@ def handle_savings_get(event: Dict[str, Any], conn, path: str) -> Dict[str, Any]
             query += " AND s.saving_reason_id = %s"
             params.append(int(saving_reason_id))
         
-        query += " ORDER BY s.created_at DESC"
+        if date_from:
+            query += " AND s.created_at >= %s"
+            params.append(date_from)
+        
+        if date_to:
+            query += " AND s.created_at < %s::date + INTERVAL '1 day'"
+            params.append(date_to)
+        
+        if cursor:
+            try:
+                cursor_created_at, cursor_id = cursor.rsplit('|', 1)
+                query += " AND (s.created_at, s.id) < (%s, %s)"
+                params.extend([datetime.fromisoformat(cursor_created_at), int(cursor_id)])
+            except ValueError:
+                cur.close()
+                return response(400, {'error': 'Invalid cursor'})
+        
+        query += " ORDER BY s.created_at DESC, s.id DESC"
+        if limit:
+            query += " LIMIT %s"
+            params.append(limit + 1)
         
         cur.execute(query, params)
         savings = [dict(row) for row in cur.fetchall()]
+        next_cursor = None
+        if limit and len(savings) > limit:
+            savings = savings[:limit]
+            next_cursor = f"{savings[-1]['created_at'].isoformat()}|{savings[-1]['id']}"
         
-        # Получаем статистику
+        # Статистика берётся из агрегата savings_summary, поддерживаемого триггером
         cur.execute(f"""
             SELECT 
-                COUNT(*) as total_count,
-                SUM(CASE 
-                    WHEN frequency = 'once' THEN amount
-                    WHEN frequency = 'monthly' THEN amount * 12
-                    WHEN frequency = 'quarterly' THEN amount * 4
-                    WHEN frequency = 'yearly' THEN amount
-                    ELSE 0
-                END) as total_annual_savings
-            FROM {SCHEMA}.savings
+                COALESCE(SUM(savings_count), 0) as total_count,
+                SUM(total_annual_amount) as total_annual_savings
+            FROM {SCHEMA}.savings_summary
         """)
         
         stats = cur.fetchone()
         cur.close()
         
-        return response(200, {
+        result = {
             'savings': savings,
             'stats': dict(stats) if stats else {'total_count': 0, 'total_annual_savings': 0}
-        })
+        }
+        if limit:
+            result['next_cursor'] = next_cursor
+        return response(200, result)
+
+def handle_savings_summary(event: Dict[str, Any], conn) -> Dict[str, Any]:
+    """Итоги экономий по причинам, услугам и месяцам из агрегата savings_summary"""
+    query_params = event.get('queryStringParameters', {}) or {}
+    conditions = ["ss.savings_count <> 0"]
+    params = []
+    
+    if query_params.get('service_id'):
+        conditions.append("ss.service_id = %s")
+        params.append(int(query_params['service_id']))
+    if query_params.get('saving_reason_id'):
+        conditions.append("ss.saving_reason_id = %s")
+        params.append(int(query_params['saving_reason_id']))
+    if query_params.get('date_from'):
+        conditions.append("ss.month >= date_trunc('month', %s::date)")
+        params.append(query_params['date_from'])
+    if query_params.get('date_to'):
+        conditions.append("ss.month <= %s::date")
+        params.append(query_params['date_to'])
+    
+    where = ' AND '.join(conditions)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    groupings = {
+        'by_reason': ("ss.saving_reason_id, sr.name", f"LEFT JOIN {SCHEMA}.saving_reasons sr ON sr.id = ss.saving_reason_id",
+                      "ss.saving_reason_id as saving_reason_id, sr.name as saving_reason_name"),
+        'by_service': ("ss.service_id, srv.name", f"LEFT JOIN {SCHEMA}.services srv ON srv.id = ss.service_id",
+                       "ss.service_id as service_id, srv.name as service_name"),
+        'by_month': ("ss.month", "", "ss.month as month"),
+    }
+    summary = {}
+    for key, (group_by, join, columns) in groupings.items():
+        cur.execute(f"""
+            SELECT {columns},
+                   SUM(ss.savings_count) as total_count,
+                   SUM(ss.total_amount) as total_amount,
+                   SUM(ss.total_annual_amount) as total_annual_savings
+            FROM {SCHEMA}.savings_summary ss
+            {join}
+            WHERE {where}
+            GROUP BY {group_by}
+            ORDER BY {'ss.month' if key == 'by_month' else 'total_annual_savings DESC'}
+        """, params)
+        summary[key] = [dict(row) for row in cur.fetchall()]
+    
+    cur.execute(f"""
+        SELECT COALESCE(SUM(ss.savings_count), 0) as total_count,
+               SUM(ss.total_amount) as total_amount,
+               SUM(ss.total_annual_amount) as total_annual_savings
+        FROM {SCHEMA}.savings_summary ss
+        WHERE {where}
+    """, params)
+    summary['totals'] = dict(cur.fetchone())
+    cur.close()
+    
+    return response(200, summary)
 
 def handle_saving_reasons_get(event: Dict[str, Any], conn) -> Dict[str, Any]:
     """Получение причин экономий"""
@@ -206,6 +289,7 @@ def handler(event: dict, context) -> dict:
     Endpoints:
     - GET /savings - список всех экономий
     - GET /savings/{id} - получить конкретную экономию
+    - GET ?endpoint=summary - итоги по причинам, услугам и месяцам
     - POST /savings - создать экономию
     - PUT /savings/{id} - обновить экономию
     - DELETE /savings/{id} - удалить экономию
@@ -235,6 +319,14 @@ def handler(event: dict, context) -> dict:
             else:
                 endpoint = 'savings'
         
+        if endpoint == 'summary':
+            if method != 'GET':
+                return response(405, {'error': 'Method not allowed'})
+            payload, error = verify_token_and_permission(event, conn, 'savings:read')
+            if error:
+                return error
+            return handle_savings_summary(event, conn)
+        
         if endpoint in ['reasons', 'saving-reasons']:
             # /reasons endpoint
             if method == 'GET':
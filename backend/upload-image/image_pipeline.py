@@ -0,0 +1,135 @@
+"""
+Обработка изображений для upload-image: поворот по EXIF, белый фон вместо прозрачности,
+варианты thumb/card/full в JPEG и WebP.
+
+Функции уровня модуля и без обращений к сети - их можно выполнять в пуле процессов
+(index.py загружается адаптером docker/server.py не как обычный модуль и не сериализуется).
+"""
+import hashlib
+from io import BytesIO
+from typing import Any, Dict, List, Tuple
+
+# Варианты изображения: имя → максимальная сторона в пикселях.
+# Ключи в хранилище предсказуемы: products/{content_hash}/{имя}.{jpg|webp}
+VARIANTS: List[Tuple[str, int]] = [
+    ('thumb', 320),
+    ('card', 640),
+    ('full', 1920),
+]
+FORMATS = (
+    ('jpg', 'JPEG', 'image/jpeg'),
+    ('webp', 'WEBP', 'image/webp'),
+)
+
+
+class InvalidImage(ValueError):
+    """Данные не удалось прочитать как изображение"""
+
+
+def normalize_image(img):
+    """Поворот по EXIF и приведение к RGB с белым фоном вместо прозрачности"""
+    from PIL import Image, ImageOps
+
+    if hasattr(img, '_getexif') and img._getexif() is not None:
+        img = ImageOps.exif_transpose(img)
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def fit_size(width: int, height: int, max_width: int, max_height: int) -> Tuple[int, int]:
+    if width <= max_width and height <= max_height:
+        return width, height
+    ratio = min(max_width / width, max_height / height)
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def build_variants(img, max_width: int, max_height: int, quality: int) -> List[Dict[str, Any]]:
+    """
+    Кодирует все варианты в JPEG и WebP.
+    Каждый следующий (меньший) вариант масштабируется из предыдущего, а не из оригинала.
+    """
+    from PIL import Image
+
+    variants = []
+    source = img
+    for name, limit in reversed(VARIANTS):
+        if name == 'full':
+            width, height = fit_size(source.width, source.height, max_width, max_height)
+        else:
+            width, height = fit_size(source.width, source.height, limit, limit)
+        if (width, height) != source.size:
+            source = source.resize((width, height), Image.Resampling.LANCZOS)
+
+        encoded = {}
+        for ext, pil_format, content_type in FORMATS:
+            output = BytesIO()
+            if pil_format == 'JPEG':
+                source.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+            else:
+                source.save(output, format='WEBP', quality=quality, method=4)
+            encoded[ext] = (output.getvalue(), content_type)
+
+        variants.append({'name': name, 'width': width, 'height': height, 'files': encoded})
+    variants.reverse()
+    return variants
+
+
+def params_signature(max_width: int, max_height: int, quality: int) -> bytes:
+    """Параметры кодирования и набор вариантов входят в хеш - при их изменении файлы пересоздаются"""
+    variants = ','.join(f'{name}:{limit}' for name, limit in VARIANTS)
+    return f'{max_width}x{max_height}q{quality}|{variants}|'.encode()
+
+
+def source_hash(image_bytes: bytes, max_width: int, max_height: int, quality: int) -> str:
+    """Хеш исходных байтов - повторная загрузка того же файла находится без декодирования"""
+    digest = hashlib.sha256(params_signature(max_width, max_height, quality))
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+def pixels_hash(img, max_width: int, max_height: int, quality: int) -> str:
+    """
+    Хеш нормализованного изображения (пиксели после поворота по EXIF и удаления прозрачности).
+    Совпадает у одной и той же фотографии, пересохранённой с другими метаданными.
+    """
+    digest = hashlib.sha256(params_signature(max_width, max_height, quality))
+    digest.update(f'{img.width}x{img.height}|'.encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def encode_image(image_bytes: bytes, max_width: int, max_height: int,
+                 quality: int) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Полный цикл обработки загруженных байтов за одно декодирование:
+    возвращает хеш нормализованного изображения и закодированные варианты.
+    Ошибки чтения - InvalidImage.
+    """
+    from PIL import Image
+
+    try:
+        img = normalize_image(Image.open(BytesIO(image_bytes)))
+        return pixels_hash(img, max_width, max_height, quality), build_variants(img, max_width, max_height, quality)
+    except Exception as e:
+        raise InvalidImage(str(e)) from None
+
+
+def build_srcset(variants: Dict[str, Dict[str, Any]], ext: str) -> str:
+    """srcset из вариантов: "url 320w, url 640w, ..." без повторов одинаковой ширины"""
+    seen = set()
+    parts = []
+    for name, _ in VARIANTS:
+        variant = variants.get(name)
+        if not variant or not variant.get(ext) or variant['width'] in seen:
+            continue
+        seen.add(variant['width'])
+        parts.append(f"{variant[ext]} {variant['width']}w")
+    return ', '.join(parts)
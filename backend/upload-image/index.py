@@ -2,167 +2,564 @@ import json
 import base64
 import uuid
 import os
-from typing import Dict, Any
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional, Tuple
+
+from image_pipeline import InvalidImage, build_srcset, encode_image, source_hash
+
+# Кодирование вариантов в пуле процессов. По умолчанию 1 - в процессе обработчика:
+# под docker/server.py пул форкал бы многопоточный процесс uvicorn целиком
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '1'))
+# Параллельные загрузки вариантов в хранилище и фоновые задачи
+IMAGE_UPLOAD_THREADS = int(os.environ.get('IMAGE_UPLOAD_THREADS', '8'))
+IMAGE_JOB_THREADS = int(os.environ.get('IMAGE_JOB_THREADS', '4'))
+# Задача в processing без обновлений дольше этого срока считается потерянной (инстанс остановлен)
+IMAGE_JOB_TIMEOUT = int(os.environ.get('IMAGE_JOB_TIMEOUT', '300'))
+# Задачу, которую не взял в работу создавший её инстанс, через столько секунд продолжает опрос статуса
+IMAGE_JOB_RESUME_AFTER = int(os.environ.get('IMAGE_JOB_RESUME_AFTER', '15'))
+IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get('IMAGE_JOB_MAX_ATTEMPTS', '3'))
+# Сборка мусора не трогает файлы моложе этого срока: товар ещё может быть не сохранён
+IMAGE_GC_MIN_AGE_HOURS = int(os.environ.get('IMAGE_GC_MIN_AGE_HOURS', '24'))
+IMAGE_JOBS_RETENTION_DAYS = int(os.environ.get('IMAGE_JOBS_RETENTION_DAYS', '7'))
+
+_s3_client = None
+_image_pool: Optional[ProcessPoolExecutor] = None
+_upload_pool: Optional[ThreadPoolExecutor] = None
+_job_runner: Optional[ThreadPoolExecutor] = None
+
+CORS_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+def json_response(status: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': CORS_HEADERS,
+        'body': json.dumps(payload, default=str),
+        'isBase64Encoded': False
+    }
+
+
+def get_s3():
+    '''Клиент S3 создаётся один раз на инстанс и переиспользуется между вызовами'''
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+
+        # ⚠️ CRITICAL: Используем ТОЛЬКО эти env переменные и endpoint!
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url='https://bucket.poehali.dev',  # ⚠️ ТОЛЬКО ЭТОТ URL!
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(max_pool_connections=IMAGE_UPLOAD_THREADS * 2)
+        )
+    return _s3_client
+
+
+def get_image_pool() -> Optional[ProcessPoolExecutor]:
+    '''Пул процессов для кодирования, переиспользуется между вызовами; None - если недоступен'''
+    global _image_pool
+    if _image_pool is None and IMAGE_WORKERS > 1:
+        try:
+            pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+            # Процессы стартуют лениво - проверяем, что среда их поддерживает
+            pool.submit(int).result()
+            _image_pool = pool
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            print(f"[UPLOAD-IMAGE] Process pool unavailable, encoding in-process: {e}")
+            return None
+    return _image_pool
+
+
+def get_upload_pool() -> ThreadPoolExecutor:
+    global _upload_pool
+    if _upload_pool is None:
+        _upload_pool = ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_THREADS)
+    return _upload_pool
+
+
+def get_job_runner() -> ThreadPoolExecutor:
+    global _job_runner
+    if _job_runner is None:
+        _job_runner = ThreadPoolExecutor(max_workers=IMAGE_JOB_THREADS)
+    return _job_runner
+
+
+def decode_image(image_data: str) -> bytes:
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data)
+
+
+def encode_params(body_data: Dict[str, Any]) -> Dict[str, int]:
+    # Параметры оптимизации из body (если переданы) относятся к варианту full
+    return {
+        'max_width': int(body_data.get('max_width', 1920)),
+        'max_height': int(body_data.get('max_height', 1920)),
+        'quality': int(body_data.get('quality', 85)),
+    }
+
+
+def run_encoder(fn, *args):
+    '''Выполняет функцию из image_pipeline в пуле процессов, если он доступен'''
+    pool = get_image_pool()
+    if pool is None:
+        return fn(*args)
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        return fn(*args)
+
+
+def find_upload(cur, by_source: Optional[str] = None, by_content: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''Ранее загруженное изображение с тем же хешем; отметка last_used_at защищает его от сборки мусора'''
+    column, value = ('source_hash', by_source) if by_source else ('content_hash', by_content)
+    cur.execute(
+        f"""UPDATE image_uploads SET last_used_at = CURRENT_TIMESTAMP
+            WHERE content_hash = (SELECT content_hash FROM image_uploads WHERE {column} = %s LIMIT 1)
+            RETURNING result""",
+        (value,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def process_image(image_bytes: bytes, params: Dict[str, int]) -> Dict[str, Any]:
+    '''
+    Кодирует варианты (в пуле процессов, если он доступен) и загружает их параллельно
+    общим клиентом S3. Возвращает тело успешного ответа.
+
+    Файлы адресуются хешем нормализованного изображения: products/{content_hash}/...
+    Повторная загрузка того же файла находится по хешу байтов до декодирования - кодирование
+    и загрузка в хранилище пропускаются. Та же фотография в другом файле узнаётся по хешу
+    пикселей, который считается в том же проходе, что и варианты: изображение декодируется
+    один раз, а пропускается только запись в хранилище. Без базы данных дедупликация отключается.
+    '''
+    args = (image_bytes, params['max_width'], params['max_height'], params['quality'])
+    by_source = source_hash(*args)
+
+    conn = None
+    try:
+        conn = get_connection()
+        conn.autocommit = True
+        cached = find_upload(conn.cursor(), by_source=by_source)
+        if cached:
+            conn.close()
+            return {**cached, 'deduplicated': True}
+    except Exception as e:
+        print(f"[UPLOAD-IMAGE] Deduplication disabled, database unavailable: {e}")
+        if conn:
+            conn.close()
+        conn = None
+
+    try:
+        image_id, variants = run_encoder(encode_image, *args)
+
+        if conn:
+            try:
+                cached = find_upload(conn.cursor(), by_content=image_id)
+                if cached:
+                    return {**cached, 'deduplicated': True}
+            except Exception as e:
+                print(f"[UPLOAD-IMAGE] Deduplication disabled, database unavailable: {e}")
+                conn.close()
+                conn = None
+
+        result = upload_variants(image_id, variants)
+        if conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """INSERT INTO image_uploads (content_hash, source_hash, result)
+                           VALUES (%s, %s, %s)
+                           ON CONFLICT (content_hash) DO UPDATE SET last_used_at = CURRENT_TIMESTAMP""",
+                        (image_id, by_source, json.dumps(result))
+                    )
+            except Exception as e:
+                # Файлы уже в хранилище; без записи следующая такая загрузка просто не дедуплицируется
+                print(f"[UPLOAD-IMAGE] Could not save upload hash: {e}")
+        return {**result, 'deduplicated': False}
+    finally:
+        if conn:
+            conn.close()
+
+
+def upload_variants(image_id: str, variants: List[Dict[str, Any]]) -> Dict[str, Any]:
+    s3 = get_s3()
+    # ⚠️ CDN URL: использовать AWS_ACCESS_KEY_ID (НЕ PROJECT_ID!)
+    cdn_prefix = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket"
+
+    variant_urls: Dict[str, Dict[str, Any]] = {}
+    uploads = []
+    for variant in variants:
+        urls: Dict[str, Any] = {'width': variant['width'], 'height': variant['height']}
+        for ext, (data, content_type) in variant['files'].items():
+            key = f"products/{image_id}/{variant['name']}.{ext}"
+            # ⚠️ Bucket ВСЕГДА 'files'!
+            uploads.append(get_upload_pool().submit(
+                s3.put_object,
+                Bucket='files',
+                Key=key,
+                Body=data,
+                ContentType=content_type,
+                CacheControl='public, max-age=31536000, immutable'
+            ))
+            urls['jpeg' if ext == 'jpg' else ext] = f"{cdn_prefix}/{key}"
+        variant_urls[variant['name']] = urls
+    for upload in uploads:
+        upload.result()
+
+    full = variant_urls['full']
+    return {
+        'success': True,
+        'url': full['jpeg'],
+        'image_id': image_id,
+        'optimized_size': f"{full['width']}x{full['height']}",
+        'width': full['width'],
+        'height': full['height'],
+        'variants': variant_urls,
+        'srcset': build_srcset(variant_urls, 'jpeg'),
+        'srcset_webp': build_srcset(variant_urls, 'webp')
+    }
+
+
+def get_connection():
+    import psycopg2
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def store_sources(job_ids: List[str], sources: List[bytes]) -> List[str]:
+    '''Исходники фоновых задач кладутся в бакет, чтобы задачу мог продолжить любой вызов'''
+    s3 = get_s3()
+    keys = [f"uploads/{job_id}" for job_id in job_ids]
+    uploads = [
+        get_upload_pool().submit(s3.put_object, Bucket='files', Key=key, Body=data,
+                                 ContentType='application/octet-stream')
+        for key, data in zip(keys, sources)
+    ]
+    for upload in uploads:
+        upload.result()
+    return keys
+
+
+def create_jobs(job_ids: List[str], source_keys: List[str], params: Dict[str, int]) -> None:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            from psycopg2.extras import execute_values
+            execute_values(
+                cur,
+                "INSERT INTO image_jobs (id, status, source_key, params) VALUES %s",
+                [(job_id, 'queued', key, json.dumps(params)) for job_id, key in zip(job_ids, source_keys)]
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def claim_job(job_id: str, queued_after: int) -> Optional[Tuple[str, Dict[str, int]]]:
+    '''
+    Атомарно переводит задачу в processing и возвращает (source_key, params).
+    Берётся задача в очереди дольше queued_after секунд или брошенная в processing;
+    None - если её уже обрабатывает другой вызов, она завершена или попытки исчерпаны.
+    '''
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE image_jobs
+                   SET status = 'processing', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                   WHERE id = %s AND source_key IS NOT NULL AND attempts < %s
+                     AND ((status = 'queued' AND updated_at <= CURRENT_TIMESTAMP - make_interval(secs => %s))
+                          OR (status = 'processing' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+                   RETURNING source_key, params""",
+                (job_id, IMAGE_JOB_MAX_ATTEMPTS, queued_after, IMAGE_JOB_TIMEOUT)
+            )
+            row = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return (row[0], row[1]) if row else None
+
+
+def update_job(job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE image_jobs
+                   SET status = %s, result = %s, error = %s, updated_at = CURRENT_TIMESTAMP
+                   WHERE id = %s""",
+                (status, json.dumps(result) if result is not None else None, error, job_id)
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_job(job_id: str, image_bytes: Optional[bytes] = None, queued_after: int = 0) -> None:
+    '''
+    Обработка одной загрузки; итог пишется в image_jobs. Исходник читается из бакета,
+    если вызов его не получил (задачу продолжает другой инстанс), и удаляется после завершения.
+    '''
+    claimed = claim_job(job_id, queued_after)
+    if not claimed:
+        return
+    source_key, params = claimed
+    try:
+        if image_bytes is None:
+            image_bytes = get_s3().get_object(Bucket='files', Key=source_key)['Body'].read()
+        update_job(job_id, 'done', result=process_image(image_bytes, params))
+    except InvalidImage as e:
+        update_job(job_id, 'failed', error=f'Invalid image format: {str(e)}')
+    except Exception as e:
+        print(f"[UPLOAD-IMAGE] Job {job_id} failed: {e}")
+        try:
+            update_job(job_id, 'failed', error=f'Upload failed: {str(e)}')
+        except Exception as db_error:
+            # Статус не сохранён - исходник остаётся, задачу продолжит следующий опрос
+            print(f"[UPLOAD-IMAGE] Could not save status of job {job_id}: {db_error}")
+            return
+    try:
+        get_s3().delete_object(Bucket='files', Key=source_key)
+    except Exception as e:
+        print(f"[UPLOAD-IMAGE] Could not delete source of job {job_id}: {e}")
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    '''Статус задачи; задачи, брошенные после всех попыток, помечаются как failed'''
+    from psycopg2.extras import RealDictCursor
+
+    conn = get_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """UPDATE image_jobs
+                   SET status = 'failed', error = 'Processing timed out', updated_at = CURRENT_TIMESTAMP
+                   WHERE id = %s AND status IN ('queued', 'processing')
+                     AND (attempts >= %s OR source_key IS NULL)
+                     AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)""",
+                (job_id, IMAGE_JOB_MAX_ATTEMPTS, IMAGE_JOB_TIMEOUT)
+            )
+            cur.execute(
+                "SELECT id, status, result, error, created_at, updated_at FROM image_jobs WHERE id = %s",
+                (job_id,)
+            )
+            job = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return dict(job) if job else None
+
+
+def object_key(url: Optional[str]) -> Optional[str]:
+    '''Ключ в бакете из CDN URL (.../bucket/{key})'''
+    if not url or '/bucket/' not in url:
+        return None
+    return url.split('/bucket/', 1)[1].split('?', 1)[0]
+
+
+def collect_referenced_keys(cur) -> Tuple[set, set]:
+    '''
+    Ключи, на которые ссылаются товары и галерея, и каталоги products/{image_id}/ новых загрузок.
+    Каталог сохраняется целиком: srcset собирается из всех вариантов по предсказуемым ключам.
+    Недавно найденные дедупликацией загрузки тоже считаются используемыми.
+    '''
+    cur.execute(
+        """SELECT image_url AS url FROM product_images
+           UNION SELECT v.value ->> f.fmt FROM product_images pi,
+                  jsonb_each(COALESCE(pi.variants, '{}'::jsonb)) v, (VALUES ('jpeg'), ('webp')) f(fmt)
+           UNION SELECT image_url FROM products
+           UNION SELECT image_url FROM gallery_images"""
+    )
+    keys = set()
+    dirs = set()
+    for row in cur.fetchall():
+        key = object_key(row[0])
+        if not key:
+            continue
+        keys.add(key)
+        dirs.add(key.rsplit('/', 1)[0] + '/')
+
+    cur.execute(
+        "SELECT content_hash FROM image_uploads WHERE last_used_at > CURRENT_TIMESTAMP - make_interval(hours => %s)",
+        (IMAGE_GC_MIN_AGE_HOURS,)
+    )
+    dirs.update(f"products/{row[0]}/" for row in cur.fetchall())
+    # Старые загрузки лежат прямо в products/ - их защищает только точный ключ
+    dirs.discard('products/')
+    return keys, dirs
+
+
+def collect_garbage(conn, dry_run: bool) -> Dict[str, Any]:
+    '''
+    Удаляет из products/ файлы, на которые не ссылаются product_images, products и gallery_images,
+    старше IMAGE_GC_MIN_AGE_HOURS. В режиме dry_run только возвращает список кандидатов.
+    '''
+    from datetime import datetime, timedelta, timezone
+
+    with conn.cursor() as cur:
+        keys, dirs = collect_referenced_keys(cur)
+
+    s3 = get_s3()
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=IMAGE_GC_MIN_AGE_HOURS)
+    scanned = 0
+    garbage = []
+    freed = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket='files', Prefix='products/'):
+        for obj in page.get('Contents', []):
+            scanned += 1
+            key = obj['Key']
+            if key in keys or obj['LastModified'] >= cutoff:
+                continue
+            if key.count('/') > 1 and key.rsplit('/', 1)[0] + '/' in dirs:
+                continue
+            garbage.append(key)
+            freed += obj.get('Size', 0)
+
+    if not dry_run:
+        for offset in range(0, len(garbage), 1000):
+            batch = garbage[offset:offset + 1000]
+            s3.delete_objects(Bucket='files', Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+        removed_hashes = list({key.split('/')[1] for key in garbage if key.count('/') > 1})
+        with conn.cursor() as cur:
+            if removed_hashes:
+                cur.execute("DELETE FROM image_uploads WHERE content_hash = ANY(%s)", (removed_hashes,))
+            cur.execute(
+                """DELETE FROM image_jobs WHERE created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+                   RETURNING source_key""",
+                (IMAGE_JOBS_RETENTION_DAYS,)
+            )
+            # Исходники задач, которые так и не завершились
+            sources = [row[0] for row in cur.fetchall() if row[0]]
+        for offset in range(0, len(sources), 1000):
+            batch = sources[offset:offset + 1000]
+            s3.delete_objects(Bucket='files', Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        conn.commit()
+
+    return {
+        'success': True,
+        'dry_run': dry_run,
+        'scanned': scanned,
+        'garbage': len(garbage),
+        'freed_bytes': freed,
+        'keys': garbage[:100]
+    }
+
+
+def is_admin(conn, user_id: Optional[str]) -> bool:
+    if not user_id or not str(user_id).isdigit():
+        return False
+    with conn.cursor() as cur:
+        cur.execute("SELECT is_admin FROM users WHERE id = %s", (int(user_id),))
+        row = cur.fetchone()
+    return bool(row and row[0])
 
-from io import BytesIO
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Upload product images to cloud storage
-    Args: event with httpMethod, body containing base64 image
-    Returns: HTTP response with image URL
+    Business: Upload product images to cloud storage as responsive JPEG/WebP variants
+    Args: event with httpMethod, body containing base64 image (or images list for background jobs),
+          queryStringParameters with job_id for job status or action=gc for storage cleanup
+    Returns: HTTP response with image URL, variant URLs and srcset strings, or job ids and status
     '''
     method: str = event.get('httpMethod', 'POST')
-    
+
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type, Accept, Cache-Control, X-User-Id, X-Auth-Token, X-Session-Id',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
-    
+
+    params = event.get('queryStringParameters') or {}
+
+    if method == 'GET':
+        job_id = params.get('job_id')
+        if not job_id:
+            return json_response(400, {'error': 'job_id is required'})
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            return json_response(400, {'error': 'Invalid job_id'})
+        try:
+            # Задачу, брошенную остановленным инстансом, продолжает этот вызов
+            run_job(job_id, queued_after=IMAGE_JOB_RESUME_AFTER)
+            job = get_job(job_id)
+        except Exception as e:
+            return json_response(500, {'error': f'Job lookup failed: {str(e)}'})
+        if not job:
+            return json_response(404, {'error': 'Job not found'})
+        return json_response(200, {'job': job})
+
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
-    try:
-        body_data = json.loads(event.get('body', '{}'))
-        
-        if 'image' not in body_data:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Missing image data'}),
-                'isBase64Encoded': False
-            }
-        
-        image_data = body_data['image']
-        
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        image_bytes = base64.b64decode(image_data)
-        
-        from PIL import Image
-        import io
-        
+        return json_response(405, {'error': 'Method not allowed'})
+
+    if params.get('action') == 'gc':
+        headers = event.get('headers') or {}
+        user_id = headers.get('X-User-Id') or headers.get('x-user-id')
         try:
-            img = Image.open(io.BytesIO(image_bytes))
-            
-            if hasattr(img, '_getexif') and img._getexif() is not None:
-                from PIL import ImageOps
-                img = ImageOps.exif_transpose(img)
-            
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Получаем параметры оптимизации из body (если переданы)
-            max_width = body_data.get('max_width', 1920)
-            max_height = body_data.get('max_height', 1920)
-            quality = body_data.get('quality', 85)
-            
-            # Оптимизируем размер только если изображение больше лимитов
-            if img.width > max_width or img.height > max_height:
-                ratio = min(max_width / img.width, max_height / img.height)
-                new_width = int(img.width * ratio)
-                new_height = int(img.height * ratio)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            output = io.BytesIO()
-            img.save(output, format='JPEG', quality=quality, optimize=True)
-            image_bytes = output.getvalue()
-            
-            optimized_size = f"{img.width}x{img.height}"
-            
-            file_extension = 'jpg'
-            
+            body_data = json.loads(event.get('body') or '{}')
+            conn = get_connection()
+            try:
+                if not is_admin(conn, user_id):
+                    return json_response(403, {'error': 'Admin access required'})
+                # По умолчанию только отчёт; удаление - явным {"dry_run": false}
+                return json_response(200, collect_garbage(conn, body_data.get('dry_run', True) is not False))
+            finally:
+                conn.close()
         except Exception as e:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': f'Invalid image format: {str(e)}'}),
-                'isBase64Encoded': False
-            }
-        
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        
-        storage_path = f"/tmp/{unique_filename}"
-        with open(storage_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        import boto3
-        
-        # ⚠️ CRITICAL: Используем ТОЛЬКО эти env переменные и endpoint!
-        aws_access_key = os.environ.get('AWS_ACCESS_KEY_ID')
-        aws_secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-        
-        if not aws_access_key or not aws_secret_key:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Storage credentials not configured'}),
-                'isBase64Encoded': False
-            }
-        
-        s3 = boto3.client(
-            's3',
-            endpoint_url='https://bucket.poehali.dev',  # ⚠️ ТОЛЬКО ЭТОТ URL!
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key
-        )
-        
-        content_type = 'image/jpeg'
-        if file_extension == 'png':
-            content_type = 'image/png'
-        elif file_extension == 'webp':
-            content_type = 'image/webp'
-        elif file_extension == 'gif':
-            content_type = 'image/gif'
-        
-        # ⚠️ Bucket ВСЕГДА 'files'!
-        s3.put_object(
-            Bucket='files',
-            Key=f"products/{unique_filename}",
-            Body=image_bytes,
-            ContentType=content_type
-        )
-        
-        os.remove(storage_path)
-        
-        # ⚠️ CDN URL: использовать AWS_ACCESS_KEY_ID (НЕ PROJECT_ID!)
-        public_url = f"https://cdn.poehali.dev/projects/{aws_access_key}/bucket/products/{unique_filename}"
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'url': public_url,
-                'optimized_size': optimized_size
-            }),
-            'isBase64Encoded': False
-        }
-    
+            return json_response(500, {'error': f'Garbage collection failed: {str(e)}'})
+
+    try:
+        if event.get('isBase64Encoded'):
+            # Изображение сырым телом (image/*, application/octet-stream), параметры в query string
+            body_data = {**params, 'image': event.get('body') or ''}
+        else:
+            body_data = json.loads(event.get('body', '{}'))
+
+        images = body_data.get('images')
+        if images is None and 'image' not in body_data:
+            return json_response(400, {'error': 'Missing image data'})
+
+        if not os.environ.get('AWS_ACCESS_KEY_ID') or not os.environ.get('AWS_SECRET_ACCESS_KEY'):
+            return json_response(500, {'error': 'Storage credentials not configured'})
+
+        encode_args = encode_params(body_data)
+        run_async = (images is not None or body_data.get('async') is True
+                     or str(params.get('async', '')).lower() == 'true')
+
+        if not run_async:
+            try:
+                result = process_image(decode_image(body_data['image']), encode_args)
+            except InvalidImage as e:
+                return json_response(400, {'error': f'Invalid image format: {str(e)}'})
+            return json_response(200, result)
+
+        # Фоновая обработка: сразу отдаём id задач, готовность проверяется через GET ?job_id=
+        if images is None:
+            images = [body_data['image']]
+        if not isinstance(images, list) or not images:
+            return json_response(400, {'error': 'images must be a non-empty list'})
+
+        decoded = [decode_image(image) for image in images]
+        job_ids = [str(uuid.uuid4()) for _ in decoded]
+        create_jobs(job_ids, store_sources(job_ids, decoded), encode_args)
+        # Обработка сразу в этом инстансе; если он остановится после ответа, задачу продолжит GET ?job_id=
+        runner = get_job_runner()
+        for job_id, image_bytes in zip(job_ids, decoded):
+            runner.submit(run_job, job_id, image_bytes)
+
+        return json_response(202, {'success': True, 'job_ids': job_ids, 'status': 'queued'})
+
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Upload failed: {str(e)}'}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return json_response(500, {'error': f'Upload failed: {str(e)}'})
@@ -0,0 +1,64 @@
+-- Составные индексы под keyset-пагинацию журнала аудита (ORDER BY created_at DESC, id DESC)
+CREATE INDEX IF NOT EXISTS idx_audit_logs_created_id
+    ON t_p61788166_html_to_frontend.audit_logs(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_audit_logs_entity_created_id
+    ON t_p61788166_html_to_frontend.audit_logs(entity_type, entity_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_audit_logs_user_created_id
+    ON t_p61788166_html_to_frontend.audit_logs(user_id, created_at DESC, id DESC);
+
+-- Архив старых записей аудита, секционированный по месяцам
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.audit_logs_archive (
+    id INTEGER NOT NULL,
+    entity_type VARCHAR(100) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    action VARCHAR(50) NOT NULL,
+    user_id INTEGER,
+    username VARCHAR(255),
+    changed_fields JSONB,
+    old_values JSONB,
+    new_values JSONB,
+    metadata JSONB,
+    created_at TIMESTAMP NOT NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.audit_logs_archive_default
+    PARTITION OF t_p61788166_html_to_frontend.audit_logs_archive DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_audit_logs_archive_entity
+    ON t_p61788166_html_to_frontend.audit_logs_archive(entity_type, entity_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_audit_logs_archive_created_id
+    ON t_p61788166_html_to_frontend.audit_logs_archive(created_at DESC, id DESC);
+
+-- Месячные секции архива создаются заранее - для всех месяцев, уже лежащих в audit_logs,
+-- и на полгода вперёд. Секцию нельзя создать, если DEFAULT уже содержит строки её диапазона.
+DO $$
+DECLARE
+    month_start DATE;
+    last_month DATE := date_trunc('month', CURRENT_DATE + INTERVAL '6 months');
+BEGIN
+    SELECT COALESCE(date_trunc('month', MIN(created_at)), date_trunc('month', CURRENT_DATE))
+    INTO month_start
+    FROM t_p61788166_html_to_frontend.audit_logs;
+
+    WHILE month_start <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.%I '
+            'PARTITION OF t_p61788166_html_to_frontend.audit_logs_archive FOR VALUES FROM (%L) TO (%L)',
+            'audit_logs_archive_' || to_char(month_start, 'YYYYMM'),
+            month_start,
+            (month_start + INTERVAL '1 month')::date
+        );
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+END $$;
+
+-- Право на перенос записей аудита в архив
+INSERT INTO t_p61788166_html_to_frontend.permissions (name, resource, action, description)
+VALUES
+('audit_logs.delete', 'audit_logs', 'delete', 'Архивирование и удаление записей журнала аудита')
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO t_p61788166_html_to_frontend.role_permissions (role_id, permission_id)
+SELECT 1, id FROM t_p61788166_html_to_frontend.permissions WHERE name = 'audit_logs.delete'
+ON CONFLICT DO NOTHING;
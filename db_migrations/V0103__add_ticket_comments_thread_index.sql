@@ -0,0 +1,3 @@
+-- Индекс под постраничную загрузку ветки комментариев заявки (ORDER BY created_at DESC, id DESC)
+CREATE INDEX IF NOT EXISTS idx_ticket_comments_ticket_created_id
+    ON t_p61788166_html_to_frontend.ticket_comments(ticket_id, created_at DESC, id DESC);
@@ -0,0 +1,36 @@
+-- Глобальный счётчик версии справочников для снапшота dictionaries-api (ETag)
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.dictionary_version (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO t_p61788166_html_to_frontend.dictionary_version (id, version)
+VALUES (1, 1)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.bump_dictionary_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE t_p61788166_html_to_frontend.dictionary_version
+    SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE id = 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Любая запись в справочник (из main, dictionaries-api или миграций) увеличивает версию
+DO $$
+DECLARE
+    tbl TEXT;
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY['categories', 'legal_entities', 'contractors', 'customer_departments',
+                               'services', 'saving_reasons', 'custom_fields']
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_%s_dictionary_version ON t_p61788166_html_to_frontend.%I', tbl, tbl);
+        EXECUTE format('CREATE TRIGGER trg_%s_dictionary_version
+                        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON t_p61788166_html_to_frontend.%I
+                        FOR EACH STATEMENT EXECUTE FUNCTION t_p61788166_html_to_frontend.bump_dictionary_version()',
+                       tbl, tbl);
+    END LOOP;
+END $$;
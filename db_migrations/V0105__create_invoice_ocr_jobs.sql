@@ -0,0 +1,14 @@
+-- Задания пакетного распознавания счетов (invoice-ocr), клиент опрашивает статус по id
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.invoice_ocr_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    total INTEGER NOT NULL DEFAULT 0,
+    processed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    results JSONB NOT NULL DEFAULT '[]'::jsonb,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_invoice_ocr_jobs_user_id ON t_p61788166_html_to_frontend.invoice_ocr_jobs(user_id, created_at DESC);
@@ -0,0 +1,4 @@
+-- Частичный индекс для выборки просроченных запланированных платежей пачками (process-scheduled-payments)
+CREATE INDEX IF NOT EXISTS idx_planned_payments_due
+    ON t_p61788166_html_to_frontend.planned_payments(planned_date, id)
+    WHERE is_active = true AND converted_to_payment_id IS NULL;
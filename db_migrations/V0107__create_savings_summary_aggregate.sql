@@ -0,0 +1,79 @@
+-- Инкрементально поддерживаемые итоги экономий по месяцу/услуге/причине (savings-api summary)
+-- 0 в service_id / saving_reason_id означает "не указано"
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.savings_summary (
+    month DATE NOT NULL,
+    service_id INTEGER NOT NULL DEFAULT 0,
+    saving_reason_id INTEGER NOT NULL DEFAULT 0,
+    savings_count BIGINT NOT NULL DEFAULT 0,
+    total_amount NUMERIC(18, 2) NOT NULL DEFAULT 0,
+    total_annual_amount NUMERIC(18, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (month, service_id, saving_reason_id)
+);
+
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.savings_annual_amount(p_amount NUMERIC, p_frequency VARCHAR)
+RETURNS NUMERIC AS $$
+    SELECT CASE p_frequency
+        WHEN 'once' THEN p_amount
+        WHEN 'monthly' THEN p_amount * 12
+        WHEN 'quarterly' THEN p_amount * 4
+        WHEN 'yearly' THEN p_amount
+        ELSE 0
+    END;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.savings_summary_apply(
+    p_created_at TIMESTAMP, p_service_id INTEGER, p_reason_id INTEGER,
+    p_amount NUMERIC, p_frequency VARCHAR, p_sign INTEGER
+) RETURNS VOID AS $$
+    INSERT INTO t_p61788166_html_to_frontend.savings_summary AS ss
+        (month, service_id, saving_reason_id, savings_count, total_amount, total_annual_amount)
+    VALUES (
+        date_trunc('month', COALESCE(p_created_at, CURRENT_TIMESTAMP))::date,
+        COALESCE(p_service_id, 0),
+        COALESCE(p_reason_id, 0),
+        p_sign,
+        p_sign * p_amount,
+        p_sign * t_p61788166_html_to_frontend.savings_annual_amount(p_amount, p_frequency)
+    )
+    ON CONFLICT (month, service_id, saving_reason_id) DO UPDATE SET
+        savings_count = ss.savings_count + EXCLUDED.savings_count,
+        total_amount = ss.total_amount + EXCLUDED.total_amount,
+        total_annual_amount = ss.total_annual_amount + EXCLUDED.total_annual_amount;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.savings_summary_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM t_p61788166_html_to_frontend.savings_summary_apply(
+            OLD.created_at, OLD.service_id, OLD.saving_reason_id, OLD.amount, OLD.frequency, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM t_p61788166_html_to_frontend.savings_summary_apply(
+            NEW.created_at, NEW.service_id, NEW.saving_reason_id, NEW.amount, NEW.frequency, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_savings_summary ON t_p61788166_html_to_frontend.savings;
+CREATE TRIGGER trg_savings_summary
+    AFTER INSERT OR UPDATE OR DELETE ON t_p61788166_html_to_frontend.savings
+    FOR EACH ROW EXECUTE FUNCTION t_p61788166_html_to_frontend.savings_summary_trigger();
+
+-- Первичное заполнение агрегата из существующих данных
+TRUNCATE t_p61788166_html_to_frontend.savings_summary;
+INSERT INTO t_p61788166_html_to_frontend.savings_summary
+    (month, service_id, saving_reason_id, savings_count, total_amount, total_annual_amount)
+SELECT date_trunc('month', COALESCE(created_at, CURRENT_TIMESTAMP))::date,
+       COALESCE(service_id, 0),
+       COALESCE(saving_reason_id, 0),
+       COUNT(*),
+       SUM(amount),
+       SUM(t_p61788166_html_to_frontend.savings_annual_amount(amount, frequency))
+FROM t_p61788166_html_to_frontend.savings
+GROUP BY 1, 2, 3;
+
+-- Индекс под keyset-пагинацию списка экономий
+CREATE INDEX IF NOT EXISTS idx_savings_created_id
+    ON t_p61788166_html_to_frontend.savings(created_at DESC, id DESC);
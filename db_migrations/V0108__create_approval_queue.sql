@@ -0,0 +1,60 @@
+-- Материализованная очередь согласований: кто и на каком этапе должен согласовать платёж
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.approval_queue (
+    approver_id INTEGER NOT NULL,
+    payment_id INTEGER NOT NULL,
+    stage VARCHAR(20) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (approver_id, payment_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_approval_queue_payment_id ON t_p61788166_html_to_frontend.approval_queue(payment_id);
+
+-- Очередь пересобирается при отправке на согласование, утверждении, отклонении и отзыве (смена статуса платежа)
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.sync_approval_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM t_p61788166_html_to_frontend.approval_queue WHERE payment_id = OLD.id;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'UPDATE'
+       AND NEW.status IS NOT DISTINCT FROM OLD.status
+       AND NEW.service_id IS NOT DISTINCT FROM OLD.service_id THEN
+        RETURN NULL;
+    END IF;
+
+    DELETE FROM t_p61788166_html_to_frontend.approval_queue WHERE payment_id = NEW.id;
+
+    IF NEW.status LIKE 'pending\_%' THEN
+        INSERT INTO t_p61788166_html_to_frontend.approval_queue (approver_id, payment_id, stage)
+        SELECT a.approver_id, NEW.id, a.stage
+        FROM t_p61788166_html_to_frontend.services s
+        CROSS JOIN LATERAL (VALUES
+            (s.intermediate_approver_id, 'intermediate'),
+            (s.final_approver_id, 'final')
+        ) AS a(approver_id, stage)
+        WHERE s.id = NEW.service_id AND a.approver_id IS NOT NULL
+        ON CONFLICT (approver_id, payment_id) DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_payments_approval_queue ON t_p61788166_html_to_frontend.payments;
+CREATE TRIGGER trg_payments_approval_queue
+    AFTER INSERT OR UPDATE OF status, service_id OR DELETE ON t_p61788166_html_to_frontend.payments
+    FOR EACH ROW EXECUTE FUNCTION t_p61788166_html_to_frontend.sync_approval_queue();
+
+-- Заполнение очереди для платежей, уже находящихся на согласовании
+INSERT INTO t_p61788166_html_to_frontend.approval_queue (approver_id, payment_id, stage)
+SELECT a.approver_id, p.id, a.stage
+FROM t_p61788166_html_to_frontend.payments p
+JOIN t_p61788166_html_to_frontend.services s ON s.id = p.service_id
+CROSS JOIN LATERAL (VALUES
+    (s.intermediate_approver_id, 'intermediate'),
+    (s.final_approver_id, 'final')
+) AS a(approver_id, stage)
+WHERE p.status LIKE 'pending\_%' AND a.approver_id IS NOT NULL
+ON CONFLICT (approver_id, payment_id) DO NOTHING;
@@ -0,0 +1,94 @@
+-- Счётчики непрочитанных уведомлений на пользователя
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.notification_counters (
+    user_id INTEGER PRIMARY KEY,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    last_notification_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_notifications_user_id_id ON t_p61788166_html_to_frontend.notifications(user_id, id DESC);
+
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.notification_counters_apply()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO t_p61788166_html_to_frontend.notification_counters (user_id, unread_count, last_notification_id)
+        VALUES (NEW.user_id, CASE WHEN COALESCE(NEW.is_read, false) THEN 0 ELSE 1 END, NEW.id)
+        ON CONFLICT (user_id) DO UPDATE SET
+            unread_count = notification_counters.unread_count + EXCLUDED.unread_count,
+            last_notification_id = GREATEST(notification_counters.last_notification_id, EXCLUDED.last_notification_id),
+            updated_at = CURRENT_TIMESTAMP;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF COALESCE(NEW.is_read, false) IS DISTINCT FROM COALESCE(OLD.is_read, false) THEN
+            UPDATE t_p61788166_html_to_frontend.notification_counters
+            SET unread_count = GREATEST(unread_count + CASE WHEN COALESCE(NEW.is_read, false) THEN -1 ELSE 1 END, 0),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = NEW.user_id;
+        END IF;
+    ELSIF TG_OP = 'DELETE' THEN
+        IF NOT COALESCE(OLD.is_read, false) THEN
+            UPDATE t_p61788166_html_to_frontend.notification_counters
+            SET unread_count = GREATEST(unread_count - 1, 0),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = OLD.user_id;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notifications_counters ON t_p61788166_html_to_frontend.notifications;
+CREATE TRIGGER trg_notifications_counters
+    AFTER INSERT OR UPDATE OF is_read OR DELETE ON t_p61788166_html_to_frontend.notifications
+    FOR EACH ROW EXECUTE FUNCTION t_p61788166_html_to_frontend.notification_counters_apply();
+
+-- Начальное заполнение счётчиков
+INSERT INTO t_p61788166_html_to_frontend.notification_counters (user_id, unread_count, last_notification_id)
+SELECT user_id,
+       COUNT(*) FILTER (WHERE NOT COALESCE(is_read, false)),
+       MAX(id)
+FROM t_p61788166_html_to_frontend.notifications
+GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET
+    unread_count = EXCLUDED.unread_count,
+    last_notification_id = EXCLUDED.last_notification_id,
+    updated_at = CURRENT_TIMESTAMP;
+
+-- Холодный архив прочитанных уведомлений
+CREATE TABLE IF NOT EXISTS t_p61788166_html_to_frontend.notifications_archive
+    (LIKE t_p61788166_html_to_frontend.notifications INCLUDING DEFAULTS);
+
+ALTER TABLE t_p61788166_html_to_frontend.notifications_archive
+    ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_notifications_archive_user_id ON t_p61788166_html_to_frontend.notifications_archive(user_id, id DESC);
+
+-- Переносит прочитанные уведомления старше p_retention_days в архив (порциями по p_batch_size)
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.archive_notifications(
+    p_user_id INTEGER,
+    p_retention_days INTEGER,
+    p_batch_size INTEGER DEFAULT 1000
+)
+RETURNS INTEGER AS $$
+DECLARE
+    moved_count INTEGER;
+BEGIN
+    WITH moved AS (
+        DELETE FROM t_p61788166_html_to_frontend.notifications
+        WHERE id IN (
+            SELECT id FROM t_p61788166_html_to_frontend.notifications
+            WHERE (p_user_id IS NULL OR user_id = p_user_id)
+              AND is_read = true
+              AND created_at < CURRENT_TIMESTAMP - make_interval(days => p_retention_days)
+            ORDER BY id
+            LIMIT p_batch_size
+        )
+        RETURNING *
+    )
+    INSERT INTO t_p61788166_html_to_frontend.notifications_archive
+    SELECT moved.*, CURRENT_TIMESTAMP FROM moved;
+
+    GET DIAGNOSTICS moved_count = ROW_COUNT;
+    RETURN moved_count;
+END;
+$$ LANGUAGE plpgsql;
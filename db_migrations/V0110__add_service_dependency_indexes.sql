@@ -0,0 +1,4 @@
+-- Индексы для проверки зависимостей сервиса перед удалением (EXISTS по service_id)
+CREATE INDEX IF NOT EXISTS idx_payments_service_id ON t_p61788166_html_to_frontend.payments(service_id);
+CREATE INDEX IF NOT EXISTS idx_savings_service_id ON t_p61788166_html_to_frontend.savings(service_id);
+CREATE INDEX IF NOT EXISTS idx_planned_payments_service_id ON t_p61788166_html_to_frontend.planned_payments(service_id);
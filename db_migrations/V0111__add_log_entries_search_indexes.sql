@@ -0,0 +1,10 @@
+-- Индексы для поиска по логам: триграммы для подстрочного поиска, составные индексы для keyset-пагинации
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_log_entries_message_trgm ON log_entries USING gin (message gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_log_entries_file_line ON log_entries(file_id, line_number);
+CREATE INDEX IF NOT EXISTS idx_log_entries_file_level_line ON log_entries(file_id, level, line_number);
+CREATE INDEX IF NOT EXISTS idx_log_entries_file_timestamp ON log_entries(file_id, timestamp);
+
+-- Покрывается idx_log_entries_file_line
+DROP INDEX IF EXISTS idx_log_entries_file_id;
@@ -0,0 +1,8 @@
+-- Прогресс потоковой загрузки лог-файлов по частям
+ALTER TABLE log_files ALTER COLUMN file_size TYPE BIGINT;
+ALTER TABLE log_files ADD COLUMN IF NOT EXISTS chunks_received INTEGER DEFAULT 0;
+ALTER TABLE log_files ADD COLUMN IF NOT EXISTS lines_processed INTEGER DEFAULT 0;
+-- Незавершённая последняя строка предыдущего куска
+ALTER TABLE log_files ADD COLUMN IF NOT EXISTS pending_tail BYTEA;
+ALTER TABLE log_files ADD COLUMN IF NOT EXISTS error TEXT;
+ALTER TABLE log_files ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
@@ -0,0 +1,2 @@
+-- Формат лог-файла, определённый по первым строкам при загрузке
+ALTER TABLE log_files ADD COLUMN IF NOT EXISTS log_format VARCHAR(30);
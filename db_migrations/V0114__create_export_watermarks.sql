@@ -0,0 +1,6 @@
+-- Отметка времени последнего успешного экспорта (для инкрементального режима export-data)
+CREATE TABLE IF NOT EXISTS export_watermarks (
+    name VARCHAR(100) PRIMARY KEY,
+    exported_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
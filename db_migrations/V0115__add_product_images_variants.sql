@@ -0,0 +1,5 @@
+-- Адаптивные варианты изображения (thumb/card/full в JPEG и WebP), которые создаёт upload-image:
+-- {"thumb": {"width": 320, "height": 240, "jpeg": "...", "webp": "..."}, "card": {...}, "full": {...}}
+ALTER TABLE product_images ADD COLUMN IF NOT EXISTS variants JSONB;
+
+COMMENT ON COLUMN product_images.variants IS 'Responsive image variants from upload-image, used to build srcset';
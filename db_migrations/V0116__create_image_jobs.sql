@@ -0,0 +1,15 @@
+-- Фоновая обработка загрузок upload-image: клиент получает id задачи сразу
+-- и опрашивает GET ?job_id=, пока варианты изображения не будут готовы
+CREATE TABLE IF NOT EXISTS image_jobs (
+    id VARCHAR(36) PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    result JSONB,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_image_jobs_created_at ON image_jobs(created_at);
+
+COMMENT ON COLUMN image_jobs.status IS 'queued, processing, done or failed';
+COMMENT ON COLUMN image_jobs.result IS 'Same payload as a synchronous upload response (url, variants, srcset)';
@@ -0,0 +1,14 @@
+-- Загрузки upload-image по хешу содержимого: повторная загрузка той же фотографии
+-- возвращает уже сохранённые варианты без кодирования и записи в хранилище
+CREATE TABLE IF NOT EXISTS image_uploads (
+    content_hash VARCHAR(64) PRIMARY KEY,
+    source_hash VARCHAR(64) NOT NULL,
+    result JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_image_uploads_source_hash ON image_uploads(source_hash);
+
+COMMENT ON COLUMN image_uploads.content_hash IS 'sha256 of normalized pixels and encoding params; objects live under products/{content_hash}/';
+COMMENT ON COLUMN image_uploads.source_hash IS 'sha256 of the uploaded bytes and encoding params';
@@ -0,0 +1,7 @@
+-- Статус задания запрашивается по случайному UUID, а не по последовательному id:
+-- результаты распознавания нельзя получить перебором номеров
+ALTER TABLE t_p61788166_html_to_frontend.invoice_ocr_jobs
+    ADD COLUMN IF NOT EXISTS public_id UUID NOT NULL DEFAULT gen_random_uuid();
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_invoice_ocr_jobs_public_id
+    ON t_p61788166_html_to_frontend.invoice_ocr_jobs(public_id);
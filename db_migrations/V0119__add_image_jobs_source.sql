@@ -0,0 +1,9 @@
+-- Источник фоновой задачи upload-image хранится в бакете (uploads/{job_id}), а не в памяти инстанса:
+-- задачу, брошенную остановленным инстансом, продолжает любой следующий вызов
+ALTER TABLE image_jobs ADD COLUMN IF NOT EXISTS source_key TEXT;
+ALTER TABLE image_jobs ADD COLUMN IF NOT EXISTS params JSONB;
+ALTER TABLE image_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+
+COMMENT ON COLUMN image_jobs.source_key IS 'Key of the uploaded source in the files bucket; removed once the job is done or failed';
+COMMENT ON COLUMN image_jobs.params IS 'Encoding parameters: max_width, max_height, quality';
+COMMENT ON COLUMN image_jobs.attempts IS 'Number of times the job was claimed for processing';
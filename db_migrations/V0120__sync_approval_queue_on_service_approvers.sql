@@ -0,0 +1,51 @@
+-- Смена согласующих услуги пересобирает очередь согласований её платежей, ожидающих согласования:
+-- иначе строки остаются за прежним согласующим, и новый их не видит
+CREATE OR REPLACE FUNCTION t_p61788166_html_to_frontend.sync_approval_queue_for_service()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.intermediate_approver_id IS NOT DISTINCT FROM OLD.intermediate_approver_id
+       AND NEW.final_approver_id IS NOT DISTINCT FROM OLD.final_approver_id THEN
+        RETURN NULL;
+    END IF;
+
+    DELETE FROM t_p61788166_html_to_frontend.approval_queue q
+    USING t_p61788166_html_to_frontend.payments p
+    WHERE q.payment_id = p.id AND p.service_id = NEW.id;
+
+    INSERT INTO t_p61788166_html_to_frontend.approval_queue (approver_id, payment_id, stage)
+    SELECT a.approver_id, p.id, a.stage
+    FROM t_p61788166_html_to_frontend.payments p
+    CROSS JOIN LATERAL (VALUES
+        (NEW.intermediate_approver_id, 'intermediate'),
+        (NEW.final_approver_id, 'final')
+    ) AS a(approver_id, stage)
+    WHERE p.service_id = NEW.id AND p.status LIKE 'pending\_%' AND a.approver_id IS NOT NULL
+    ON CONFLICT (approver_id, payment_id) DO NOTHING;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_services_approval_queue ON t_p61788166_html_to_frontend.services;
+CREATE TRIGGER trg_services_approval_queue
+    AFTER UPDATE OF intermediate_approver_id, final_approver_id ON t_p61788166_html_to_frontend.services
+    FOR EACH ROW EXECUTE FUNCTION t_p61788166_html_to_frontend.sync_approval_queue_for_service();
+
+-- Пересборка строк, оставшихся за прежними согласующими до появления триггера
+DELETE FROM t_p61788166_html_to_frontend.approval_queue q
+USING t_p61788166_html_to_frontend.payments p
+JOIN t_p61788166_html_to_frontend.services s ON s.id = p.service_id
+WHERE q.payment_id = p.id
+  AND q.approver_id IS DISTINCT FROM
+      CASE q.stage WHEN 'intermediate' THEN s.intermediate_approver_id ELSE s.final_approver_id END;
+
+INSERT INTO t_p61788166_html_to_frontend.approval_queue (approver_id, payment_id, stage)
+SELECT a.approver_id, p.id, a.stage
+FROM t_p61788166_html_to_frontend.payments p
+JOIN t_p61788166_html_to_frontend.services s ON s.id = p.service_id
+CROSS JOIN LATERAL (VALUES
+    (s.intermediate_approver_id, 'intermediate'),
+    (s.final_approver_id, 'final')
+) AS a(approver_id, stage)
+WHERE p.status LIKE 'pending\_%' AND a.approver_id IS NOT NULL
+ON CONFLICT (approver_id, payment_id) DO NOTHING;
@@ -0,0 +1,10 @@
+-- Варианты в product_images восстанавливались по URL с номинальной шириной 320/640/1920 -
+-- фактическая ширина файлов зависит от исходника и max_width, и браузер выбирал слишком мелкий файл.
+-- Клиент варианты не передавал, поэтому все сохранённые значения угаданы: заменяем их вариантами,
+-- записанными upload-image для этой загрузки, а неизвестные загрузки оставляем без вариантов
+UPDATE product_images SET variants = NULL WHERE variants IS NOT NULL;
+
+UPDATE product_images pi
+SET variants = u.result -> 'variants'
+FROM image_uploads u
+WHERE pi.image_url LIKE '%/products/' || u.content_hash || '/%';
@@ -0,0 +1,14 @@
+-- Снапшот справочников показывает имена согласующих услуг из users (username),
+-- поэтому переименование или удаление пользователя тоже увеличивает версию (ETag)
+DROP TRIGGER IF EXISTS trg_users_dictionary_version ON t_p61788166_html_to_frontend.users;
+CREATE TRIGGER trg_users_dictionary_version
+    AFTER UPDATE OF username ON t_p61788166_html_to_frontend.users
+    FOR EACH ROW
+    WHEN (OLD.username IS DISTINCT FROM NEW.username)
+    EXECUTE FUNCTION t_p61788166_html_to_frontend.bump_dictionary_version();
+
+DROP TRIGGER IF EXISTS trg_users_delete_dictionary_version ON t_p61788166_html_to_frontend.users;
+CREATE TRIGGER trg_users_delete_dictionary_version
+    AFTER DELETE OR TRUNCATE ON t_p61788166_html_to_frontend.users
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION t_p61788166_html_to_frontend.bump_dictionary_version();
@@ -0,0 +1,184 @@
+"""
+Бенчмарк загрузки ветки комментариев заявки (endpoint ticket-comments-api) на 1 000 комментариев.
+
+Сравнивает прежнюю схему (два запроса на каждый комментарий: вложения и реакции)
+с пакетной загрузкой handle_ticket_comments_api - целиком и постранично (limit/before_id).
+Данные создаются во временной схеме bench_ticket_comments, которая удаляется в конце,
+поэтому скрипт можно запускать на любой базе: DATABASE_URL=... python docker/bench-ticket-comments.py
+"""
+
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+BENCH_SCHEMA = "bench_ticket_comments"
+COMMENTS = int(os.environ.get("BENCH_COMMENTS", "1000"))
+RUNS = int(os.environ.get("BENCH_RUNS", "10"))
+PAGE = 50
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "main", "index.py")
+
+
+class CountingCursor(RealDictCursor):
+    queries = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.queries += 1
+        return super().execute(query, vars)
+
+
+def load_main():
+    spec = importlib.util.spec_from_file_location("main_index", MAIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Все запросы обработчика идут во временную схему
+    module.SCHEMA = BENCH_SCHEMA
+    module.RealDictCursor = CountingCursor
+    return module
+
+
+def seed(conn):
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    cur.execute(f"""
+        CREATE TABLE {BENCH_SCHEMA}.users (
+            id SERIAL PRIMARY KEY, username VARCHAR(255), email VARCHAR(255)
+        );
+        CREATE TABLE {BENCH_SCHEMA}.ticket_comments (
+            id SERIAL PRIMARY KEY,
+            ticket_id INTEGER,
+            user_id INTEGER NOT NULL,
+            comment TEXT NOT NULL,
+            is_internal BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            parent_comment_id INTEGER,
+            mentioned_user_ids INTEGER[],
+            is_read BOOLEAN DEFAULT FALSE
+        );
+        CREATE INDEX ON {BENCH_SCHEMA}.ticket_comments(ticket_id, created_at DESC, id DESC);
+        CREATE TABLE {BENCH_SCHEMA}.comment_attachments (
+            id SERIAL PRIMARY KEY, comment_id INTEGER NOT NULL, filename VARCHAR(255) NOT NULL,
+            url TEXT NOT NULL, size INTEGER NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX ON {BENCH_SCHEMA}.comment_attachments(comment_id);
+        CREATE TABLE {BENCH_SCHEMA}.comment_reactions (
+            id SERIAL PRIMARY KEY, comment_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+            emoji VARCHAR(10) NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX ON {BENCH_SCHEMA}.comment_reactions(comment_id);
+    """)
+    cur.execute(f"""
+        INSERT INTO {BENCH_SCHEMA}.users (username, email)
+        SELECT 'user' || g, 'user' || g || '@example.com' FROM generate_series(1, 20) g
+    """)
+    cur.execute(f"""
+        INSERT INTO {BENCH_SCHEMA}.ticket_comments (ticket_id, user_id, comment, created_at, is_read)
+        SELECT 1, 1 + g %% 20, 'Комментарий ' || g, TIMESTAMP '2026-01-01' + g * INTERVAL '1 minute', TRUE
+        FROM generate_series(1, %s) g
+    """, (COMMENTS,))
+    # Каждый третий комментарий с вложением, у каждого - реакции двух видов
+    cur.execute(f"""
+        INSERT INTO {BENCH_SCHEMA}.comment_attachments (comment_id, filename, url, size)
+        SELECT id, 'file' || id || '.pdf', 'https://example.com/' || id, 1024
+        FROM {BENCH_SCHEMA}.ticket_comments WHERE id % 3 = 0
+    """)
+    cur.execute(f"""
+        INSERT INTO {BENCH_SCHEMA}.comment_reactions (comment_id, user_id, emoji)
+        SELECT c.id, 1 + (c.id + r) % 20, CASE WHEN r % 2 = 0 THEN '👍' ELSE '🔥' END
+        FROM {BENCH_SCHEMA}.ticket_comments c, generate_series(1, 3) r
+    """)
+    cur.execute(f"ANALYZE {BENCH_SCHEMA}.ticket_comments")
+    conn.commit()
+
+
+def per_comment_queries(conn, ticket_id):
+    """Прежняя схема загрузки: запрос веток, затем вложения и реакции отдельно для каждого комментария"""
+    cur = conn.cursor(cursor_factory=CountingCursor)
+    cur.execute(f"""
+        SELECT tc.id, tc.ticket_id, tc.user_id, tc.comment, tc.is_internal, tc.created_at,
+               tc.parent_comment_id, tc.mentioned_user_ids, u.username as user_name, u.email as user_email
+        FROM {BENCH_SCHEMA}.ticket_comments tc
+        LEFT JOIN {BENCH_SCHEMA}.users u ON tc.user_id = u.id
+        WHERE tc.ticket_id = %s
+        ORDER BY tc.created_at DESC
+    """, (ticket_id,))
+    comments = []
+    for row in cur.fetchall():
+        cur.execute(f"""
+            SELECT id, filename, url, size FROM {BENCH_SCHEMA}.comment_attachments
+            WHERE comment_id = %s ORDER BY created_at ASC
+        """, (row['id'],))
+        attachments = [dict(a) for a in cur.fetchall()]
+        cur.execute(f"""
+            SELECT emoji, COUNT(*) as count, ARRAY_AGG(user_id) as users
+            FROM {BENCH_SCHEMA}.comment_reactions WHERE comment_id = %s GROUP BY emoji
+        """, (row['id'],))
+        comments.append({**row, 'attachments': attachments, 'reactions': cur.fetchall()})
+    cur.close()
+    return comments
+
+
+def measure(name, fn):
+    timings = []
+    for _ in range(RUNS):
+        CountingCursor.queries = 0
+        started = time.perf_counter()
+        count = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f"{name:<34} {count:>6} {CountingCursor.queries:>8} {statistics.median(timings):>10.1f} {min(timings):>9.1f}")
+
+
+def main():
+    if not DATABASE_URL:
+        sys.exit("DATABASE_URL is not set")
+    main_module = load_main()
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        seed(conn)
+        payload = {'user_id': 1}
+
+        def batched(params):
+            result = main_module.handle_ticket_comments_api(
+                'GET', {'queryStringParameters': {'ticket_id': '1', **params}}, conn, payload
+            )
+            assert result['statusCode'] == 200, result['body']
+            return len(json.loads(result['body'])['comments'])
+
+        def walk_pages():
+            loaded, before_id = 0, None
+            while True:
+                params = {'limit': str(PAGE)}
+                if before_id:
+                    params['before_id'] = str(before_id)
+                result = main_module.handle_ticket_comments_api(
+                    'GET', {'queryStringParameters': {'ticket_id': '1', **params}}, conn, payload
+                )
+                body = json.loads(result['body'])
+                loaded += len(body['comments'])
+                if not body['has_more']:
+                    return loaded
+                before_id = body['comments'][-1]['id']
+
+        print(f"Ticket with {COMMENTS} comments, median/min of {RUNS} runs")
+        print(f"{'variant':<34} {'rows':>6} {'queries':>8} {'median ms':>10} {'min ms':>9}")
+        measure("per-comment queries (before)", lambda: len(per_comment_queries(conn, 1)))
+        measure("batched, whole thread", lambda: batched({}))
+        measure(f"batched, first page of {PAGE}", lambda: batched({'limit': str(PAGE)}))
+        measure(f"batched, all pages of {PAGE}", walk_pages)
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
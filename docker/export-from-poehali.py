@@ -4,18 +4,39 @@
 
 Запуск:
     pip install psycopg2-binary boto3
-    python export-from-poehali.py
+    python export-from-poehali.py                  # полный экспорт
+    python export-from-poehali.py --incremental    # только изменения с прошлого экспорта
+    python export-from-poehali.py --copy           # таблицы в формате COPY (быстрый импорт)
 
 Результат: папка export/ с файлами:
     export/database.sql         — дамп базы данных
+    export/database-incremental.sql — изменения (режим --incremental, применяется после database.sql)
+    export/database/*.copy      — таблицы в формате COPY + tables.json (режим --copy)
+    export/watermark.json       — отметка времени экспорта для следующего --incremental
+    export/files-manifest.json  — размер и ETag скачанных файлов (повторный запуск докачивает остальное)
     export/files/               — все фотографии и файлы
     export/export-info.txt      — информация об экспорте
+
+Инкрементальный экспорт переносит только добавленные и изменённые строки (по created_at/updated_at).
+Удалённые строки не выгружаются — чтобы перенести удаления, сделайте полный экспорт в чистую базу.
+Отметку watermark.json сдвигают только полный экспорт и --incremental без --since;
+разовая выгрузка с --since её не меняет.
+
+Проверка на локальном MinIO:
+    S3_ENDPOINT=http://localhost:9000 AWS_ACCESS_KEY_ID=minioadmin AWS_SECRET_ACCESS_KEY=... \\
+        python export-from-poehali.py --workers 32
 """
 
 import os
 import sys
 import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
@@ -27,11 +48,21 @@ AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID", "")
 AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY", "")
 MAIN_DB_SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
 
-# S3 endpoint поехали.dev (не менять!)
-S3_ENDPOINT = "https://bucket.poehali.dev"
-S3_BUCKET = "files"
+# S3 endpoint поехали.dev (не менять! S3_ENDPOINT задаётся только для проверки на локальном MinIO)
+S3_ENDPOINT = os.environ.get("S3_ENDPOINT", "https://bucket.poehali.dev")
+S3_BUCKET = os.environ.get("S3_BUCKET", "files")
 
 OUTPUT_DIR = Path("export")
+# Отметка времени последнего экспорта для режима --incremental
+WATERMARK_FILE = OUTPUT_DIR / "watermark.json"
+# Сколько таблиц выгружается параллельно
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "4"))
+# Сколько файлов скачивается параллельно
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "16"))
+# Служебные префиксы бакета, которые не переносятся (дампы базы из export-data)
+SKIP_PREFIXES = ("exports/",)
+# Размер и ETag скачанных файлов — для продолжения прерванной загрузки
+FILES_MANIFEST = OUTPUT_DIR / "files-manifest.json"
 # ───────────────────────────────────────────────────────────────────────────────
 
 
@@ -62,122 +93,267 @@ def check_requirements():
         sys.exit(1)
 
 
-def export_database():
+def format_sql_value(val):
+    if val is None:
+        return "NULL"
+    if isinstance(val, bool):
+        return "TRUE" if val else "FALSE"
+    if isinstance(val, (int, float)):
+        return str(val)
+    if isinstance(val, (dict, list)):
+        escaped = json.dumps(val, ensure_ascii=False).replace("'", "''")
+        return f"'{escaped}'"
+    escaped = str(val).replace("'", "''")
+    return f"'{escaped}'"
+
+
+def load_watermark():
+    if WATERMARK_FILE.exists():
+        data = json.loads(WATERMARK_FILE.read_text(encoding="utf-8"))
+        return datetime.fromisoformat(data["exported_at"])
+    return None
+
+
+def export_table(snapshot_id, table, columns, since, part_file):
+    """Выгружает одну таблицу в отдельный файл на своём соединении с общим снимком."""
+    import psycopg2
+    from psycopg2 import sql
+
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+
+        query = sql.SQL("SELECT * FROM {}.{}").format(
+            sql.Identifier(MAIN_DB_SCHEMA), sql.Identifier(table)
+        )
+        change_columns = [c for c in ("updated_at", "created_at") if c in columns]
+        if since is not None and change_columns:
+            query += sql.SQL(" WHERE GREATEST({}) > %s").format(
+                sql.SQL(", ").join(sql.Identifier(c) for c in change_columns)
+            )
+
+        # Именованный курсор читает строки порциями, а не всю таблицу разом
+        named = conn.cursor(name=f"export_{table}")
+        named.itersize = 2000
+        named.execute(query, (since,) if since is not None and change_columns else None)
+
+        rows = 0
+        with open(part_file, "w", encoding="utf-8") as f:
+            col_list = None
+            for row in named:
+                if col_list is None:
+                    col_names = [desc[0] for desc in named.description]
+                    col_list = ", ".join(f'"{c}"' for c in col_names)
+                    if since is not None and "id" in col_names:
+                        updates = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in col_names if c != "id")
+                        conflict = f' ON CONFLICT ("id") DO UPDATE SET {updates}' if updates else " ON CONFLICT DO NOTHING"
+                    else:
+                        conflict = " ON CONFLICT DO NOTHING"
+                    f.write(f"-- Таблица: {table}\n")
+                val_str = ", ".join(format_sql_value(val) for val in row)
+                f.write(
+                    f'INSERT INTO "{MAIN_DB_SCHEMA}"."{table}" ({col_list}) '
+                    f"VALUES ({val_str}){conflict};\n"
+                )
+                rows += 1
+            if rows:
+                f.write("\n")
+        named.close()
+        conn.rollback()
+        return rows
+    finally:
+        conn.close()
+
+
+def export_table_copy(snapshot_id, table, columns, copy_file):
+    """Выгружает таблицу в формате COPY (текст) для быстрого восстановления."""
     import psycopg2
     from psycopg2 import sql
 
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        query = sql.SQL("COPY {}.{} ({}) TO STDOUT").format(
+            sql.Identifier(MAIN_DB_SCHEMA),
+            sql.Identifier(table),
+            sql.SQL(", ").join(sql.Identifier(c) for c in columns),
+        )
+        with open(copy_file, "w", encoding="utf-8") as f:
+            cur.copy_expert(query.as_string(conn), f)
+        conn.rollback()
+        with open(copy_file, "rb") as f:
+            return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1024 * 1024), b""))
+    finally:
+        conn.close()
+
+
+def export_database(incremental=False, since=None, copy_format=False):
+    import psycopg2
+
     print("\n📦 Экспорт базы данных...")
 
     db_dir = OUTPUT_DIR / "database"
     db_dir.mkdir(parents=True, exist_ok=True)
 
+    # Отметку сдвигают только плановые запуски: полный экспорт или --incremental без явного --since
+    advance_watermark = since is None
+    if incremental and since is None:
+        since = load_watermark()
+        if since is None:
+            print("   Нет отметки прошлого экспорта (export/watermark.json) — выполняется полный экспорт")
+    if since is not None:
+        print(f"   Инкрементальный режим: строки, изменённые после {since.isoformat()}")
+
+    # Главное соединение держит снимок REPEATABLE READ, пока таблицы выгружаются параллельно
     conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
     cur = conn.cursor()
 
-    # Получаем список таблиц в нужной схеме
+    cur.execute("SELECT pg_export_snapshot()")
+    snapshot_id = cur.fetchone()[0]
+    cur.execute("""
+        SELECT LEAST(now(), COALESCE((
+            SELECT MIN(xact_start) FROM pg_stat_activity
+            WHERE backend_xid IS NOT NULL AND pid <> pg_backend_pid()
+        ), now()))::timestamp
+    """)
+    watermark = cur.fetchone()[0]
+
+    # Таблицы и их колонки одним запросом
     cur.execute("""
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = %s
-        AND table_type = 'BASE TABLE'
-        ORDER BY table_name
+        SELECT c.table_name, array_agg(c.column_name::text ORDER BY c.ordinal_position)
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+          ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = %s
+        AND t.table_type = 'BASE TABLE'
+        GROUP BY c.table_name
+        ORDER BY c.table_name
     """, (MAIN_DB_SCHEMA,))
-    tables = [row[0] for row in cur.fetchall()]
-
-    print(f"   Найдено таблиц: {len(tables)}")
+    tables = dict(cur.fetchall())
+
+    print(f"   Найдено таблиц: {len(tables)}, потоков: {EXPORT_WORKERS}")
+
+    if copy_format and since is not None:
+        print("   Формат COPY поддерживается только для полного экспорта, используются INSERT")
+        copy_format = False
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as pool:
+        if copy_format:
+            futures = {
+                table: pool.submit(export_table_copy, snapshot_id, table, columns, db_dir / f"{table}.copy")
+                for table, columns in tables.items()
+            }
+        else:
+            futures = {
+                table: pool.submit(export_table, snapshot_id, table, columns, since, db_dir / f"{table}.sql")
+                for table, columns in tables.items()
+            }
+        for table, future in futures.items():
+            try:
+                results[table] = future.result()
+                print(f"   → {table}... {results[table]} строк ✓" if results[table] else f"   → {table}... пусто")
+            except Exception as e:
+                results[table] = e
+                print(f"   → {table}... ОШИБКА: {e}")
 
-    all_sql = []
-    all_sql.append(f"-- Экспорт из поехали.dev")
-    all_sql.append(f"-- Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    all_sql.append(f"-- Схема: {MAIN_DB_SCHEMA}")
-    all_sql.append(f"-- Таблиц: {len(tables)}")
-    all_sql.append("")
-    all_sql.append("BEGIN;")
-    all_sql.append("")
+    cur.close()
+    conn.close()
 
+    failed = any(isinstance(r, Exception) for r in results.values())
+    if not failed and advance_watermark:
+        WATERMARK_FILE.write_text(
+            json.dumps({"exported_at": watermark.isoformat()}), encoding="utf-8"
+        )
+
+    if since is None:
+        # Изменения прошлых запусков уже вошли в полный дамп; их старые значения не должны его перезаписать
+        (OUTPUT_DIR / "database-incremental.sql").unlink(missing_ok=True)
+
+    if copy_format:
+        # Описание COPY-файлов для import-to-server.py
+        manifest = {
+            "schema": MAIN_DB_SCHEMA,
+            "exported_at": watermark.isoformat(),
+            "tables": {
+                table: {"columns": tables[table], "rows": results[table]}
+                for table in tables if not isinstance(results[table], Exception)
+            },
+        }
+        (db_dir / "tables.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        total_rows = sum(t["rows"] for t in manifest["tables"].values())
+        print(f"\n   ✅ База данных: {total_rows} строк → export/database/*.copy")
+        return total_rows, len(tables)
+
+    sql_file = OUTPUT_DIR / ("database-incremental.sql" if since is not None else "database.sql")
     total_rows = 0
+    with open(sql_file, "w", encoding="utf-8") as out:
+        out.write(f"-- Экспорт из поехали.dev\n")
+        out.write(f"-- Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        out.write(f"-- Схема: {MAIN_DB_SCHEMA}\n")
+        out.write(f"-- Таблиц: {len(tables)}\n")
+        if since is not None:
+            out.write(f"-- Изменения после: {since.isoformat()}\n")
+        out.write("\nBEGIN;\n\n")
+        for table in tables:
+            part_file = db_dir / f"{table}.sql"
+            if isinstance(results[table], Exception):
+                out.write(f"-- ОШИБКА при экспорте таблицы {table}: {results[table]}\n")
+            else:
+                total_rows += results[table]
+                with open(part_file, encoding="utf-8") as part:
+                    shutil.copyfileobj(part, out)
+            part_file.unlink(missing_ok=True)
+        out.write("COMMIT;\n")
 
-    for table in tables:
-        print(f"   → {table}...", end="", flush=True)
-
-        try:
-            # Получаем структуру таблицы
-            cur.execute("""
-                SELECT column_name, data_type, character_maximum_length,
-                       is_nullable, column_default
-                FROM information_schema.columns
-                WHERE table_schema = %s AND table_name = %s
-                ORDER BY ordinal_position
-            """, (MAIN_DB_SCHEMA, table))
-            columns = cur.fetchall()
-
-            # Получаем данные
-            cur.execute(
-                sql.SQL("SELECT * FROM {}.{}").format(
-                    sql.Identifier(MAIN_DB_SCHEMA),
-                    sql.Identifier(table)
-                )
-            )
-            rows = cur.fetchall()
-            col_names = [desc[0] for desc in cur.description]
+    size_mb = sql_file.stat().st_size / 1024 / 1024
+    print(f"\n   ✅ База данных: {total_rows} строк, {size_mb:.1f} МБ → export/{sql_file.name}")
+    return total_rows, len(tables)
 
-            if rows:
-                all_sql.append(f"-- Таблица: {table} ({len(rows)} строк)")
-
-                # Генерируем INSERT с обработкой всех типов
-                col_list = ", ".join(f'"{c}"' for c in col_names)
-
-                for row in rows:
-                    values = []
-                    for val in row:
-                        if val is None:
-                            values.append("NULL")
-                        elif isinstance(val, bool):
-                            values.append("TRUE" if val else "FALSE")
-                        elif isinstance(val, (int, float)):
-                            values.append(str(val))
-                        elif isinstance(val, (dict, list)):
-                            escaped = json.dumps(val, ensure_ascii=False).replace("'", "''")
-                            values.append(f"'{escaped}'")
-                        else:
-                            escaped = str(val).replace("'", "''")
-                            values.append(f"'{escaped}'")
-
-                    val_str = ", ".join(values)
-                    all_sql.append(
-                        f'INSERT INTO "{MAIN_DB_SCHEMA}"."{table}" ({col_list}) '
-                        f'VALUES ({val_str}) ON CONFLICT DO NOTHING;'
-                    )
-
-                all_sql.append("")
-                total_rows += len(rows)
-                print(f" {len(rows)} строк ✓")
-            else:
-                print(f" пусто")
 
-        except Exception as e:
-            print(f" ОШИБКА: {e}")
-            all_sql.append(f"-- ОШИБКА при экспорте таблицы {table}: {e}")
+def load_files_manifest():
+    if FILES_MANIFEST.exists():
+        return json.loads(FILES_MANIFEST.read_text(encoding="utf-8"))
+    return {}
 
-    all_sql.append("COMMIT;")
 
-    sql_file = OUTPUT_DIR / "database.sql"
-    with open(sql_file, "w", encoding="utf-8") as f:
-        f.write("\n".join(all_sql))
+def save_files_manifest(manifest):
+    tmp = FILES_MANIFEST.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(FILES_MANIFEST)
 
-    cur.close()
-    conn.close()
 
-    size_mb = sql_file.stat().st_size / 1024 / 1024
-    print(f"\n   ✅ База данных: {total_rows} строк, {size_mb:.1f} МБ → export/database.sql")
-    return total_rows, len(tables)
+def local_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_downloaded(local_path, size, etag, manifest_entry):
+    """Файл уже скачан: совпадает размер и ETag (по манифесту или по MD5 для обычных ETag)."""
+    if not local_path.exists() or local_path.stat().st_size != size:
+        return False
+    if manifest_entry is not None:
+        return manifest_entry.get("etag") == etag
+    # Файлы из прошлых запусков без манифеста: ETag обычной загрузки — это MD5 содержимого
+    if etag and "-" not in etag:
+        return local_md5(local_path) == etag
+    return True
 
 
-def export_files():
+def export_files(workers=None):
     import boto3
+    from botocore.config import Config
     from botocore.exceptions import ClientError
 
+    workers = workers or DOWNLOAD_WORKERS
     print("\n🖼️  Экспорт фотографий и файлов...")
 
     files_dir = OUTPUT_DIR / "files"
@@ -188,6 +364,7 @@ def export_files():
         endpoint_url=S3_ENDPOINT,
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=Config(max_pool_connections=workers * 2),
     )
 
     paginator = s3.get_paginator("list_objects_v2")
@@ -202,41 +379,77 @@ def export_files():
         print("   Проверьте AWS_ACCESS_KEY_ID и AWS_SECRET_ACCESS_KEY")
         return 0, 0
 
+    all_objects = [obj for obj in all_objects if not obj["Key"].startswith(SKIP_PREFIXES)]
     if not all_objects:
         print("   Файлов в хранилище нет")
         return 0, 0
 
-    print(f"   Найдено файлов: {len(all_objects)}")
-
-    downloaded = 0
-    total_size = 0
-    errors = 0
-
-    for i, obj in enumerate(all_objects, 1):
+    manifest = load_files_manifest()
+    pending = []
+    skipped = 0
+    for obj in all_objects:
         key = obj["Key"]
-        size = obj.get("Size", 0)
-
+        if key.endswith("/"):
+            continue
+        etag = obj.get("ETag", "").strip('"')
+        # Пропускаем если уже скачан и размер/ETag совпадают
+        if is_downloaded(files_dir / key, obj.get("Size", 0), etag, manifest.get(key)):
+            manifest[key] = {"size": obj.get("Size", 0), "etag": etag}
+            skipped += 1
+        else:
+            pending.append((key, obj.get("Size", 0), etag))
+
+    total_bytes = sum(size for _, size, _ in pending)
+    print(f"   Найдено файлов: {len(all_objects)}, уже скачано: {skipped}, "
+          f"к загрузке: {len(pending)} ({total_bytes / 1024 / 1024:.1f} МБ), потоков: {workers}")
+
+    lock = threading.Lock()
+    progress = {"files": 0, "bytes": 0, "errors": 0, "saved_at": time.time()}
+    started = time.time()
+
+    def download(key, size, etag):
         local_path = files_dir / key
         local_path.parent.mkdir(parents=True, exist_ok=True)
-
-        # Пропускаем если уже скачан и размер совпадает
-        if local_path.exists() and local_path.stat().st_size == size:
-            downloaded += 1
-            total_size += size
-            continue
-
-        print(f"   [{i}/{len(all_objects)}] {key} ({size/1024:.0f} КБ)...", end="", flush=True)
-        try:
-            s3.download_file(S3_BUCKET, key, str(local_path))
-            downloaded += 1
-            total_size += size
-            print(" ✓")
-        except Exception as e:
-            errors += 1
-            print(f" ✗ {e}")
-
-    size_mb = total_size / 1024 / 1024
-    print(f"\n   ✅ Файлы: {downloaded} скачано, {errors} ошибок, {size_mb:.1f} МБ → export/files/")
+        # Пишем во временный файл, чтобы прерванная загрузка не выглядела готовой
+        part_path = local_path.with_name(local_path.name + ".part")
+        s3.download_file(S3_BUCKET, key, str(part_path))
+        os.replace(part_path, local_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download, key, size, etag): (key, size, etag) for key, size, etag in pending}
+        for future in as_completed(futures):
+            key, size, etag = futures[future]
+            with lock:
+                try:
+                    future.result()
+                    manifest[key] = {"size": size, "etag": etag}
+                    progress["files"] += 1
+                    progress["bytes"] += size
+                except Exception as e:
+                    progress["errors"] += 1
+                    print(f"\n   ✗ {key}: {e}")
+
+                # Манифест сохраняется периодически — прерванный запуск продолжится с этого места
+                if time.time() - progress["saved_at"] > 5:
+                    save_files_manifest(manifest)
+                    progress["saved_at"] = time.time()
+
+                elapsed = max(time.time() - started, 0.001)
+                done = progress["files"] + progress["errors"]
+                print(f"\r   [{done}/{len(pending)}] {progress['bytes'] / 1024 / 1024:.1f} МБ, "
+                      f"{progress['bytes'] / 1024 / 1024 / elapsed:.1f} МБ/с, "
+                      f"{progress['files'] / elapsed:.1f} файлов/с", end="", flush=True)
+
+    save_files_manifest(manifest)
+
+    downloaded = skipped + progress["files"]
+    errors = progress["errors"]
+    size_mb = sum(obj.get("Size", 0) for obj in all_objects) / 1024 / 1024
+    elapsed = time.time() - started
+    print(f"\n\n   ✅ Файлы: {downloaded} скачано, {errors} ошибок, {size_mb:.1f} МБ → export/files/ "
+          f"(за {elapsed:.1f} с)")
+    if errors:
+        print("   Запустите скрипт снова — скачанные файлы будут пропущены.")
     return downloaded, errors
 
 
@@ -262,6 +475,16 @@ def write_info(db_rows, db_tables, files_count):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Экспорт данных из поехали.dev")
+    parser.add_argument("--incremental", action="store_true",
+                        help="выгрузить только строки, изменённые после прошлого экспорта")
+    parser.add_argument("--since", help="выгрузить строки, изменённые после указанного времени (ISO)")
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS,
+                        help="число параллельных загрузок файлов")
+    parser.add_argument("--copy", action="store_true",
+                        help="выгрузить таблицы в формате COPY для быстрого восстановления")
+    args = parser.parse_args()
+
     print("=" * 55)
     print("  Экспорт данных из поехали.dev")
     print("=" * 55)
@@ -270,8 +493,10 @@ def main():
 
     OUTPUT_DIR.mkdir(exist_ok=True)
 
-    db_rows, db_tables = export_database()
-    files_count, _ = export_files()
+    since = datetime.fromisoformat(args.since) if args.since else None
+    db_rows, db_tables = export_database(incremental=args.incremental or since is not None, since=since,
+                                         copy_format=args.copy)
+    files_count, _ = export_files(args.workers)
 
     write_info(db_rows, db_tables, files_count)
 
@@ -5,6 +5,15 @@
 Запуск (на вашем сервере, из папки проекта):
     pip install psycopg2-binary boto3
     python docker/import-to-server.py
+    python docker/import-to-server.py --workers 16   # больше параллельных загрузок
+    python docker/import-to-server.py --restart      # начать заново, игнорируя прогресс
+
+Если экспорт сделан с --copy (export/database/*.copy), таблицы загружаются
+через COPY, а индексы и внешние ключи пересоздаются после загрузки.
+Если есть export/database-incremental.sql (экспорт с --incremental), он применяется
+после основного дампа: новые строки добавляются, изменённые обновляются.
+Удалённые на поехали.dev строки инкрементальный экспорт не переносит.
+Прерванный импорт продолжается с места остановки при повторном запуске.
 
 Требования:
     - Docker Compose запущен (docker compose up -d)
@@ -13,8 +22,13 @@
 
 import os
 import sys
+import json
+import time
+import argparse
+import threading
 import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ─── НАСТРОЙКИ ──────────────────────────────────────────────────────────────
 # Берутся из .env автоматически, или задайте вручную
@@ -45,8 +59,20 @@ DB_SCHEMA = "public"
 
 MINIO_ENDPOINT = "http://localhost:9000"
 MINIO_BUCKET = "files"
+# Не загружаются: дампы базы из export-data (бакет files публичный) и недокачанные файлы
+SKIP_PREFIXES = ("exports/",)
 
 EXPORT_DIR = Path("export")
+COPY_MANIFEST = EXPORT_DIR / "database" / "tables.json"
+FULL_SQL_FILE = EXPORT_DIR / "database.sql"
+INCREMENTAL_SQL_FILE = EXPORT_DIR / "database-incremental.sql"
+# Прогресс импорта для продолжения после прерывания
+DB_STATE_FILE = EXPORT_DIR / "import-state.json"
+FILES_DONE_FILE = EXPORT_DIR / "import-files.done"
+
+IMPORT_WORKERS = int(ENV.get("IMPORT_WORKERS") or os.environ.get("IMPORT_WORKERS", "8"))
+# Файлы крупнее порога загружаются multipart-частями
+MULTIPART_CHUNK_MB = 8
 # ────────────────────────────────────────────────────────────────────────────
 
 
@@ -78,8 +104,7 @@ def check_requirements():
         print("Скопируйте папку export/ рядом с проектом и попробуйте снова.")
         sys.exit(1)
 
-    sql_file = EXPORT_DIR / "database.sql"
-    if not sql_file.exists():
+    if not FULL_SQL_FILE.exists() and not COPY_MANIFEST.exists() and not INCREMENTAL_SQL_FILE.exists():
         print(f"Ошибка: файл export/database.sql не найден.")
         sys.exit(1)
 
@@ -103,17 +128,206 @@ def wait_for_docker():
     print("   ✅ Docker сервисы работают")
 
 
-def import_database():
+def database_url():
+    return f"postgresql://{DB_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+
+def load_db_state():
+    if DB_STATE_FILE.exists():
+        return json.loads(DB_STATE_FILE.read_text(encoding="utf-8"))
+    return {"tables_done": []}
+
+
+def save_db_state(state):
+    tmp = DB_STATE_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(DB_STATE_FILE)
+
+
+def defer_indexes(cur, tables, state):
+    """Сохраняет и удаляет вторичные индексы и внешние ключи загружаемых таблиц."""
+    if "deferred" in state:
+        # Уже удалены в прерванном запуске — определения лежат в state
+        return
+
+    cur.execute("""
+        SELECT cl.relname, con.conname, pg_get_constraintdef(con.oid)
+        FROM pg_constraint con
+        JOIN pg_class cl ON cl.oid = con.conrelid
+        JOIN pg_namespace n ON n.oid = cl.relnamespace
+        WHERE n.nspname = %s AND con.contype = 'f' AND cl.relname = ANY(%s)
+    """, (DB_SCHEMA, tables))
+    foreign_keys = [{"table": t, "name": name, "definition": d} for t, name, d in cur.fetchall()]
+
+    # Первичные ключи и уникальные индексы остаются — они нужны для ON CONFLICT
+    cur.execute("""
+        SELECT i.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_class t ON t.oid = x.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        WHERE n.nspname = %s AND t.relname = ANY(%s)
+        AND NOT x.indisprimary AND NOT x.indisunique
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+    """, (DB_SCHEMA, tables))
+    indexes = [{"name": name, "definition": d} for name, d in cur.fetchall()]
+
+    state["deferred"] = {"foreign_keys": foreign_keys, "indexes": indexes}
+    save_db_state(state)
+
+    for fk in foreign_keys:
+        cur.execute(f'ALTER TABLE "{DB_SCHEMA}"."{fk["table"]}" DROP CONSTRAINT IF EXISTS "{fk["name"]}"')
+    for idx in indexes:
+        cur.execute(f'DROP INDEX IF EXISTS "{DB_SCHEMA}"."{idx["name"]}"')
+
+    print(f"   Отложено: {len(indexes)} индексов, {len(foreign_keys)} внешних ключей")
+
+
+def restore_indexes(cur, state):
+    """Пересоздаёт отложенные индексы и внешние ключи."""
     import psycopg2
 
-    sql_file = EXPORT_DIR / "database.sql"
-    size_mb = sql_file.stat().st_size / 1024 / 1024
-    print(f"\n🗄️  Импорт базы данных ({size_mb:.1f} МБ)...")
+    deferred = state.get("deferred")
+    if not deferred:
+        return
+
+    cur.execute("SET maintenance_work_mem = '512MB'")
+    started = time.time()
+    for idx in deferred["indexes"]:
+        try:
+            cur.execute(idx["definition"])
+        except psycopg2.errors.DuplicateTable:
+            pass
+    for fk in deferred["foreign_keys"]:
+        try:
+            cur.execute(
+                f'ALTER TABLE "{DB_SCHEMA}"."{fk["table"]}" ADD CONSTRAINT "{fk["name"]}" {fk["definition"]}'
+            )
+        except psycopg2.errors.DuplicateObject:
+            pass
+    print(f"   Индексы и внешние ключи пересозданы за {time.time() - started:.1f} с")
+
+    del state["deferred"]
+    save_db_state(state)
+
+
+def load_table_copy(table, columns, copy_file):
+    """Загружает одну таблицу из COPY-файла. Возвращает число строк."""
+    import psycopg2
+
+    conn = psycopg2.connect(database_url())
+    try:
+        cur = conn.cursor()
+        target = f'"{DB_SCHEMA}"."{table}"'
+        col_list = ", ".join(f'"{c}"' for c in columns)
+
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {target})")
+        has_rows = cur.fetchone()[0]
+
+        with open(copy_file, encoding="utf-8") as f:
+            if not has_rows:
+                cur.copy_expert(f"COPY {target} ({col_list}) FROM STDIN", f)
+                rows = cur.rowcount
+            else:
+                # В таблице уже есть данные — через промежуточную таблицу и ON CONFLICT DO NOTHING
+                cur.execute(f'CREATE TEMP TABLE "stage_{table}" (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP')
+                cur.copy_expert(f'COPY "stage_{table}" ({col_list}) FROM STDIN', f)
+                cur.execute(
+                    f'INSERT INTO {target} ({col_list}) SELECT {col_list} FROM "stage_{table}" ON CONFLICT DO NOTHING'
+                )
+                rows = cur.rowcount
+
+        if "id" in columns:
+            cur.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                f"(SELECT COALESCE(MAX(id), 0) + 1 FROM {target}), false) "
+                f"WHERE pg_get_serial_sequence(%s, 'id') IS NOT NULL",
+                (f'"{DB_SCHEMA}"."{table}"', f'"{DB_SCHEMA}"."{table}"')
+            )
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def import_database_copy(workers):
+    import psycopg2
+
+    manifest = json.loads(COPY_MANIFEST.read_text(encoding="utf-8"))
+    tables = manifest["tables"]
+    copy_dir = COPY_MANIFEST.parent
+    total_bytes = sum((copy_dir / f"{t}.copy").stat().st_size for t in tables)
+    print(f"\n🗄️  Импорт базы данных через COPY ({len(tables)} таблиц, {total_bytes / 1024 / 1024:.1f} МБ)...")
+
+    try:
+        conn = psycopg2.connect(database_url())
+        conn.autocommit = True
+        cur = conn.cursor()
+    except Exception as e:
+        print(f"   Ошибка подключения к БД: {e}")
+        print("   Убедитесь что Docker запущен: docker compose up -d")
+        sys.exit(1)
+
+    state = load_db_state()
+    done = set(state["tables_done"])
+    pending = [t for t in tables if t not in done]
+    if done:
+        print(f"   Продолжаем прерванный импорт: готово {len(done)} из {len(tables)} таблиц")
+
+    defer_indexes(cur, list(tables), state)
+
+    lock = threading.Lock()
+    started = time.time()
+    loaded_rows = 0
+    errors = 0
 
-    database_url = f"postgresql://{DB_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(load_table_copy, t, tables[t]["columns"], copy_dir / f"{t}.copy"): t
+            for t in pending
+        }
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                rows = future.result()
+                loaded_rows += rows
+                with lock:
+                    state["tables_done"].append(table)
+                    save_db_state(state)
+                print(f"   → {table}: {rows} строк ✓")
+            except Exception as e:
+                errors += 1
+                print(f"   → {table}: ОШИБКА {e}")
+
+    elapsed = max(time.time() - started, 0.001)
+    loaded_bytes = sum((copy_dir / f"{t}.copy").stat().st_size for t in pending)
+    print(f"   Загрузка: {loaded_rows} строк за {elapsed:.1f} с "
+          f"({loaded_rows / elapsed:,.0f} строк/с, {loaded_bytes / 1024 / 1024 / elapsed:.1f} МБ/с)")
+
+    if errors:
+        print(f"   {errors} таблиц не загружено. Индексы будут пересозданы после успешного повтора.")
+        print("   Исправьте ошибку и запустите скрипт снова — загруженные таблицы будут пропущены.")
+        cur.close()
+        conn.close()
+        sys.exit(1)
+
+    restore_indexes(cur, state)
+    cur.execute("ANALYZE")
+    cur.close()
+    conn.close()
+
+    DB_STATE_FILE.unlink(missing_ok=True)
+    print(f"   ✅ База данных импортирована успешно")
+
+
+def import_database(sql_file=FULL_SQL_FILE):
+    import psycopg2
+
+    size_mb = sql_file.stat().st_size / 1024 / 1024
+    print(f"\n🗄️  Импорт базы данных из {sql_file.name} ({size_mb:.1f} МБ)...")
 
     try:
-        conn = psycopg2.connect(database_url)
+        conn = psycopg2.connect(database_url())
         conn.autocommit = True
         cur = conn.cursor()
     except Exception as e:
@@ -154,8 +368,18 @@ def import_database():
         conn.close()
 
 
-def import_files():
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg",
+    ".png": "image/png", ".gif": "image/gif",
+    ".webp": "image/webp", ".svg": "image/svg+xml",
+    ".pdf": "application/pdf", ".mp4": "video/mp4",
+}
+
+
+def import_files(workers):
     import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
     from botocore.exceptions import ClientError
 
     files_dir = EXPORT_DIR / "files"
@@ -170,13 +394,31 @@ def import_files():
         print("\n🖼️  Нет файлов для импорта.")
         return 0
 
-    print(f"\n🖼️  Импорт файлов ({len(all_files)} шт)...")
+    # Уже загруженные ключи из прошлых запусков
+    done_keys = set()
+    if FILES_DONE_FILE.exists():
+        done_keys = set(FILES_DONE_FILE.read_text(encoding="utf-8").splitlines())
+
+    # Вычисляем ключ относительно папки files/
+    pending = [
+        (f, str(f.relative_to(files_dir)).replace("\\", "/"))
+        for f in all_files
+    ]
+    pending = [
+        (f, key) for f, key in pending
+        if key not in done_keys and not key.startswith(SKIP_PREFIXES) and not key.endswith(".part")
+    ]
+
+    print(f"\n🖼️  Импорт файлов ({len(all_files)} шт, осталось {len(pending)}, потоков: {workers})...")
+    if not pending:
+        return len(all_files)
 
     s3 = boto3.client(
         "s3",
         endpoint_url=MINIO_ENDPOINT,
         aws_access_key_id=MINIO_ROOT_USER,
         aws_secret_access_key=MINIO_ROOT_PASSWORD,
+        config=Config(max_pool_connections=workers * 2),
     )
 
     # Создаём bucket если нет
@@ -199,44 +441,64 @@ def import_files():
         except Exception as e:
             print(f"   Ошибка создания bucket: {e}")
 
-    uploaded = 0
-    errors = 0
-
-    for i, file_path in enumerate(all_files, 1):
-        # Вычисляем ключ относительно папки files/
-        key = str(file_path.relative_to(files_dir)).replace("\\", "/")
+    transfer_config = TransferConfig(
+        multipart_threshold=MULTIPART_CHUNK_MB * 1024 * 1024,
+        multipart_chunksize=MULTIPART_CHUNK_MB * 1024 * 1024,
+        max_concurrency=4,
+    )
 
+    def upload(file_path, key):
         # Определяем content-type
-        suffix = file_path.suffix.lower()
-        content_types = {
-            ".jpg": "image/jpeg", ".jpeg": "image/jpeg",
-            ".png": "image/png", ".gif": "image/gif",
-            ".webp": "image/webp", ".svg": "image/svg+xml",
-            ".pdf": "application/pdf", ".mp4": "video/mp4",
-        }
-        content_type = content_types.get(suffix, "application/octet-stream")
-
-        print(f"   [{i}/{len(all_files)}] {key}...", end="", flush=True)
-
-        try:
-            s3.upload_file(
-                str(file_path),
-                MINIO_BUCKET,
-                key,
-                ExtraArgs={"ContentType": content_type}
-            )
-            uploaded += 1
-            print(" ✓")
-        except Exception as e:
-            errors += 1
-            print(f" ✗ {e}")
+        content_type = CONTENT_TYPES.get(file_path.suffix.lower(), "application/octet-stream")
+        s3.upload_file(
+            str(file_path),
+            MINIO_BUCKET,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=transfer_config,
+        )
+        return file_path.stat().st_size
 
-    print(f"\n   ✅ Файлы: {uploaded} загружено, {errors} ошибок")
-    return uploaded
+    uploaded = 0
+    errors = 0
+    uploaded_bytes = 0
+    started = time.time()
+
+    with open(FILES_DONE_FILE, "a", encoding="utf-8") as done_log, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(upload, f, key): key for f, key in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                uploaded_bytes += future.result()
+                uploaded += 1
+                done_log.write(key + "\n")
+                done_log.flush()
+                elapsed = max(time.time() - started, 0.001)
+                print(f"   [{i}/{len(pending)}] {key} ✓  "
+                      f"{uploaded_bytes / 1024 / 1024 / elapsed:.1f} МБ/с", flush=True)
+            except Exception as e:
+                errors += 1
+                print(f"   [{i}/{len(pending)}] {key} ✗ {e}", flush=True)
+
+    elapsed = max(time.time() - started, 0.001)
+    print(f"\n   ✅ Файлы: {uploaded} загружено, {errors} ошибок, "
+          f"{uploaded_bytes / 1024 / 1024:.1f} МБ за {elapsed:.1f} с "
+          f"({uploaded_bytes / 1024 / 1024 / elapsed:.1f} МБ/с, {uploaded / elapsed:.1f} файлов/с)")
+    if not errors:
+        FILES_DONE_FILE.unlink(missing_ok=True)
+    else:
+        print("   Запустите скрипт снова — загруженные файлы будут пропущены.")
+    return len(done_keys) + uploaded
 
 
 def main():
-    import json
+    parser = argparse.ArgumentParser(description="Импорт данных в локальный сервер")
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS,
+                        help="число параллельных загрузок (таблиц и файлов)")
+    parser.add_argument("--restart", action="store_true",
+                        help="не продолжать прерванный импорт, начать заново")
+    args = parser.parse_args()
 
     print("=" * 55)
     print("  Импорт данных в локальный сервер")
@@ -255,13 +517,29 @@ def main():
 
     print("\nПредупреждение: существующие данные НЕ удаляются.")
     print("Используется INSERT ... ON CONFLICT DO NOTHING")
+    if INCREMENTAL_SQL_FILE.exists():
+        print("Изменения из database-incremental.sql обновят существующие строки (ON CONFLICT DO UPDATE)")
     answer = input("\nПродолжить? [y/N]: ").strip().lower()
     if answer != "y":
         print("Отменено.")
         sys.exit(0)
 
-    import_database()
-    import_files()
+    if args.restart:
+        if DB_STATE_FILE.exists() and "deferred" in load_db_state():
+            # Отложенные индексы нельзя потерять — сохраняем только их
+            save_db_state({"tables_done": [], "deferred": load_db_state()["deferred"]})
+        else:
+            DB_STATE_FILE.unlink(missing_ok=True)
+        FILES_DONE_FILE.unlink(missing_ok=True)
+
+    if COPY_MANIFEST.exists():
+        import_database_copy(args.workers)
+    elif FULL_SQL_FILE.exists():
+        import_database()
+    if INCREMENTAL_SQL_FILE.exists():
+        # Изменения после основного дампа: ON CONFLICT DO UPDATE перезаписывает строки новыми значениями
+        import_database(INCREMENTAL_SQL_FILE)
+    import_files(args.workers)
 
     print("\n" + "=" * 55)
     print("  ✅ Импорт завершён!")
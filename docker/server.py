@@ -1,19 +1,50 @@
 """
 FastAPI adapter that wraps all serverless backend functions
 and exposes them as HTTP endpoints.
+
+Besides JSON bodies with base64-encoded files, functions accept uploads as
+multipart/form-data or as a raw binary body. Both are streamed to a spooled
+temp file (on disk above UPLOAD_SPOOL_BYTES) and handed to the function in the
+usual event format:
+
+- multipart: a JSON body with text fields as strings and files base64-encoded
+  under their field names, e.g. a form with image=<file>, max_width=800 becomes
+  {"image": "<base64>", "max_width": "800"};
+- binary (application/octet-stream, image/*, application/pdf, ...): the body is
+  base64-encoded with isBase64Encoded=True, as the cloud gateway does.
+
+UPLOAD_MAX_BYTES is enforced on the bytes actually received, so chunked requests
+are limited too. The event body has to be a str: large bodies are assembled in a
+temp file and decoded from an mmap of it, so the final str is the only full-size
+copy in memory.
 """
 
+import base64
+import io
 import json
+import mmap
 import os
 import sys
 import importlib.util
-from typing import Any
+from tempfile import SpooledTemporaryFile, TemporaryFile
+from typing import Any, BinaryIO, List, Tuple
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
 
 sys.path.insert(0, "/app/backend")
 
+# Uploads above this size are spooled to disk instead of being held in memory
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_MAX_PARTS = int(os.environ.get("UPLOAD_MAX_PARTS", "1000"))
+# Read and base64-encode in blocks divisible by 3 so the pieces concatenate cleanly
+UPLOAD_BLOCK_BYTES = 3 * 256 * 1024
+TEXT_CONTENT_TYPES = ("application/json", "text/", "application/x-www-form-urlencoded",
+                      "application/xml", "application/javascript")
+
 app = FastAPI()
 
 app.add_middleware(
@@ -88,6 +119,10 @@ def load_handler(function_name: str):
         module_path
     )
     module = importlib.util.module_from_spec(spec)
+    # Соседние модули функции (например, log_parser.py) импортируются как в облаке
+    function_dir = os.path.dirname(module_path)
+    if function_dir not in sys.path:
+        sys.path.insert(0, function_dir)
     spec.loader.exec_module(module)
 
     handler = getattr(module, "handler", None)
@@ -103,14 +138,193 @@ class FakeContext:
         self.invoked_function_arn = "arn:local:docker"
 
 
-async def build_event(request: Request) -> dict:
+class UploadTooLarge(Exception):
+    pass
+
+
+class BadUpload(Exception):
+    pass
+
+
+Part = Tuple[str, bool, SpooledTemporaryFile]
+
+
+def is_binary_content_type(content_type: str) -> bool:
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    return bool(content_type) and not content_type.startswith(TEXT_CONTENT_TYPES)
+
+
+def base64_size(size: int) -> int:
+    return (size + 2) // 3 * 4
+
+
+def body_buffer(estimated_size: int) -> BinaryIO:
+    """Buffer for assembling an event body: memory for small bodies, a temp file otherwise"""
+    return io.BytesIO() if estimated_size <= UPLOAD_SPOOL_BYTES else TemporaryFile()
+
+
+def copy_base64(src: BinaryIO, out: BinaryIO) -> None:
+    """Write base64 of src to out block by block"""
+    src.seek(0)
+    for block in iter(lambda: src.read(UPLOAD_BLOCK_BYTES), b""):
+        out.write(base64.b64encode(block))
+
+
+def read_ascii(out: BinaryIO) -> str:
+    """Decode the assembled body straight from the buffer, without an intermediate bytes copy"""
+    if isinstance(out, io.BytesIO):
+        with out.getbuffer() as view:
+            return str(view, "ascii")
+    out.flush()
+    if out.tell() == 0:
+        return ""
+    with mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        return str(view, "ascii")
+
+
+async def stream_body(request: Request):
+    """Request body chunks, counting actual bytes against UPLOAD_MAX_BYTES"""
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge()
+        yield chunk
+
+
+async def spool_body(request: Request) -> SpooledTemporaryFile:
+    spool = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
     try:
-        raw_body = await request.body()
-        body = raw_body.decode("utf-8") if raw_body else ""
-    except Exception:
-        body = ""
+        async for chunk in stream_body(request):
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+async def parse_multipart(request: Request, content_type: str) -> List[Part]:
+    """Stream a multipart body into one spooled temp file per part: (field name, is file, data)"""
+    _, options = parse_options_header(content_type)
+    boundary = options.get(b"boundary")
+    if not boundary:
+        raise BadUpload("Missing boundary in multipart")
+
+    parts: List[Part] = []
+    header = {"field": b"", "value": b"", "disposition": b""}
+
+    def on_part_begin():
+        header["disposition"] = b""
+
+    def on_header_field(data, start, end):
+        header["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        if header["field"].lower() == b"content-disposition":
+            header["disposition"] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(header["disposition"])
+        if b"name" not in disposition:
+            raise BadUpload('Multipart part without a "name"')
+        if len(parts) >= UPLOAD_MAX_PARTS:
+            raise BadUpload(f"Too many multipart parts, maximum is {UPLOAD_MAX_PARTS}")
+        name = disposition[b"name"].decode("utf-8", "replace")
+        parts.append((name, b"filename" in disposition, SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)))
+
+    def on_part_data(data, start, end):
+        parts[-1][2].write(data[start:end])
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+    try:
+        async for chunk in stream_body(request):
+            parser.write(chunk)
+        parser.finalize()
+    except BaseException as e:
+        for _, _, data in parts:
+            data.close()
+        if isinstance(e, MultipartParseError):
+            raise BadUpload(f"Malformed multipart body: {e}") from None
+        raise
+    return parts
+
+
+def multipart_to_json(parts: List[Part]) -> str:
+    """JSON body functions expect: files base64-encoded under their field names, repeated fields as lists"""
+    fields: dict = {}
+    for name, is_file, data in parts:
+        fields.setdefault(name, []).append((is_file, data))
+
+    estimated = sum(base64_size(data.tell()) if is_file else data.tell() * 6 for _, is_file, data in parts)
+    out = body_buffer(estimated)
+    try:
+        out.write(b"{")
+        for index, (name, values) in enumerate(fields.items()):
+            if index:
+                out.write(b",")
+            out.write(json.dumps(name).encode() + b":")
+            if len(values) > 1:
+                out.write(b"[")
+            for value_index, (is_file, data) in enumerate(values):
+                if value_index:
+                    out.write(b",")
+                if is_file:
+                    # base64 needs no JSON escaping
+                    out.write(b'"')
+                    copy_base64(data, out)
+                    out.write(b'"')
+                else:
+                    data.seek(0)
+                    out.write(json.dumps(data.read().decode("utf-8", "replace")).encode())
+            if len(values) > 1:
+                out.write(b"]")
+        out.write(b"}")
+        return read_ascii(out)
+    finally:
+        out.close()
 
+
+async def build_event(request: Request) -> dict:
     headers = dict(request.headers)
+    content_type = headers.get("content-type", "")
+    is_base64 = False
+
+    if content_type.lower().startswith("multipart/form-data"):
+        parts = await parse_multipart(request, content_type)
+        try:
+            body = multipart_to_json(parts)
+        finally:
+            for _, _, data in parts:
+                data.close()
+        headers["x-original-content-type"] = content_type
+        headers["content-type"] = "application/json"
+    elif is_binary_content_type(content_type):
+        spool = await spool_body(request)
+        out = body_buffer(base64_size(spool.tell()))
+        try:
+            copy_base64(spool, out)
+            body = read_ascii(out)
+        finally:
+            out.close()
+            spool.close()
+        is_base64 = bool(body)
+    else:
+        try:
+            raw_body = await request.body()
+            body = raw_body.decode("utf-8") if raw_body else ""
+        except Exception:
+            body = ""
 
     query_params = dict(request.query_params)
 
@@ -120,7 +334,7 @@ async def build_event(request: Request) -> dict:
         "headers": headers,
         "queryStringParameters": query_params if query_params else {},
         "body": body,
-        "isBase64Encoded": False,
+        "isBase64Encoded": is_base64,
         "requestContext": {
             "identity": {
                 "sourceIp": request.client.host if request.client else "127.0.0.1"
@@ -142,10 +356,13 @@ def make_response(result: dict) -> Response:
     headers = result.get("headers", {})
     body = result.get("body", "")
 
-    if not isinstance(body, str):
-        body = json.dumps(body)
+    if result.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    else:
+        if not isinstance(body, str):
+            body = json.dumps(body)
 
-    body = patch_s3_urls(body)
+        body = patch_s3_urls(body)
 
     response_headers = {}
     for k, v in headers.items():
@@ -154,7 +371,8 @@ def make_response(result: dict) -> Response:
 
     response_headers["Access-Control-Allow-Origin"] = "*"
     response_headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
-    response_headers["Access-Control-Allow-Headers"] = "Content-Type, X-User-Id, X-Auth-Token, X-Session-Id, Authorization"
+    response_headers["Access-Control-Allow-Headers"] = "Content-Type, X-User-Id, X-Auth-Token, X-Session-Id, Authorization, If-None-Match"
+    response_headers["Access-Control-Expose-Headers"] = "ETag"
 
     content_type = response_headers.get("Content-Type", "application/json")
 
@@ -175,7 +393,7 @@ async def proxy(function_name: str, request: Request, path: str = ""):
             headers={
                 "Access-Control-Allow-Origin": "*",
                 "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, X-User-Id, X-Auth-Token, X-Session-Id, Authorization",
+                "Access-Control-Allow-Headers": "Content-Type, X-User-Id, X-Auth-Token, X-Session-Id, Authorization, If-None-Match",
                 "Access-Control-Max-Age": "86400",
             }
         )
@@ -188,7 +406,20 @@ async def proxy(function_name: str, request: Request, path: str = ""):
             headers={"Access-Control-Allow-Origin": "*"}
         )
 
-    event = await build_event(request)
+    try:
+        event = await build_event(request)
+    except UploadTooLarge:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"Upload exceeds {UPLOAD_MAX_BYTES} bytes"},
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
+    except BadUpload as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": str(e)},
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
     context = FakeContext()
 
     try: